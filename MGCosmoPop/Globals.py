@@ -12,4 +12,10 @@ detectorPath=os.path.join(dataPath, 'detectors')
 
 
 thetaPath=os.path.join(dataPath, 'theta')
-#print('theta Directory: %s' %thetaPath)
\ No newline at end of file
+#print('theta Directory: %s' %thetaPath)
+
+cosmoPath=os.path.join(dataPath, 'cosmology')
+#print('Cosmology tables Directory: %s' %cosmoPath)
+
+popPath=os.path.join(dataPath, 'population')
+#print('Population tables Directory: %s' %popPath)
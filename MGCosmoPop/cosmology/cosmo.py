@@ -12,13 +12,76 @@ from scipy import interpolate
 from astropy import constants as const
 import astropy.units as u
 from scipy.optimize import fsolve
+from scipy.special import hyp2f1
+import os
+import sys
 
+PACKAGE_PARENT = '..'
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import utils
+from .emulator import ComovingDistanceEmulator, E_flat_wCDM
+
+
+
+def uu_flat_LCDM(z, Om):
+    '''
+    Dimensionless comoving distance in flat LCDM without radiation, in closed form:
+    
+        uu(z) = [ F(1+z) - F(1) ] / sqrt(1-Om),   F(y) = y 2F1(1/3, 1/2; 4/3; -Om y^3/(1-Om) )
+    
+    For z<1e-03 the difference is replaced by its Taylor expansion to fourth order 
+    to avoid cancellations. The relative error is below 1e-11 for 0<z<1e05 
+    '''
+    z = np.asarray(z, dtype=float)
+    if Om==1:
+        return -2*np.expm1(-np.log1p(z)/2)
+    OL = 1-Om
+    F = lambda y: y*hyp2f1(1/3, 1/2, 4/3, -Om*y**3/OL)
+    res = np.atleast_1d( (F(1+z)-F(1.))/np.sqrt(OL) )
+    small = np.atleast_1d(z<1e-03)
+    zs = np.atleast_1d(z)[small]
+    res[small] = zs*(1+zs*(-3*Om/4+zs*(9*Om**2/8-Om/2+zs*(-Om/8+27*Om**2/16-135*Om**3/64))))
+    return res.reshape(z.shape)
 
 
 
 class Cosmo(object):
     
-    def __init__(self, dist_unit = u.Gpc, baseValues=None):
+    def __init__(self, dist_unit = u.Gpc, baseValues=None, use_emulator=False, emulator_args={}, cache_size=32, kernels='astropy', analytic_LCDM=True):
+        '''
+        If analytic_LCDM is True, for w0=-1 the comoving distance is computed in closed form 
+        (see uu_flat_LCDM) instead of with astropy. This is used by uu, E, dLGW and z_from_dLGW_fast, 
+        and takes precedence over the emulator. 
+        
+        If use_emulator is True, the dimensionless comoving distance is obtained from a 
+        table (see cosmology.emulator.ComovingDistanceEmulator) instead of astropy, 
+        and E(z) from its closed form. This is used by uu, E, dLGW and z_from_dLGW_fast, and by
+        all the functions that call them. 
+        Values of (Om, w0) outside the tabulated range fall back to astropy.
+        emulator_args are passed to ComovingDistanceEmulator. The table is computed when the class is 
+        initialised, and is only saved to disk (and re-used) if a file name is given with emulator_args['fname']
+        
+        cache_size is the max number of interpolators for z(dL) and uu(z) kept in memory 
+        (one for each value of Om, w0, Xi0, n. See z_from_dLGW_fast)
+        
+        kernels selects how log_dV_dz and log_ddL_dz are computed: 
+            - 'astropy' uses the functions uu and E 
+            - 'numpy' uses pure numpy expressions, sharing E(z), uu(z), (1+z)^-n between the two 
+               when called through log_jacobians. uu(z) is interpolated from its values on zGridGlobals 
+               (or taken from the emulator if use_emulator is True). 
+               The relative difference wrt the 'astropy' kernels is of order 1e-06 for z<1e05
+        
+        z_from_dLGW_fast, dLGW, log_dV_dz, log_ddL_dz and log_jacobians also accept arrays 
+        of parameters, one value for each point in parameter space (e.g. the walkers of an ensemble sampler). 
+        In that case the result has shape (n_points, n_samples) - or (n_points, )+shape for 
+        samples with more dimensions. See _batch_eval.
+        '''
+        if kernels not in ('astropy', 'numpy'):
+            raise ValueError('kernels should be one among astropy, numpy. Got %s' %kernels)
+        self.kernels=kernels
+        self.analytic_LCDM=analytic_LCDM
         
         self.dist_unit=dist_unit
         self.params = ['H0', 'Om', 'w0', 'Xi0', 'n']
@@ -46,6 +109,15 @@ class Cosmo(object):
         self.dLGridGlobals = self.cosmoGlobals.luminosity_distance(self.zGridGlobals).to(dist_unit).value
 
         self.clight=const.c.value*1e-03 # c in km/s
+        self.Mpc_to_dist_unit = (1*u.Mpc).to(dist_unit).value
+        
+        if use_emulator:
+            self.emulator = ComovingDistanceEmulator(**emulator_args)
+        else:
+            self.emulator = None
+        
+        self._z_from_dL_cache = utils.LRUCache(maxsize=cache_size)
+        self._uu_cache = utils.LRUCache(maxsize=cache_size)
         
     
     
@@ -79,14 +151,66 @@ class Cosmo(object):
     
     
 
+    ######################
+    # BATCHED EVALUATION
+    ######################
+    
+    def _is_batch(self, H0, *params):
+        '''
+        True if the parameters are given as arrays (one value for each point). 
+        H0 with more than one dimension is treated as already broadcast against the samples
+        '''
+        return np.ndim(H0)==1 or any(np.ndim(p)>0 for p in params)
+    
+    
+    def _batch_eval(self, func, samples, H0, params, shared=False):
+        '''
+        Evaluates func(*samples, H0, *params) for arrays of parameters of length n_points.
+        
+        H0 enters only through broadcasting, so func is called once for each 
+        unique value of the other parameters (only once if just H0 varies).
+        
+        samples: list of arrays. If shared is True they are the same for all points 
+        (e.g. the observed luminosity distances); otherwise the first axis has length n_points 
+        (e.g. redshifts computed in a batch) or 1. 1D arrays are always shared.
+        
+        Returns array of shape (n_points, ...)
+        '''
+        H0, *params = np.broadcast_arrays(*[np.atleast_1d(np.asarray(p, dtype=float)) for p in [H0]+list(params)])
+        nPoints = H0.shape[0]
+        
+        samples = [np.asarray(x) for x in samples]
+        samples = [x[None] if (shared or x.ndim<2) else x for x in samples]
+        outShape = np.broadcast_shapes((nPoints,), *[x.shape[:1] for x in samples])+np.broadcast_shapes(*[x.shape[1:] for x in samples])
+        H0 = H0.reshape( (-1,)+(1,)*(len(outShape)-1) )
+        
+        res = np.empty(outShape)
+        uniqueParams, inv = np.unique(np.stack(params, axis=-1), axis=0, return_inverse=True)
+        for i, p in enumerate(uniqueParams):
+            idx = np.flatnonzero(inv.ravel()==i)
+            rows = [x[idx] if x.shape[0]==nPoints else x for x in samples]
+            res[idx] = func(*rows, H0[idx], *p)
+        return res
+    
+    
     ######################
     # FUNCTIONS FOR COSMOLOGY
     ######################
+    
+    def _use_analytic(self, Om, w0):
+        return self.analytic_LCDM and w0==-1 and 0<=Om<=1
+    
+    def _use_emulator(self, Om, w0):
+        return (self.emulator is not None) and self.emulator.covers(Om, w0)
 
     def uu(self, z, Om, w0):
         '''
         Dimensionless comoving distance. Does not depend on H0
         '''
+        if self._use_analytic(Om, w0):
+            return uu_flat_LCDM(z, Om)
+        if self._use_emulator(Om, w0):
+            return self.emulator.uu(z, Om, w0)
         if w0!=-1:
             return 70/self.clight*FlatwCDM(H0=70, Om0=Om, w0=w0).comoving_distance(z).to(u.Mpc).value
         else:
@@ -96,6 +220,8 @@ class Cosmo(object):
         '''
         E(z). Does not depend on H0
         '''
+        if self._use_analytic(Om, w0) or self._use_emulator(Om, w0):
+            return E_flat_wCDM(z, Om, w0)
         if w0!=-1:
             return FlatwCDM(H0=70, Om0=Om, w0=w0).efunc(z)
         else:
@@ -113,6 +239,10 @@ class Cosmo(object):
             return 4*np.pi*FlatLambdaCDM(H0=H0, Om0=Om,).differential_comoving_volume(z).to(self.dist_unit**3/u.sr).value
 
     def log_dV_dz(self, z, H0, Om0, w0):
+        if self._is_batch(H0, Om0, w0):
+            return self._batch_eval(self.log_dV_dz, [z], H0, [Om0, w0])
+        if self.kernels=='numpy':
+            return self._log_dV_dz_numpy(z, H0, self._uu_fast(z, Om0, w0), E_flat_wCDM(z, Om0, w0))
         res =  np.log(4*np.pi)+3*np.log(self.clight)-3*np.log(H0)+2*np.log(self.uu(z, Om0, w0))-np.log(self.E(z, Om0, w0))
         if self.dist_unit==u.Gpc:
             res -=9*np.log(10)
@@ -137,8 +267,15 @@ class Cosmo(object):
 
 
     def log_ddL_dz(self, z, H0, Om0, w0, Xi0, n, dL=None):
+        if self._is_batch(H0, Om0, w0, Xi0, n):
+            if dL is None:
+                return self._batch_eval(self.log_ddL_dz, [z], H0, [Om0, w0, Xi0, n])
+            return self._batch_eval(lambda z, dL, *args: self.log_ddL_dz(z, *args, dL=dL), [z, dL], H0, [Om0, w0, Xi0, n])
+        if self.kernels=='numpy':
+            uu = self._uu_fast(z, Om0, w0) if dL is None else None
+            return self._log_ddL_dz_numpy(z, H0, Xi0, n, uu, E_flat_wCDM(z, Om0, w0), dL=dL)
         if self.dist_unit==u.Gpc: # and dL is not None:
-            H0*=1e03
+            H0=H0*1e03
         
         if Xi0!=1 and n!=0:
         
@@ -158,11 +295,77 @@ class Cosmo(object):
         #if self.dist_unit==u.Gpc and dL is None:
         #    res -= 3*np.log(10)
         return res
+    
+    
+    def log_jacobians(self, z, H0, Om0, w0, Xi0, n, dL=None):
+        '''
+        Returns log_dV_dz and log_ddL_dz evaluated at the same redshifts.
+        With kernels='numpy' the two are computed in a single pass, sharing E(z) and uu(z).
+        '''
+        if self.kernels=='astropy' or self._is_batch(H0, Om0, w0, Xi0, n):
+            return self.log_dV_dz(z, H0, Om0, w0), self.log_ddL_dz(z, H0, Om0, w0, Xi0, n, dL=dL)
+        uu = self._uu_fast(z, Om0, w0)
+        E = E_flat_wCDM(z, Om0, w0)
+        return self._log_dV_dz_numpy(z, H0, uu, E), self._log_ddL_dz_numpy(z, H0, Xi0, n, uu, E, dL=dL)
+    
+    
+    ######################
+    # NUMPY KERNELS
+    ######################
+    
+    def _uu_fast(self, z, Om, w0):
+        '''
+        Dimensionless comoving distance without astropy. 
+        Uses the emulator if available, otherwise interpolates the values on zGridGlobals 
+        (computed once for each Om, w0)
+        '''
+        if self._use_emulator(Om, w0):
+            return self.emulator.uu(z, Om, w0)
+        return self._get_uu_interpolator(Om, w0)(z)
+    
+    
+    def _get_uu_interpolator(self, Om, w0):
+        return self._uu_cache.get( (Om, w0), lambda: interpolate.interp1d( self.zGridGlobals, self.uu(self.zGridGlobals, Om, w0), kind='cubic', bounds_error=False, fill_value=(0, np.NaN), assume_sorted=True) )
+    
+    
+    def _log_dV_dz_numpy(self, z, H0, uu, E):
+        res = np.log(4*np.pi)+3*np.log(self.clight)-3*np.log(H0)+2*np.log(uu)-np.log(E)
+        if self.dist_unit==u.Gpc:
+            res -=9*np.log(10)
+        return res
+    
+    
+    def _log_ddL_dz_numpy(self, z, H0, Xi0, n, uu, E, dL=None):
+        '''
+        Same as log_ddL_dz, given uu(z) and E(z). 
+        (1+z)^-n is computed only once. uu is not used if dL is given
+        '''
+        if self.dist_unit==u.Gpc:
+            H0=H0*1e03
+        zp1 = 1+z
+        
+        if Xi0!=1 and n!=0:
+            zp1n = zp1**(-n)
+            Xi = Xi0+(1-Xi0)*zp1n
+            if dL is None:
+                sPrime = Xi-n*(1-Xi0)*zp1n
+                return np.log(self.clight/H0)+np.log( sPrime*uu+zp1*Xi/E )
+            return np.log( dL/zp1*( 1-n*(1-Xi0)*zp1n/Xi )+self.clight*zp1*Xi/(H0*E) )
+        
+        if dL is None:
+            return np.log(self.clight/H0)+np.log( uu+zp1/E )
+        return np.log( dL/zp1+self.clight*zp1/(H0*E) )
+    
 
     def dLGW(self, z, H0, Om, w0, Xi0, n):
         '''                                                                                                          
         Modified GW luminosity distance in units set by self.dist_unit (default Mpc)                                                                           
         '''
+        if self._is_batch(H0, Om, w0, Xi0, n):
+            # H0 is an array, so use dL = (1+z)*c/H0*uu*Xi instead of astropy
+            return self._batch_eval(lambda z, H0, Om, w0, Xi0, n: (1+z)*self.uu(z, Om, w0)*self.clight/H0*self.Mpc_to_dist_unit*self.Xi(z, Xi0, n), [z], H0, [Om, w0, Xi0, n])
+        if self._use_analytic(Om, w0) or self._use_emulator(Om, w0):
+            return (1+z)*self.uu(z, Om, w0)*self.clight/H0*self.Mpc_to_dist_unit*self.Xi(z, Xi0, n)
         if w0!=-1:
             cosmo=FlatwCDM(H0=H0, Om0=Om, w0=w0, )
         else:
@@ -187,18 +390,76 @@ class Cosmo(object):
     def z_from_dLGW_fast(self, r, H0, Om, w0, Xi0, n):
         '''
         Returns redshift for a given luminosity distance r (in Mpc by default). Vectorized
+        
+        Uses the fact that H0*dL does not depend on H0. The interpolator for z(H0*dL) is computed 
+        once for each value of (Om, w0, Xi0, n) and kept in a cache, so that it is
+        shared by all the calls with the same parameters (e.g. between the likelihood and the selection effects)
+        
+        If the parameters are arrays, r is the same for all points and the result has shape (n_points, )+r.shape
         '''
-        if (Om==self.baseValues['Om']) & (w0==-1.):
-            dLGrid = self.dLGridGlobals/H0*self.baseValues['H0']
-        else:
-            if w0==-1:
-                cosmo = FlatLambdaCDM(H0=H0, Om0=Om, )
-            else:
-                cosmo = FlatwCDM(H0=H0, Om0=Om, w0=w0, )
-            dLGrid = cosmo.luminosity_distance(self.zGridGlobals).to(self.dist_unit).value
-        z2dL = interpolate.interp1d( dLGrid*self.Xi(self.zGridGlobals, Xi0, n), self.zGridGlobals, kind='cubic', bounds_error=False, fill_value=(0,np.NaN), assume_sorted=False)
-        return z2dL(r)
+        if self._is_batch(H0, Om, w0, Xi0, n):
+            return self._batch_eval(self.z_from_dLGW_fast, [r], H0, [Om, w0, Xi0, n], shared=True)
+        z2dL = self._get_z_from_dL_interpolator(Om, w0, Xi0, n)
+        return z2dL(r*H0/(self.clight*self.Mpc_to_dist_unit))
+    
+    
+    def _get_z_from_dL_interpolator(self, Om, w0, Xi0, n):
+        if Xi0==1 or n==0:
+            Xi0, n = 1., 0.
+        return self._z_from_dL_cache.get( (Om, w0, Xi0, n), lambda: self._make_z_from_dL_interpolator(Om, w0, Xi0, n))
+    
+    
+    def _make_z_from_dL_interpolator(self, Om, w0, Xi0, n):
+        '''
+        Interpolator for z as a function of the dimensionless GW luminosity distance H0*dL/c
+        '''
+        dLGrid = (1+self.zGridGlobals)*self._get_uu_interpolator(Om, w0).y*self.Xi(self.zGridGlobals, Xi0, n)
+        # the emulator gives nan above its max redshift
+        ok = np.isfinite(dLGrid)
+        return interpolate.interp1d( dLGrid[ok], self.zGridGlobals[ok], kind='cubic', bounds_error=False, fill_value=(0,np.NaN), assume_sorted=False)
 
+    def set_z_grid(self, dL_max, dL_min=None, priorLimits={}, margin=2., points_per_decade=100, verbose=False):
+        '''
+        Replaces zGridGlobals (by default 1e-15<z<1e05) with a grid that only covers 
+        the redshifts corresponding to luminosity distances between dL_min and dL_max 
+        (in units of dist_unit) for any value of the cosmological parameters in the prior range.
+        
+        priorLimits: dict {param: (min, max)}. Parameters not in priorLimits are fixed to baseValues.
+        margin: the range in dL is extended to (dL_min/margin, dL_max*margin)
+        points_per_decade: density of the new grid (the default grid has ~110 points per decade)
+        
+        Since dL is monotonic in each parameter, the extremes are attained at 
+        the corners of the prior range. Above the new grid, z_from_dLGW_fast and the numpy kernels give nan. 
+        The cached interpolators are discarded.
+        '''
+        lims = { p: priorLimits.get(p, (self.baseValues[p], self.baseValues[p])) for p in self.params }
+        xmax = dL_max*margin*max(lims['H0'])/(self.clight*self.Mpc_to_dist_unit)
+        if dL_min is not None:
+            xmin = dL_min/margin*min(lims['H0'])/(self.clight*self.Mpc_to_dist_unit)
+        
+        zmin, zmax = self.zGridGlobals[-1], self.zGridGlobals[0]
+        for Om in lims['Om']:
+            for w0 in lims['w0']:
+                uuGrid = self.uu(self.zGridGlobals, Om, w0)
+                for Xi0 in lims['Xi0']:
+                    for n in lims['n']:
+                        xGrid = (1+self.zGridGlobals)*uuGrid*self.Xi(self.zGridGlobals, Xi0, n)
+                        zmax = max(zmax, np.interp(xmax, xGrid, self.zGridGlobals))
+                        if dL_min is not None:
+                            zmin = min(zmin, np.interp(xmin, xGrid, self.zGridGlobals))
+        if dL_min is None:
+            zmin=1e-08
+        
+        nPoints = max(int(points_per_decade*np.log10(zmax/zmin)), 100)
+        if verbose:
+            print('Setting redshift grid: %s points between z=%s and z=%s' %(nPoints, zmin, zmax))
+        
+        self.zGridGlobals = np.logspace(start=np.log10(zmin), stop=np.log10(zmax), base=10, num=nPoints)
+        self.dLGridGlobals = self.cosmoGlobals.luminosity_distance(self.zGridGlobals).to(self.dist_unit).value
+        self._z_from_dL_cache.clear()
+        self._uu_cache.clear()
+    
+    
     def z_from_dLGW(self, dL_GW_val, H0, Om, w0, Xi0, n):
         '''Returns redshift for a given luminosity distance dL_GW_val (in Mpc by default)                                         '''
         func = lambda z : self.dLGW(z, H0, Om, w0, Xi0, n) - dL_GW_val
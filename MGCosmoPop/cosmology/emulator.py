@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+import h5py
+import os
+import sys
+import time
+
+PACKAGE_PARENT = '..'
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import utils
+
+
+
+def E_flat_wCDM(z, Om, w0):
+    '''
+    E(z) = H(z)/H0 for a flat wCDM cosmology without radiation
+    (same model as astropy's FlatwCDM/FlatLambdaCDM with Tcmb0=0)
+    '''
+    zp1 = 1+z
+    return np.sqrt( Om*zp1**3+(1-Om)*zp1**(3*(1+w0)) )
+
+
+
+class ComovingDistanceEmulator(object):
+
+    '''
+    Emulator for the dimensionless comoving distance
+
+        uu(z; Om, w0) = H0/c * d_C(z) = int_0^z dz'/E(z')
+
+    in a flat wCDM cosmology.
+
+    The function is tabulated once on a grid in (log(Om), w0, x=log(1+z))
+    and interpolated with a tensor-product cubic spline.
+    What is actually tabulated is log(uu/x), which is smooth and equal to zero at z=0,
+    so that the relative accuracy is preserved down to z->0 and for small Om,
+    where uu ~ 1/sqrt(Om) at high redshift.
+    The table is computed with an 8-point Gauss-Legendre rule in each interval
+    of the x grid, so the only source of error is the interpolation.
+
+    With the default settings (Om in (0.01, 1), w0 in (-3, -0.3), z<1e05, grid of
+    60x100x400 points) the maximum relative error with respect to astropy
+    over the whole box is ~2e-06. The error is evaluated when the
+    table is built, on random points off the grid, and stored in the attribute max_rel_err.
+
+    Usage:
+
+        emu = ComovingDistanceEmulator()
+        emu.uu(z, Om, w0)
+
+    By default the table is kept in memory only. If fname is given, the table is loaded
+    from fname if it exists with the same settings, otherwise it is computed and saved there
+    (e.g. fname=os.path.join(Globals.cosmoPath, 'uu_emulator.h5'); the data/ directory is not tracked by git).
+
+    Values of (Om, w0) outside the tabulated range give nan. Use covers() to check.
+
+    '''
+
+    def __init__(self, fname=None,
+                 Om_range=(0.01, 1.), w0_range=(-3., -0.3), zmax=1e05,
+                 nOm=60, nw0=100, nz=400,
+                 force_recompute=False, verbose=False):
+
+        self.Om_range=Om_range
+        self.w0_range=w0_range
+        self.zmax=zmax
+        self.grid_shape=(int(nOm), int(nw0), int(nz))
+        self.verbose=verbose
+
+        self.path=fname
+
+        Omgrid, w0grid, xgrid, table = self._load_or_compute(force_recompute)
+
+        self.spline = utils.TensorSpline([np.log(Omgrid), w0grid, xgrid], table, k=3)
+
+
+    def covers(self, Om, w0):
+        return (self.Om_range[0] <= Om <= self.Om_range[1]) & (self.w0_range[0] <= w0 <= self.w0_range[1])
+
+
+    def uu(self, z, Om, w0):
+        '''
+        Dimensionless comoving distance. Does not depend on H0
+        '''
+        x = np.log1p(z)
+        return np.exp(self.spline(np.log(Om), w0, x))*x
+
+
+    ######################
+    # BUILDING THE TABLE
+    ######################
+
+    def _get_grids(self):
+        nOm, nw0, nz = self.grid_shape
+        Omgrid = np.geomspace(self.Om_range[0], self.Om_range[1], nOm)
+        w0grid = np.linspace(self.w0_range[0], self.w0_range[1], nw0)
+        xgrid = np.linspace(0, np.log1p(self.zmax), nz)
+        return Omgrid, w0grid, xgrid
+
+
+    def _load_or_compute(self, force_recompute):
+
+        if self.path is not None and os.path.exists(self.path) and not force_recompute:
+            with h5py.File(self.path, 'r') as inp:
+                same = ( tuple(inp.attrs['Om_range'])==tuple(self.Om_range) ) & ( tuple(inp.attrs['w0_range'])==tuple(self.w0_range) ) & ( inp.attrs['zmax']==self.zmax ) & ( tuple(inp.attrs['grid_shape'])==self.grid_shape )
+                if same:
+                    if self.verbose:
+                        print('Pre-computed comoving distance table is present. Loading from %s...' %self.path)
+                    Omgrid, w0grid, xgrid = np.array(inp['Om']), np.array(inp['w0']), np.array(inp['x'])
+                    table = np.array(inp['log_uu_over_x'])
+                    self.max_rel_err = inp.attrs['max_rel_err']
+                    return Omgrid, w0grid, xgrid, table
+            if self.verbose:
+                print('Pre-computed comoving distance table in %s has different settings. Re-computing...' %self.path)
+
+        Omgrid, w0grid, xgrid, table = self._compute_table()
+        self.spline = utils.TensorSpline([np.log(Omgrid), w0grid, xgrid], table, k=3)
+        self.max_rel_err = self._check_accuracy()
+        if self.verbose:
+            print('Max relative error of the comoving distance emulator wrt astropy: %s' %self.max_rel_err)
+
+        if self.path is None:
+            return Omgrid, w0grid, xgrid, table
+
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except FileExistsError:
+            pass
+        if self.verbose:
+            print('Saving comoving distance table to %s...' %self.path)
+        with h5py.File(self.path, 'w') as out:
+            out.create_dataset('Om', data=Omgrid)
+            out.create_dataset('w0', data=w0grid)
+            out.create_dataset('x', data=xgrid)
+            out.create_dataset('log_uu_over_x', data=table, compression='gzip', shuffle=True)
+            out.attrs['Om_range'] = self.Om_range
+            out.attrs['w0_range'] = self.w0_range
+            out.attrs['zmax'] = self.zmax
+            out.attrs['grid_shape'] = self.grid_shape
+            out.attrs['max_rel_err'] = self.max_rel_err
+
+        return Omgrid, w0grid, xgrid, table
+
+
+    def _compute_table(self, nGL=8):
+
+        Omgrid, w0grid, xgrid = self._get_grids()
+        if self.verbose:
+            print('Tabulating comoving distance on a %sx%sx%s grid in (Om, w0, log(1+z))...' %self.grid_shape)
+        in_time=time.time()
+
+        # Gauss-Legendre nodes in each interval of the x grid
+        xi, wi = np.polynomial.legendre.leggauss(nGL)
+        h = np.diff(xgrid)
+        nodes = (xgrid[:-1, None]+h[:, None]*(xi[None, :]+1)/2)
+        weights = h[:, None]*wi[None, :]/2
+        zp1 = np.exp(nodes)
+
+        table = np.empty(self.grid_shape)
+        for i, Om in enumerate(Omgrid):
+            # shape (nw0, nz-1, nGL)
+            integrand = zp1/E_flat_wCDM(zp1-1, Om, w0grid[:, None, None])
+            uu = np.concatenate( [ np.zeros((len(w0grid), 1)), np.cumsum( (integrand*weights).sum(axis=-1), axis=-1) ], axis=-1)
+            table[i, :, 1:] = np.log(uu[:, 1:]/xgrid[1:])
+            table[i, :, 0] = 0.
+
+        if self.verbose:
+            print('Done in %.2fs ' %(time.time() - in_time))
+        return Omgrid, w0grid, xgrid, table
+
+
+    def _check_accuracy(self, nCheck=100, seed=1312):
+        from astropy.cosmology import FlatwCDM
+
+        rng = np.random.default_rng(seed)
+        z = np.geomspace(1e-06, self.zmax, 300)
+        max_err = 0.
+        for _ in range(nCheck):
+            Om = rng.uniform(*self.Om_range)
+            w0 = rng.uniform(*self.w0_range)
+            exact = FlatwCDM(H0=100, Om0=Om, w0=w0).comoving_distance(z).value*100/2.99792458e05
+            max_err = max(max_err, np.max(np.abs(self.uu(z, Om, w0)/exact-1)) )
+        return max_err
@@ -28,11 +28,48 @@ class Data(ABC):
     
     def downsample(self, nSamples=None, percSamples=None, verbose=True):
         if nSamples is None:
-            return self._downsample_perc(percSamples, verbose=verbose)
+            self._downsample_perc(percSamples, verbose=verbose)
         elif percSamples is None:
-            return self._downsample_n(nSamples, verbose=verbose)
+            self._downsample_n(nSamples, verbose=verbose)
         else:
             raise ValueError('One among nSamples and percSamples should not be None')
+        self._set_flat_samples()
+    
+    
+    def _apply_condition(self, condition):
+        '''
+        Used for injections. Keeps only the injections that satisfy condition (e.g. the detected ones), 
+        in contiguous arrays. The total number of generated injections (N_gen) is not modified
+        '''
+        self.m1z = np.ascontiguousarray(self.m1z[condition])
+        self.m2z = np.ascontiguousarray(self.m2z[condition])
+        self.dL = np.ascontiguousarray(self.dL[condition])
+        self.spins = [np.ascontiguousarray(s[condition]) for s in self.spins]
+        self.log_weights_sel = np.ascontiguousarray(self.log_weights_sel[condition])
+        print('Number of injections passing the detection condition: %s' %self.dL.shape[0])
+    
+    
+    def _set_flat_samples(self):
+        '''
+        Stores the samples of all events in flat arrays, without the nan padding 
+        used to bring all events to the same number of samples.
+        The samples of the i-th event are in [sample_offsets[i], sample_offsets[i+1]) 
+        (as in a CSR sparse matrix). 
+        Has to be called again if the samples are modified.
+        
+        Also stores logOrPrior_flat, the log of the original prior of the samples 
+        (mass and distance), which is removed from the posterior samples in the likelihood.
+        The logs of m1z, m2z and dL are not stored: the populations are evaluated on 
+        source-frame masses m/(1+z), which depend on the cosmological parameters, 
+        and log(dL) only enters through logOrPrior_flat.
+        '''
+        where_compute = ~np.isnan(self.m1z)
+        self.m1z_flat = self.m1z[where_compute]
+        self.m2z_flat = self.m2z[where_compute]
+        self.dL_flat = self.dL[where_compute]
+        self.spins_flat = [s[where_compute] for s in getattr(self, 'spins', [])]
+        self.sample_offsets = np.concatenate([[0], np.cumsum(where_compute.sum(axis=-1))])
+        self.logOrPrior_flat = self.logOrMassPrior(flat=True)+self.logOrDistPrior(flat=True)
 
     def _downsample_perc(self, percSamples, verbose=True):
         try:
@@ -150,6 +187,100 @@ class Data(ABC):
     
     
     
+
+
+class ConcatenatedData(Data):
+    '''
+    Joins the flat sample stores (see Data._set_flat_samples) of several catalogs, 
+    so that the population can be evaluated on the events of all catalogs at once.
+    
+    Tobs is an array with the observing time of the catalog of each sample.
+    The events of the i-th catalog are in [catalog_offsets[i], catalog_offsets[i+1]), 
+    and catalog contains the index of the catalog of each event.
+    '''
+    
+    def __init__(self, allData):
+        
+        Data.__init__(self)
+        nSpins = [len(data_.spins_flat) for data_ in allData]
+        if len(set(nSpins))>1:
+            raise ValueError('All catalogs should have the same number of spin parameters to be concatenated. Got %s' %str(nSpins))
+        self.allData = allData
+        self._load_data()
+    
+    
+    def _load_data(self):
+        allData = self.allData
+        self.m1z_flat = np.concatenate([data_.m1z_flat for data_ in allData])
+        self.m2z_flat = np.concatenate([data_.m2z_flat for data_ in allData])
+        self.dL_flat = np.concatenate([data_.dL_flat for data_ in allData])
+        self.spins_flat = [ np.concatenate([data_.spins_flat[j] for data_ in allData]) for j in range(len(allData[0].spins_flat)) ]
+        
+        self.logNsamples = np.concatenate([data_.logNsamples for data_ in allData])
+        self.sample_offsets = np.concatenate([[0], np.cumsum(np.concatenate([np.diff(data_.sample_offsets) for data_ in allData]))])
+        
+        nEvents = [ len(data_.logNsamples) for data_ in allData]
+        self.catalog = np.repeat(np.arange(len(allData)), nEvents)
+        self.catalog_offsets = np.concatenate([[0], np.cumsum(nEvents)])
+        self.Tobs = np.concatenate([ np.full(len(data_.m1z_flat), data_.Tobs) for data_ in allData])
+        self.Nobs = sum(nEvents)
+        
+        self._logOrMassPrior = np.concatenate([data_.logOrMassPrior(flat=True) for data_ in allData])
+        self._logOrDistPrior = np.concatenate([data_.logOrDistPrior(flat=True) for data_ in allData])
+        self.logOrPrior_flat = np.concatenate([data_.logOrPrior_flat for data_ in allData])
+    
+    
+    def get_theta(self):
+        return np.array( [self.m1z_flat, self.m2z_flat, self.dL_flat ] )
+    
+    def logOrMassPrior(self, flat=True):
+        return self._logOrMassPrior
+    
+    def logOrDistPrior(self, flat=True):
+        return self._logOrDistPrior
+    
+    
+    
+class MixtureInjectionsData(Data):
+    '''
+    Joins the detected injections of several observing runs, 
+    so that the population can be evaluated on the injections of all runs at once.
+    
+    Tobs is an array with the observing time of the run of each injection, 
+    logN_gen is an array with the log of the number of generated injections of each run.
+    The injections of the i-th run are in [run_offsets[i], run_offsets[i+1]), 
+    and run contains the index of the run of each injection.
+    '''
+    
+    def __init__(self, allInjData):
+        
+        Data.__init__(self)
+        nSpins = [len(injData_.spins) for injData_ in allInjData]
+        if len(set(nSpins))>1:
+            raise ValueError('All injection sets should have the same number of spin parameters to be concatenated. Got %s' %str(nSpins))
+        self.allInjData = allInjData
+        self._load_data()
+    
+    
+    def _load_data(self):
+        allInjData = self.allInjData
+        self.m1z = np.concatenate([injData_.m1z for injData_ in allInjData])
+        self.m2z = np.concatenate([injData_.m2z for injData_ in allInjData])
+        self.dL = np.concatenate([injData_.dL for injData_ in allInjData])
+        self.spins = [ np.concatenate([injData_.spins[j] for injData_ in allInjData]) for j in range(len(allInjData[0].spins)) ]
+        self.log_weights_sel = np.concatenate([injData_.log_weights_sel for injData_ in allInjData])
+        
+        nInj = [ len(injData_.m1z) for injData_ in allInjData]
+        self.run = np.repeat(np.arange(len(allInjData)), nInj)
+        self.run_offsets = np.concatenate([[0], np.cumsum(nInj)])
+        self.Tobs = np.concatenate([ np.full(len(injData_.m1z), injData_.Tobs) for injData_ in allInjData])
+        self.logN_gen = np.array([ injData_.logN_gen for injData_ in allInjData])
+    
+    
+    def get_theta(self):
+        return np.array( [self.m1z, self.m2z, self.dL ] )
+    
+    
     
 class LVCData(Data):
     
@@ -194,6 +325,7 @@ class LVCData(Data):
         print('Obs time (yrs): %s' %self.Tobs )
         
         self.Nobs=self.m1z.shape[0]
+        self._set_flat_samples()
     
     @abstractmethod
     def _name_conditions(self, f ):
@@ -332,11 +464,15 @@ class LVCData(Data):
         return m1det_samples, m2det_samples, dl_samples, spins_samples, allNsamples
     
     
-    def logOrMassPrior(self):
+    def logOrMassPrior(self, flat=False):
+        if flat:
+            return np.zeros(self.m1z_flat.shape)
         return np.zeros(self.m1z.shape)
 
-    def logOrDistPrior(self):
+    def logOrDistPrior(self, flat=False):
         # dl^2 prior on dL
+        if flat:
+            return 2*np.log(self.dL_flat)
         return np.where( ~np.isnan(self.dL), 2*np.log(self.dL), 0)
     
   
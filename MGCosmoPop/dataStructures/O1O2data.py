@@ -135,7 +135,8 @@ class O1O2InjectionsData(Data):
         
         self.ifar_th=ifar_th
         #gstlal_ifar, pycbc_ifar, pycbc_bbh_ifar = conditions_arr
-        self.condition = np.full(self.m1z.shape, True) #(gstlal_ifar > ifar_th) | (pycbc_ifar > ifar_th) | (pycbc_bbh_ifar > ifar_th)
+        # all injections in the file are detected
+        #self._apply_condition( (gstlal_ifar > ifar_th) | (pycbc_ifar > ifar_th) | (pycbc_bbh_ifar > ifar_th) )
         
         
     def get_theta(self):
@@ -152,7 +152,7 @@ class O3InjectionsData(Data):
         
         self.ifar_th=ifar_th
         gstlal_ifar, pycbc_ifar, pycbc_bbh_ifar = conditions_arr
-        self.condition = (gstlal_ifar > ifar_th) | (pycbc_ifar > ifar_th) | (pycbc_bbh_ifar > ifar_th)
+        self._apply_condition( (gstlal_ifar > ifar_th) | (pycbc_ifar > ifar_th) | (pycbc_bbh_ifar > ifar_th) )
         
         
     def get_theta(self):
@@ -21,6 +21,7 @@ class GWMockData(Data):
         self.m1z, self.m2z, self.dL, self.snr, self.Nsamples = self._load_data(fname, nObsUse, ) #nSamplesUse, )  
         self.Nobs=self.m1z.shape[0]
         self.logNsamples = np.log(self.Nsamples)
+        self.spins = []
 
         if nSamplesUse is not None or percSamplesUse is not None:
             self.downsample(nSamples=nSamplesUse, percSamples=percSamplesUse)
@@ -36,10 +37,10 @@ class GWMockData(Data):
         
         self.Tobs=Tobs
         #self.chiEff = np.zeros(self.m1z.shape)
-        self.spins = []
         print('Obs time: %s' %self.Tobs )
         
         self.Nobs=self.m1z.shape[0]
+        self._set_flat_samples()
         
     
             
@@ -84,10 +85,14 @@ class GWMockData(Data):
         #return m1z, m2z, dL, np.count_nonzero(m1z, axis=-1)
         return m1det_samples, m2det_samples, dl_samples, snrs, np.count_nonzero(m1det_samples, axis=-1) 
     
-    def logOrMassPrior(self):
+    def logOrMassPrior(self, flat=False):
+        if flat:
+            return np.zeros(self.m1z_flat.shape)
         return np.zeros(self.m1z.shape)
 
-    def logOrDistPrior(self):
+    def logOrDistPrior(self, flat=False):
+        if flat:
+            return np.zeros(self.dL_flat.shape)
         return np.zeros(self.dL.shape)
     
 
@@ -105,7 +110,6 @@ class GWMockInjectionsData(Data):
         assert (self.m2z > 0).all()
         assert (self.dL > 0).all()
         assert(self.m2z<=self.m1z).all()
-        self.condition=True
         
         self.Tobs=Tobs
         self.spins = []# np.zeros(self.m1z.shape)
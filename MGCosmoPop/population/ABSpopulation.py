@@ -7,6 +7,15 @@
 
 from abc import ABC, abstractmethod
 import numpy as np
+
+import sys
+import os
+
+PACKAGE_PARENT = '..'
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import utils
 #import scipy.stats as ss
 #from scipy.integrate import cumtrapz
 #from scipy.interpolate import interp1d
@@ -72,13 +81,59 @@ class BBHDistFunction(ABC):
     
     ''''
     Abstract base class for mass and spin distributions
+    
+    Normalizations that require numerical integrals can be computed with _log_integral, 
+    and stored in norm_cache, 
+    keyed on the name of the quantity and on the values of the parameters it depends on 
+    (see _cached_norm). norm_cache_size is the max number of values kept in memory. 
+    The cache is shared by all the datasets that use the same population, 
+    so each normalization is computed only once per value of the parameters.
+    
+    Similarly, the tables used to draw samples (see _sample_pdf) are kept in sampler_cache, 
+    with max size sampler_cache_size.
     '''
     
-    def __init__(self):
+    def __init__(self, norm_cache_size=64, sampler_cache_size=8):
         self.params = []
         self.baseValues = {}
         self.n_params = 0
         self.names={}
+        self.norm_cache = utils.LRUCache(maxsize=norm_cache_size)
+        self.sampler_cache = utils.LRUCache(maxsize=sampler_cache_size)
+    
+    
+    def _cached_norm(self, name, params, compute):
+        '''
+        Returns the normalization called name for the values params of the parameters 
+        (including any setting of the numerical integration), 
+        calling compute() only if it is not in the cache
+        '''
+        return self.norm_cache.get( (name,)+tuple(float(p) for p in params), compute)
+    
+    
+    def _log_integral(self, logf, a, b, breakpoints=(), rtol=1e-08, **kwargs):
+        '''
+        log of the integral of exp(logf) between a and b, with adaptive Gauss-Kronrod quadrature 
+        vectorized over the nodes and over arrays of integration limits (see utils.log_quad).
+        breakpoints are the points where logf is not smooth
+        '''
+        return utils.log_quad(logf, a, b, breakpoints=breakpoints, rtol=rtol, **kwargs)
+    
+    
+    def _log_normalization(self, name, params, logf, a, b, breakpoints=(), rtol=1e-08):
+        '''
+        Same as _log_integral, with the result stored in norm_cache. 
+        params are the values of the parameters the integrand depends on
+        '''
+        return self._cached_norm(name, tuple(params)+(rtol,), lambda: self._log_integral(logf, a, b, breakpoints=breakpoints, rtol=rtol))
+    
+    
+    def clear_norm_cache(self):
+        '''
+        Discards the cached normalizations. 
+        Must be called if the way they are computed is changed
+        '''
+        self.norm_cache.clear()
     
     #@abstractmethod
     #def _get_normalization(lambdaBBHmass):
@@ -92,30 +147,36 @@ class BBHDistFunction(ABC):
         pass
     
     
-    def _sample_pdf(self, nSamples, pdf, lower, upper):
-        res = 100000
+    def _get_sampler(self, pdf, lower, upper, key=None, res=100000):
+        '''
+        Inverse-cdf table of pdf between lower and upper (see utils.InverseCDFSampler). 
+        If key is not None, the table is kept in sampler_cache. key should contain 
+        a name for the distribution and the values of the parameters pdf depends on
+        '''
+        if key is None:
+            return utils.InverseCDFSampler(pdf, lower, upper, res=res)
+        return self.sampler_cache.get( tuple(key)+(lower, upper, res), lambda: utils.InverseCDFSampler(pdf, lower, upper, res=res))
+    
+    
+    def _sample_pdf(self, nSamples, pdf, lower, upper, key=None):
+        '''
+        nSamples samples from pdf between lower and upper. 
+        If key is given, the table used for sampling is built only at the first call (see _get_sampler)
+        '''
         eps=1e-02
-        x = np.linspace(lower+eps, upper-eps, res)
-        cdf = np.cumsum(pdf(x))
-        cdf /= cdf[-1]
-        return np.interp(np.random.uniform(size=nSamples), cdf, x)
-        #ps = pdf(x)
-        #cms = cumtrapz(ps, x, initial=0)
-        #icdfm1 = interp1d(cms, x)
-        #def draw_m1():
-        #    return icdfm1(cms[-1]*np.random.rand())
-        #return np.array([draw_m1() for i in range(nSamples)])
+        return self._get_sampler(pdf, lower+eps, upper-eps, key=key).sample(nSamples)
         
     
-    def _sample_vector_upper(self, pdf, lower, upper):
-        nSamples = len(upper)
-        res = 100000
+    def _sample_vector_upper(self, pdf, lower, upper, key=None, upper_max=None):
+        '''
+        One sample from pdf between lower and each value in upper (e.g. m2 given m1). 
+        The table extends to upper_max, or to the max of upper if not given; 
+        upper_max should be given with key, so that the table can be used for different values of upper
+        '''
         eps=1e-02
-        x = np.linspace(lower+eps, upper.max()-eps, res)
-        cdf = np.cumsum(pdf(x))
-        cdf = cdf / cdf[-1]
-        probTilUpper = np.interp(upper, x, cdf)
-        return np.interp(probTilUpper*np.random.uniform(size=nSamples), cdf, x)
+        if upper_max is None:
+            upper_max = upper.max()
+        return self._get_sampler(pdf, lower+eps, upper_max-eps, key=key).sample_upper(upper)
     
 
     def _set_values(self, values_dict):
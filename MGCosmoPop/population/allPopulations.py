@@ -9,17 +9,30 @@ import numpy as np
 #import cosmo
 from copy import deepcopy
 
+import sys
+import os
+
+PACKAGE_PARENT = '..'
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import utils
+
 # Logic for dN/dtheta with multiple populations (e.g. astro-ph BHs, primordial BHs, ... )
 
 
 class AllPopulations(object):
     
     
-    def __init__(self, cosmo):
-        
+    def __init__(self, cosmo, sampler_cache_size=8):
+        '''
+        sampler_cache_size is the max number of tables for sampling the redshift kept in memory 
+        (see _sample_pdf)
+        '''
         self.cosmo = cosmo
         self._initialize(cosmo)
         self.nPops=0
+        self._sampler_cache = utils.LRUCache(maxsize=sampler_cache_size)
     
     
     def add_pop(self, population):
@@ -50,22 +63,40 @@ class AllPopulations(object):
     #########################################################################
     # Differential Rate
     
-    def log_dN_dm1dm2dz(self, m1, m2, z, spins, Tobs, Lambda):
-        
-        LambdaCosmo, LambdaAllPop = self._split_params(Lambda)
+    def log_dN_dm1dm2dz(self, m1, m2, z, spins, Tobs, Lambda, log_dV_dz=None):
+        '''
+        log_dV_dz can be passed if already computed. 
+        It can also include other terms that do not depend on the population (see log_dN_dm1zdm2zddL)
         
+        Samples where m1 is nan are assigned -inf
+        '''
         where_compute=~np.isnan(m1)
         res = np.empty_like(m1)
         res[~where_compute]=np.NINF
         
-        m1, m2, z = m1[where_compute], m2[where_compute], z[where_compute]
+        if log_dV_dz is not None:
+            log_dV_dz = log_dV_dz[where_compute]
+        res[where_compute] = self._log_dN_dm1dm2dz(m1[where_compute], m2[where_compute], z[where_compute], [s[where_compute] for s in spins], Tobs, Lambda, log_dV_dz=log_dV_dz)
+        
+        return res
+        #return np.where( ~np.isnan(m1), logN, np.NINF)
+    
+    
+    def _log_dN_dm1dm2dz(self, m1, m2, z, spins, Tobs, Lambda, log_dV_dz=None):
+        '''
+        Same as log_dN_dm1dm2dz, for samples that do not contain nans. Does not use masks
+        '''
+        LambdaCosmo, LambdaAllPop = self._split_params(Lambda)
         
         logN = -np.log1p(z) # differential of time between source and detector frame
         
         logN += np.log(Tobs) # obs. time
         
-        H0, Om0, w0 = self.cosmo._get_values(LambdaCosmo, ['H0', 'Om', 'w0'])
-        logN += self.cosmo.log_dV_dz(z, H0, Om0, w0)
+        if log_dV_dz is None:
+            H0, Om0, w0 = self.cosmo._get_values(LambdaCosmo, ['H0', 'Om', 'w0'])
+            logN += self.cosmo.log_dV_dz(z, H0, Om0, w0)
+        else:
+            logN += log_dV_dz
         
         prev=0
         for i,pop in enumerate(self._pops):
@@ -73,29 +104,48 @@ class AllPopulations(object):
             logN += pop.log_dR_dm1dm2(m1, m2, z, spins, LambdaPop)
             prev=self._allNParams[i]
         
-        res[where_compute]=logN
-        
-        return res
-        #return np.where( ~np.isnan(m1), logN, np.NINF)
+        return logN
     
     
-    def log_dN_dm1zdm2zddL(self, m1, m2, z, spins, Tobs, Lambda, dL=None):
-        LambdaCosmo, LambdaAllPop = self._split_params(Lambda)
-        H0, Om0, w0, Xi0, n = self.cosmo._get_values(LambdaCosmo, ['H0', 'Om', 'w0', 'Xi0', 'n'])
+    def log_dN_dm1zdm2zddL(self, m1, m2, z, spins, Tobs, Lambda, dL=None, log_cosmo=None):
+        '''
+        log_cosmo is the output of log_cosmo_terms. Can be passed if already computed 
+        (e.g. if the cosmology is fixed)
+        
+        Samples where m1 is nan are assigned -inf
+        '''
         where_compute=~np.isnan(m1)
         res = np.empty_like(m1)
         res[~where_compute]=np.NINF
         
-        m1, m2, z, spins = m1[where_compute], m2[where_compute], z[where_compute], [s[where_compute] for s in spins]
         if dL is not None:
             dL=dL[where_compute]
-        logdN = self.log_dN_dm1dm2dz(m1, m2, z, spins, Tobs, Lambda)-self._log_dMsourcedMdet(z) - self.cosmo.log_ddL_dz(z, H0, Om0, w0, Xi0, n , dL=dL)
-        
-        res[where_compute] = logdN
+        if log_cosmo is not None:
+            log_cosmo = log_cosmo[where_compute]
+        res[where_compute] = self._log_dN_dm1zdm2zddL(m1[where_compute], m2[where_compute], z[where_compute], [s[where_compute] for s in spins], Tobs, Lambda, dL=dL, log_cosmo=log_cosmo)
         return res
         #return np.where( ~np.isnan(m1), self.log_dN_dm1dm2dz(m1, m2, z, spins, Tobs, Lambda)-self._log_dMsourcedMdet(z) - self.cosmo.log_ddL_dz(z, H0, Om0, w0, Xi0, n ) , np.NINF)
     
     
+    def _log_dN_dm1zdm2zddL(self, m1, m2, z, spins, Tobs, Lambda, dL=None, log_cosmo=None):
+        '''
+        Same as log_dN_dm1zdm2zddL, for samples that do not contain nans. Does not use masks
+        '''
+        if log_cosmo is None:
+            LambdaCosmo, LambdaAllPop = self._split_params(Lambda)
+            log_cosmo = self.log_cosmo_terms(z, LambdaCosmo, dL=dL)
+        return self._log_dN_dm1dm2dz(m1, m2, z, spins, Tobs, Lambda, log_dV_dz=log_cosmo)
+    
+    
+    def log_cosmo_terms(self, z, LambdaCosmo, dL=None):
+        '''
+        Terms of log_dN_dm1zdm2zddL that depend only on the cosmology:
+        log dV/dz - log d(m1z m2z)/d(m1 m2) - log ddL/dz
+        '''
+        H0, Om0, w0, Xi0, n = self.cosmo._get_values(LambdaCosmo, ['H0', 'Om', 'w0', 'Xi0', 'n'])
+        log_dV_dz, log_ddL_dz = self.cosmo.log_jacobians(z, H0, Om0, w0, Xi0, n , dL=dL)
+        return log_dV_dz-self._log_dMsourcedMdet(z)-log_ddL_dz
+    
     
     def logdN_dz(self, z, H0, Om0, w0, lambdaBBHrate, pop):
         #LambdaCosmo, LambdaAllPop = self._split_params(Lambda)
@@ -209,17 +259,22 @@ class AllPopulations(object):
             
             zpdf = lambda z: np.exp(self.logdN_dz(z,  H0, Om0, w0, lambdaBBHrate, pop ))#lambda z: np.exp(pop.rateEvol.log_dNdVdt(z, lambdaBBHrate)+ self.cosmo.log_dV_dz(z, H0, Om0, w0)-np.log1p(z))
             
-            allsamples[:, i] = self._sample_pdf(nSamples, zpdf, 1e-05, zmax)
+            allsamples[:, i] = self._sample_pdf(nSamples, zpdf, 1e-05, zmax, key=(i, H0, Om0, w0)+tuple(lambdaBBHrate))
             #prev=self._allNParams[i]
         return allsamples
         
     
-    def _sample_pdf(self, nSamples, pdf, lower, upper):
+    def _sample_pdf(self, nSamples, pdf, lower, upper, key=None):
+        '''
+        nSamples samples from pdf between lower and upper, with an inverse-cdf table (see utils.InverseCDFSampler). 
+        If key is given, the table is kept in a cache and built only at the first call. 
+        key should identify the population and the values of the parameters pdf depends on
+        '''
         res = 100000
-        x = np.linspace(lower, upper, res)
-        cdf = np.cumsum(pdf(x))
-        cdf = cdf / cdf[-1]
-        return np.interp(np.random.uniform(size=nSamples), cdf, x)
+        if key is None:
+            return utils.InverseCDFSampler(pdf, lower, upper, res=res).sample(nSamples)
+        sampler = self._sampler_cache.get( tuple(key)+(lower, upper, res), lambda: utils.InverseCDFSampler(pdf, lower, upper, res=res))
+        return sampler.sample(nSamples)
     
     
     
@@ -6,8 +6,7 @@
 
 from ..ABSpopulation import BBHDistFunction
 import numpy as np
-import scipy.stats as ss
-from scipy.integrate import cumtrapz
+from scipy.interpolate import CubicHermiteSpline
 
 import sys
 import os
@@ -17,6 +16,8 @@ SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.
 sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
 
 import utils
+import specialFunctions as sf
+from .smoothingTable import SmoothingIntegralTable
 
 
 
@@ -92,7 +93,7 @@ class AstroSmoothPowerLawMass(BBHDistFunction):
         logpdfMass = self._logpdfm1only(m1,alpha, ml, sl, mh, sh ) + self._logpdfm2(m2, beta, ml, sl, mh, sh )
         
         if self.normalization=='integral':
-            logNorm = -np.log(self._get_normalization(lambdaBBHmass))
+            logNorm = -self._get_log_normalization(lambdaBBHmass)
         elif self.normalization=='pivot':
             logNorm = alpha*np.log(30)-beta*np.log(30)-2*self._logf_smooth(30, ml=ml, sl=sl, mh=mh, sh=sh)-2*np.log(30)
         
@@ -101,17 +102,27 @@ class AstroSmoothPowerLawMass(BBHDistFunction):
        
     def _logf_smooth(self, m, ml=5, sl=0.1, mh=45, sh=0.1):
                 
-        return np.log(ss.norm().cdf((np.log(m)-np.log(ml))/sl))+np.log((1-ss.norm().cdf((np.log(m)-np.log(mh))/sh)))
+        return sf.log_smooth_window(m, ml, sl, mh, sh)
        
     
     def _get_normalization(self, lambdaBBHmass):
-        '''Normalization of p(m1, m2 | Lambda ). Warning: works well only when sl and sh are small '''
+        '''Normalization of p(m1, m2 | Lambda ) '''
+        return np.exp(self._get_log_normalization(lambdaBBHmass))
+    
+    
+    def _get_log_normalization(self, lambdaBBHmass, rtol=1e-08, n_sigma=8):
+        '''
+        log of the integral of p(m1, m2 | Lambda ) over m2<m1, valid for any value of sl and sh. 
+        The integral over m2 is computed for all the nodes in m1 at the same time. 
+        The integration range extends n_sigma*sl below ml and n_sigma*sh above mh in log(m)
+        '''
         alpha, beta, ml, sl, mh, sh = lambdaBBHmass
+        mMin, mMax = ml*np.exp(-n_sigma*sl), mh*np.exp(n_sigma*sh)
         
-        if (beta!=-1) & (alpha!=1) : 
-            return (( mh**(-alpha+beta+2)- ml**(-alpha+beta+2) )/(-alpha+beta+2) - ml**(beta+1) *(mh**(-alpha+1)-ml**(-alpha+1))/(-alpha+1) )/(beta+1)
-        else:
-            raise ValueError 
+        def logf(m1):
+            return self._logpdfm1only(m1, alpha, ml, sl, mh, sh )+self._log_integral(lambda m2: self._logpdfm2(m2, beta, ml, sl, mh, sh ), mMin, m1, rtol=rtol)
+        
+        return self._log_normalization('logNorm', (alpha, beta, ml, sl, mh, sh, n_sigma), logf, mMin, mMax, breakpoints=(ml, mh), rtol=rtol)
     
     
     def sample(self, nSamples, lambdaBBHmass):
@@ -122,8 +133,8 @@ class AstroSmoothPowerLawMass(BBHDistFunction):
         pm1 = lambda x: np.exp(self._logpdfm1(x, alpha, ml, sl, mh, sh ))
         pm2 = lambda x: np.exp(self._logpdfm2(x, beta, ml, sl, mh, sh ))
         
-        m1 = self._sample_pdf(nSamples, pm1, mMin, mMax)
-        m2 = self._sample_vector_upper(pm2, mMin, m1)
+        m1 = self._sample_pdf(nSamples, pm1, mMin, mMax, key=('m1', alpha, ml, sl, mh, sh))
+        m2 = self._sample_vector_upper(pm2, mMin, m1, key=('m2', beta, ml, sl, mh, sh), upper_max=mMax)
         
             
         return m1, m2
@@ -168,14 +179,9 @@ class TruncPowerLawMass(BBHDistFunction):
         '''
         Marginal distribution p(m1)
         '''
-       
-        
-        where_nan = np.isnan(m)
         result = np.empty_like(m)
         
-
-        result[where_nan]=np.NINF
-        
+        # nan values are excluded by the comparisons
         where_compute = (ml < m) & (m < mh )
         result[~where_compute] = np.NINF
         
@@ -189,12 +195,8 @@ class TruncPowerLawMass(BBHDistFunction):
         '''
         Conditional distribution p(m2 | m1)
         '''
-        where_nan = np.isnan(m)
         result = np.empty_like(m)
         
-
-        result[where_nan]=np.NINF
-        
         where_compute = (ml < m)
         result[~where_compute] = np.NINF
         
@@ -234,6 +236,10 @@ class TruncPowerLawMass(BBHDistFunction):
         Gives log integral of  p(m1, m2) dm1 dm2 (i.e. total normalization of mass function )
 
         '''
+        return self._cached_norm('logNorm', (alpha, ml, mh), lambda: self._logNorm_compute(alpha, ml, mh))
+    
+    
+    def _logNorm_compute(self, alpha, ml, mh):
         if (alpha < 1) & (alpha!=0):
             return -np.log1p(-alpha)+utils.logdiffexp( (1-alpha)*np.log(mh), (1-alpha)*np.log(ml) ) #(1 - alpha) / (mh ** (1 - alpha) - ml ** (1 - alpha))
 
@@ -249,9 +255,9 @@ class TruncPowerLawMass(BBHDistFunction):
         pm1 = lambda x: np.exp(self._logpdfm1(x, alpha, ml, mh ))
         pm2 = lambda x: np.exp(self._logpdfm2(x, beta, ml ))
         
-        m1 = self._sample_pdf(nSamples, pm1, ml, mh)
+        m1 = self._sample_pdf(nSamples, pm1, ml, mh, key=('m1', alpha, ml, mh))
         #m2 = self._sample_pdf(nSamples, pm2, mMin, mMax)
-        m2 = self._sample_vector_upper(pm2, ml, m1)
+        m2 = self._sample_vector_upper(pm2, ml, m1, key=('m2', beta, ml), upper_max=mh)
         assert(m2<=m1).all() 
         assert(m2>=ml).all() 
         assert(m1<=mh).all() 
@@ -270,10 +276,26 @@ class BrokenPowerLawMass(BBHDistFunction):
     Mass distribution  - Truncated Power Law
     '''
 
-    def __init__(self):
+    # Gauss-Legendre nodes and weights on [-1, 1] for the integrals over the smoothing region
+    N_GL = 48
+    _xGL, _wGL = np.polynomial.legendre.leggauss(N_GL)
+
+    def __init__(self, use_table=False, table_args={}):
+        '''
+        If use_table is True, the integrals over the smoothing region needed in _logNorm and _logC 
+        are taken from a table (see population.astro.smoothingTable.SmoothingIntegralTable) 
+        instead of being computed numerically, for the values of the parameters covered by the table.
+        table_args are passed to SmoothingIntegralTable. The table is computed when the class is initialised, 
+        and is only saved to disk (and re-used) if a file name is given with table_args['fname']
+        '''
         
         BBHDistFunction.__init__(self)
         
+        if use_table:
+            self.table = SmoothingIntegralTable(**table_args)
+        else:
+            self.table = None
+        
         self.params = ['alpha1', 'alpha2', 'beta', 'deltam', 'ml',  'mh', 'b' ]
         
         self.baseValues = {
@@ -323,12 +345,10 @@ class BrokenPowerLawMass(BBHDistFunction):
 
         mBreak = self._get_Mbreak( ml, mh, b)
         
-        where_nan = np.isnan(m)
         result = np.empty_like(m)
         
-        result[where_nan]=np.NINF
-        
-        where_compute = (m <= mh) & (m >= ml) & (~where_nan)
+        # nan values are excluded by the comparisons
+        where_compute = (m <= mh) & (m >= ml)
         result[~where_compute] = np.NINF
         
         m = m[where_compute]
@@ -342,12 +362,9 @@ class BrokenPowerLawMass(BBHDistFunction):
         '''
         Conditional distribution p(m2 | m1)
         '''
-        where_nan = np.isnan(m2)
         result = np.empty_like(m2)
-
-        result[where_nan]=np.NINF
         
-        where_compute = (ml<= m2) & (~where_nan)
+        where_compute = (ml<= m2)
         result[~where_compute] = np.NINF
         
         m2 = m2[where_compute]
@@ -363,13 +380,10 @@ class BrokenPowerLawMass(BBHDistFunction):
         m1, m2 = theta
         alpha1, alpha2, beta, deltam, ml, mh, b = lambdaBBHmass
         
-        where_nan = np.isnan(m1)
-        assert (where_nan==np.isnan(m2)).all()
         result = np.empty_like(m1)
-
-        result[where_nan]=np.NINF
         
-        where_compute = (m2 < m1) & (ml< m2) & (m1 < mh ) & (~where_nan)
+        # nan values are excluded by the comparisons
+        where_compute = (m2 < m1) & (ml< m2) & (m1 < mh )
         result[~where_compute] = np.NINF
         
         m1 = m1[where_compute]
@@ -382,67 +396,157 @@ class BrokenPowerLawMass(BBHDistFunction):
         
     
     
-    def _logC(self, m, beta, deltam, ml, res = 200, exact_th=0.):
+    def _logC(self, m, beta, deltam, ml, rtol=1e-06, exact_th=0.):
         '''
         Gives inverse log integral of  p(m1, m2) dm2 (i.e. log C(m1) in the LVC notation )
+        m should not contain nans
+        
+        Above ml+deltam the integral is analytic. In the smoothing region, the cumulative integral 
+        is tabulated once on a grid that is refined until the interpolation error on log C is below rtol 
+        (see _logCgrid), and evaluated for all values of m by interpolation. 
+        The grid is kept in norm_cache. 
+        Values of m below exact_th*ml, and those too close to ml to be on the grid, are integrated exactly.
+        If the table of smoothing integrals is used and covers beta, deltam, ml, 
+        it replaces both the grid and the integral over the whole smoothing region.
         '''
-        xlow=np.linspace(ml, ml+deltam+deltam/10, 200)
-        xup=np.linspace(ml+deltam+deltam/10+1e-01, m[~np.isnan(m)].max(), res)
-        xx=np.sort(np.concatenate([xlow,xup], ))
-  
-        p2 = np.exp(self._logpdfm2( xx , beta, deltam, ml))
-        cdf = cumtrapz(p2, xx)
+        result = np.empty_like(m)
         
-        where_compute = ~np.isnan(m)
-        where_exact = m <exact_th*ml
+        use_table = self._use_table(beta, deltam, ml)
         
-        where_approx = (~where_exact) & (where_compute)
+        where_tail = m >= ml+deltam
+        if use_table:
+            logI_smooth = self.table.logI_norm(beta, deltam, ml)
+        else:
+            logI_smooth = None
+        result[where_tail] = -self._logcdfm2_tail(m[where_tail], beta, deltam, ml, logI_smooth=logI_smooth)
         
+        if use_table:
+            u_min = self.table.t_min*deltam
+        else:
+            uu, logFinterp = self._cached_norm('logCgrid', (beta, deltam, ml, rtol), lambda: self._logCgrid(beta, deltam, ml, rtol=rtol))
+            u_min = uu[0]
+        where_exact = ~where_tail & ( (m < exact_th*ml) | (m < ml+u_min) )
+        where_approx = ~where_tail & ~where_exact
+        
+        result[where_exact] = self._logCexact(m[where_exact], beta, deltam, ml,)
+        if use_table:
+            result[where_approx] = -self.table.logI(m[where_approx], beta, deltam, ml)
+        else:
+            result[where_approx] = -logFinterp(m[where_approx]-ml)
         
+        return result
+    
+    
+    def _use_table(self, gamma, deltam, ml):
+        return (self.table is not None) and self.table.covers(gamma, deltam, ml)
+    
+    
+    def _logCexact(self, m, beta, deltam, ml, ):
+        '''
+        Same as _logC, with the integral computed with Gauss-Legendre quadrature for every value of m.
+        '''
         result = np.empty_like(m)
-        
-        result[~where_compute]=np.NINF
-        result[where_exact]=self._logCexact(m[where_exact], beta, deltam, ml,) #np.NINF
-        
-        result[where_approx] = -np.log( np.interp(m[where_approx], xx[1:], cdf) )
-        
+        where_tail = m >= ml+deltam
+        result[where_tail] = -self._logcdfm2_tail(m[where_tail], beta, deltam, ml)
+        result[~where_tail] = -self._logcdfm2_smooth(ml, m[~where_tail], beta, deltam, ml)
         return result
     
     
-    def _logCexact(self, m, beta, deltam, ml, res=1000):
-        result=[]
-
-        for mup in m:
-
-            xx = np.linspace(ml, mup, res)
-            p2 = np.exp(self._logpdfm2( xx , beta, deltam, ml))
-            result.append(-np.log(np.trapz(p2,xx)) )
-
+    def _logcdfm2_smooth(self, a, x, beta, deltam, ml, n_chunk=100000):
+        '''
+        log integral of p(m2) between a and x, for a and x in the smoothing region [ml, ml+deltam].
+        Gauss-Legendre quadrature with N_GL nodes, vectorized in x and computed in chunks of n_chunk points.
+        '''
+        a, x = np.broadcast_arrays(np.asarray(a, dtype=float), np.asarray(x, dtype=float))
+        result = np.empty(x.shape)
+        for i in range(0, x.size, n_chunk):
+            a_, x_ = a.ravel()[i:i+n_chunk, None], x.ravel()[i:i+n_chunk, None]
+            nodes = a_ + (x_-a_)*(1+self._xGL)/2
+            logp = self._logpdfm2(nodes, beta, deltam, ml)+np.log(self._wGL*(x_-a_)/2)
+            result.ravel()[i:i+n_chunk] = np.logaddexp.reduce(logp, axis=1)
+        return result
     
-        return np.array(result)
-        
-
-
-    def _logNorm(self, alpha1, alpha2, deltam, ml, mh, b , res=200):
+    
+    def _logcdfm2_tail(self, m, beta, deltam, ml, logI_smooth=None):
         '''
-        Gives log integral of  p(m1, m2) dm1 dm2 (i.e. total normalization of mass function )
-
+        log integral of p(m2) between ml and m, for m above ml+deltam, where the smoothing function is one 
+        and the integral of m2**beta is analytic. 
+        logI_smooth is the log integral over the smoothing region; it is computed if not given
         '''
+        a = ml+deltam
+        if logI_smooth is None:
+            logI_smooth = self._logcdfm2_smooth(ml, a, beta, deltam, ml)
+        return np.logaddexp( logI_smooth, sf.log_powerlaw_integral(beta, a, m))
+    
+    
+    def _logCgrid(self, beta, deltam, ml, rtol=1e-06, u_min=0.02, n_init=16, max_iter=30):
+        '''
+        Interpolant of the log integral of p(m2) between ml and m, as a function of m-ml in the smoothing region, 
+        starting at u_min*deltam.
+        The log integral is interpolated with cubic Hermite polynomials, using its exact derivative p(m2)/integral. 
+        The intervals where the interpolation at the midpoint differs from the exact value by more than rtol 
+        are bisected, up to max_iter times.
+        Returns the nodes and the interpolant.
+        '''
+        uu = np.linspace(u_min*deltam, deltam, n_init+1)
+        logF = np.concatenate([ self._logcdfm2_smooth(ml, ml+uu[:1], beta, deltam, ml), 
+                                self._logcdfm2_smooth(ml+uu[:-1], ml+uu[1:], beta, deltam, ml) ])
+        logF = np.logaddexp.accumulate(logF)
+        
+        # intervals to check, given by the index of their left node
+        check = np.arange(n_init)
+        for _ in range(max_iter):
+            dlogF = np.exp(self._logpdfm2(ml+uu, beta, deltam, ml)-logF)
+            left, right = uu[check], uu[check+1]
+            mid = (left+right)/2
+            logFmid = np.logaddexp( logF[check], self._logcdfm2_smooth(ml+left, ml+mid, beta, deltam, ml) )
+            logFinterp = (logF[check]+logF[check+1])/2+(right-left)*(dlogF[check]-dlogF[check+1])/8
+            refine = np.abs(logFinterp-logFmid) > rtol
+            if not refine.any():
+                break
+            idx = check[refine]+1
+            uu = np.insert(uu, idx, mid[refine])
+            logF = np.insert(logF, idx, logFmid[refine])
+            # after the insertion, the refined interval k becomes the intervals k' and k'+1
+            newLeft = idx-1+np.arange(len(idx))
+            check = np.sort(np.concatenate([newLeft, newLeft+1]))
+        
+        dlogF = np.exp(self._logpdfm2(ml+uu, beta, deltam, ml)-logF)
+        return uu, CubicHermiteSpline(uu, logF, dlogF, extrapolate=False)
+        
+        
+    def _logNorm(self, alpha1, alpha2, deltam, ml, mh, b , rtol=1e-08):
+        '''
+        Gives log integral of  p(m1, m2) dm1 dm2 (i.e. total normalization of mass function )
         
-        
+        Uses the table of smoothing integrals if available, otherwise adaptive quadrature 
+        with relative tolerance rtol, with the result kept in norm_cache
+        '''
         mbr = self._get_Mbreak( ml, mh, b)
-        
-
-        ms1 = np.linspace(1., ml+deltam+deltam/10, 200)
-        ms2 = np.linspace( ml+deltam+deltam/10+1e-01, mbr-mbr/10, int(res/2) )
-        ms3= np.linspace( mbr-mbr/10+1e-01, mbr+mbr/10, 50 )
-        ms3 = np.linspace(mbr+mbr/10+1e-01, mh+mh/2, int(res/2) )
-        
-        ms=np.sort(np.concatenate([ms1,ms2, ms3], ))
-        
-        p1 = np.exp(self._logpdfm1( ms ,alpha1, alpha2, deltam, ml, mh, b ))
-        return np.log(np.trapz(p1,ms))
-        
+        if self._use_table(-alpha1, deltam, ml) and ( (mbr >= ml+deltam) or (self._use_table(-alpha2, deltam, ml) and (mbr > ml+self.table.t_min*deltam) and (mh >= ml+deltam)) ):
+            return self._logNorm_table(alpha1, alpha2, deltam, ml, mh, b)
+        return self._log_normalization('logNorm', (alpha1, alpha2, deltam, ml, mh, b), lambda m: self._logpdfm1(m, alpha1, alpha2, deltam, ml, mh, b ), ml, mh, breakpoints=(ml+deltam, mbr), rtol=rtol)
+    
+    
+    def _logNorm_table(self, alpha1, alpha2, deltam, ml, mh, b ):
+        '''
+        Same as _logNorm, with the integrals over the smoothing region taken from the table, 
+        and the integrals of the power laws above it computed analytically. 
+        If the break is in the smoothing region, it must be above ml+t_min*deltam, and mh above the smoothing region
+        '''
+        mbr = self._get_Mbreak( ml, mh, b)
+        a = ml+deltam
+        if mbr >= a:
+            logI = [ self.table.logI_norm(-alpha1, deltam, ml) ]
+            if mbr > a:
+                logI.append( sf.log_powerlaw_integral(-alpha1, a, mbr) )
+            if mh > mbr:
+                logI.append( (alpha2-alpha1)*np.log(mbr)+sf.log_powerlaw_integral(-alpha2, mbr, mh) )
+        else:
+            logI = [ self.table.logI(mbr, -alpha1, deltam, ml), 
+                     (alpha2-alpha1)*np.log(mbr)+utils.logdiffexp(self.table.logI_norm(-alpha2, deltam, ml), self.table.logI(mbr, -alpha2, deltam, ml)), 
+                     (alpha2-alpha1)*np.log(mbr)+sf.log_powerlaw_integral(-alpha2, a, mh) ]
+        return np.logaddexp.reduce(logI)
     
     
     def _logNorm1(self, alpha1, alpha2, deltam, ml, mh, b ):
@@ -483,8 +587,8 @@ class BrokenPowerLawMass(BBHDistFunction):
         pm1 = lambda x: np.exp(self._logpdfm1(x, alpha1, alpha2, deltam, ml, mh, b ))
         pm2 = lambda x: np.exp(self._logpdfm2(x,  beta, deltam, ml ))
         
-        m1 = self._sample_pdf(nSamples, pm1, mMin, mMax)
-        m2 = self._sample_vector_upper(pm2, mMin, m1)
+        m1 = self._sample_pdf(nSamples, pm1, mMin, mMax, key=('m1', alpha1, alpha2, deltam, ml, mh, b))
+        m2 = self._sample_vector_upper(pm2, mMin, m1, key=('m2', beta, deltam, ml), upper_max=mMax)
         assert(m2<=m1).all() 
         assert(m2>=ml).all() 
         assert(m1<=mh).all() 
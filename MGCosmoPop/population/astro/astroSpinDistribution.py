@@ -9,7 +9,15 @@ from ..ABSpopulation import BBHDistFunction
 import numpy as np
 #from numpy.linalg import inv, det
 from scipy.stats import truncnorm #, multivariate_normal
-from scipy.special import erfc
+
+import sys
+import os
+
+PACKAGE_PARENT = '../..'
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import specialFunctions as sf
 ########################################################################
 # SPIN DISTRIBUTION
 ########################################################################
@@ -24,10 +32,7 @@ def trunc_gaussian_logpdf(x, mu = 1, sigma = 1, lower = 0, upper=100):
     pdf[~where_compute]=np.NINF
     x=x[where_compute]
     
-    Phialpha = 0.5*erfc(-(lower-mu)/(np.sqrt(2)*sigma))
-    Phibeta = 0.5*erfc(-(upper-mu)/(np.sqrt(2)*sigma))
-    
-    pdf[where_compute] = -np.log(2*np.pi)/2-np.log(sigma)-np.log(Phibeta-Phialpha) -(x-mu)**2/(2*sigma**2)
+    pdf[where_compute] = -np.log(2*np.pi)/2-np.log(sigma)-sf.trunc_norm_lognorm(mu, sigma, lower, upper) -(x-mu)**2/(2*sigma**2)
     
     return pdf
 
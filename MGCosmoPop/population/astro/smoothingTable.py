@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+import numpy as np
+import h5py
+import os
+import sys
+import time
+import argparse
+
+PACKAGE_PARENT = '../..'
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import Globals
+import utils
+
+
+
+def logS_unit(t):
+    '''
+    log of the smoothing function of the broken power law mass function,
+    in terms of t = (m-ml)/deltam in (0, 1)
+    '''
+    return -np.logaddexp(0, 1/t+1/(t-1))
+
+
+
+class SmoothingIntegralTable(object):
+
+    '''
+    Lookup table for the integrals of a power law times the smoothing function S(m; deltam, ml)
+    of BrokenPowerLawMass over the smoothing region,
+
+        I(x; gamma, deltam, ml) = int_ml^x m**gamma S(m; deltam, ml) dm ,   ml < x <= ml+deltam .
+
+    With m = ml+deltam*t, this is deltam * ml**gamma * J(gamma, r, t_x) where r = deltam/ml and
+
+        J(gamma, r, t) = int_0^t (1+r*t')**gamma S(t') dt' ,
+
+    so the table only has three dimensions, whatever the other parameters of the mass function.
+    Above ml+deltam the smoothing function is one and the integrals of the power laws are analytic,
+    so the normalizations _logNorm and _logC of BrokenPowerLawMass are obtained without numerical integration.
+
+    What is tabulated is log(J) + 1/t - 2*log(t), which is smooth down to t->0,
+    on a grid in (gamma, log(r), t) with t >= t_min, and interpolated with a tensor-product cubic spline.
+    The table is computed with an 8-point Gauss-Legendre rule in each interval of the t grid.
+
+    With the default settings (gamma in (-15, 15), r in (1e-3, 10), t in (0.02, 1),
+    grid of 121x121x200 points) the maximum error on log I is ~1e-06.
+    The error is evaluated when the table is built, on random points off the grid,
+    and stored in the attribute max_abs_err (max_abs_err_norm for t=1, i.e. for the full smoothing region).
+
+    Usage:
+
+        table = SmoothingIntegralTable()
+        table.logI(x, gamma, deltam, ml)
+
+    Values outside the tabulated range give nan. Use covers() to check.
+
+    By default the table is kept in memory only. If fname is given, the table is loaded
+    from fname if it exists with the same settings, otherwise it is computed and saved there.
+    The table can be built offline by running this file, which saves it by default
+    in Globals.popPath (the data/ directory is not tracked by git).
+    '''
+
+    def __init__(self, fname=None,
+                 gamma_range=(-15., 15.), r_range=(1e-03, 10.), t_min=0.02,
+                 ngamma=121, nr=121, nt=200,
+                 force_recompute=False, verbose=False):
+
+        self.gamma_range=gamma_range
+        self.r_range=r_range
+        self.t_min=t_min
+        self.grid_shape=(int(ngamma), int(nr), int(nt))
+        self.verbose=verbose
+
+        self.path=fname
+
+        gammagrid, rgrid, tgrid, table = self._load_or_compute(force_recompute)
+
+        self.spline = utils.TensorSpline([gammagrid, np.log(rgrid), tgrid], table, k=3)
+
+
+    def covers(self, gamma, deltam, ml):
+        r = deltam/ml
+        return (self.gamma_range[0] <= gamma <= self.gamma_range[1]) & (self.r_range[0] <= r <= self.r_range[1])
+
+
+    def logJ(self, gamma, r, t):
+        '''
+        log J(gamma, r, t) for t in (t_min, 1). gamma, r should be scalars, t can be an array
+        '''
+        return self.spline(gamma, np.log(r), t)-1/t+2*np.log(t)
+
+
+    def logI(self, x, gamma, deltam, ml):
+        '''
+        log of the integral of m**gamma S(m; deltam, ml) between ml and x, for x in (ml+t_min*deltam, ml+deltam].
+        '''
+        # (x-ml)/deltam can exceed one by roundoff for x=ml+deltam
+        t = np.minimum((x-ml)/deltam, 1.)
+        return np.log(deltam)+gamma*np.log(ml)+self.logJ(gamma, deltam/ml, t)
+
+
+    def logI_norm(self, gamma, deltam, ml):
+        '''
+        log of the integral of m**gamma S(m; deltam, ml) over the full smoothing region
+        '''
+        return np.log(deltam)+gamma*np.log(ml)+self.logJ(gamma, deltam/ml, 1.)
+
+
+    ######################
+    # BUILDING THE TABLE
+    ######################
+
+    def _get_grids(self):
+        ngamma, nr, nt = self.grid_shape
+        gammagrid = np.linspace(self.gamma_range[0], self.gamma_range[1], ngamma)
+        rgrid = np.geomspace(self.r_range[0], self.r_range[1], nr)
+        tgrid = np.linspace(self.t_min, 1., nt)
+        return gammagrid, rgrid, tgrid
+
+
+    def _load_or_compute(self, force_recompute):
+
+        if self.path is not None and os.path.exists(self.path) and not force_recompute:
+            with h5py.File(self.path, 'r') as inp:
+                same = ( tuple(inp.attrs['gamma_range'])==tuple(self.gamma_range) ) & ( tuple(inp.attrs['r_range'])==tuple(self.r_range) ) & ( inp.attrs['t_min']==self.t_min ) & ( tuple(inp.attrs['grid_shape'])==self.grid_shape )
+                if same:
+                    if self.verbose:
+                        print('Pre-computed smoothing integral table is present. Loading from %s...' %self.path)
+                    gammagrid, rgrid, tgrid = np.array(inp['gamma']), np.array(inp['r']), np.array(inp['t'])
+                    table = np.array(inp['logJ_reg'])
+                    self.max_abs_err = inp.attrs['max_abs_err']
+                    self.max_abs_err_norm = inp.attrs['max_abs_err_norm']
+                    return gammagrid, rgrid, tgrid, table
+            if self.verbose:
+                print('Pre-computed smoothing integral table in %s has different settings. Re-computing...' %self.path)
+
+        gammagrid, rgrid, tgrid, table = self._compute_table()
+        self.spline = utils.TensorSpline([gammagrid, np.log(rgrid), tgrid], table, k=3)
+        self.max_abs_err, self.max_abs_err_norm = self._check_accuracy()
+        if self.verbose:
+            print('Max error of the smoothing integral table on log I: %s (%s over the full smoothing region)' %(self.max_abs_err, self.max_abs_err_norm))
+
+        if self.path is None:
+            return gammagrid, rgrid, tgrid, table
+
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except FileExistsError:
+            pass
+        if self.verbose:
+            print('Saving smoothing integral table to %s...' %self.path)
+        with h5py.File(self.path, 'w') as out:
+            out.create_dataset('gamma', data=gammagrid)
+            out.create_dataset('r', data=rgrid)
+            out.create_dataset('t', data=tgrid)
+            out.create_dataset('logJ_reg', data=table, compression='gzip', shuffle=True)
+            out.attrs['gamma_range'] = self.gamma_range
+            out.attrs['r_range'] = self.r_range
+            out.attrs['t_min'] = self.t_min
+            out.attrs['grid_shape'] = self.grid_shape
+            out.attrs['max_abs_err'] = self.max_abs_err
+            out.attrs['max_abs_err_norm'] = self.max_abs_err_norm
+
+        return gammagrid, rgrid, tgrid, table
+
+
+    def _compute_table(self, nGL=8, nGL_min=64):
+
+        gammagrid, rgrid, tgrid = self._get_grids()
+        if self.verbose:
+            print('Tabulating smoothing integrals on a %sx%sx%s grid in (gamma, r, t)...' %self.grid_shape)
+        in_time=time.time()
+
+        # Gauss-Legendre nodes in (0, t_min) and in each interval of the t grid
+        xi, wi = np.polynomial.legendre.leggauss(nGL_min)
+        nodes0 = tgrid[0]*(xi+1)/2
+        weights0 = tgrid[0]*wi/2
+        xi, wi = np.polynomial.legendre.leggauss(nGL)
+        h = np.diff(tgrid)
+        nodes = (tgrid[:-1, None]+h[:, None]*(xi[None, :]+1)/2)
+        weights = h[:, None]*wi[None, :]/2
+
+        logS0 = logS_unit(nodes0)
+        logS = logS_unit(nodes)
+
+        table = np.empty(self.grid_shape)
+        for i, gamma in enumerate(gammagrid):
+            # shape (nr, ) and (nr, nt-1)
+            logJ0 = np.logaddexp.reduce( gamma*np.log1p(rgrid[:, None]*nodes0)+logS0+np.log(weights0), axis=-1)
+            logdJ = np.logaddexp.reduce( gamma*np.log1p(rgrid[:, None, None]*nodes)+logS+np.log(weights), axis=-1)
+            logJ = np.logaddexp.accumulate( np.concatenate([logJ0[:, None], logdJ], axis=-1), axis=-1)
+            table[i] = logJ+1/tgrid-2*np.log(tgrid)
+
+        if self.verbose:
+            print('Done in %.2fs ' %(time.time() - in_time))
+        return gammagrid, rgrid, tgrid, table
+
+
+    def _check_accuracy(self, nCheck=200, nGL=200, seed=1312):
+        '''
+        Max error on log J, on random points, with respect to a Gauss-Legendre rule with nGL nodes over (0, t),
+        for t in (t_min, 1) and for t=1
+        '''
+        rng = np.random.default_rng(seed)
+        xi, wi = np.polynomial.legendre.leggauss(nGL)
+        t = np.concatenate([ rng.uniform(self.t_min, 1., 100), [1.] ])
+        nodes = t[:, None]*(xi+1)/2
+        logw = np.log(t[:, None]*wi/2)
+        max_err, max_err_norm = 0., 0.
+        for _ in range(nCheck):
+            gamma = rng.uniform(*self.gamma_range)
+            r = np.exp(rng.uniform(*np.log(self.r_range)))
+            exact = np.logaddexp.reduce( gamma*np.log1p(r*nodes)+logS_unit(nodes)+logw, axis=-1)
+            err = np.abs(self.logJ(gamma, r, t)-exact)
+            max_err = max(max_err, err.max())
+            max_err_norm = max(max_err_norm, err[-1])
+        return max_err, max_err_norm
+
+
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fname", default=os.path.join(Globals.popPath, 'smoothing_integral_table.h5'), type=str, required=False)
+    parser.add_argument("--gamma_min", default=-15., type=float, required=False)
+    parser.add_argument("--gamma_max", default=15., type=float, required=False)
+    parser.add_argument("--r_min", default=1e-03, type=float, required=False)
+    parser.add_argument("--r_max", default=10., type=float, required=False)
+    parser.add_argument("--t_min", default=0.02, type=float, required=False)
+    parser.add_argument("--ngamma", default=121, type=int, required=False)
+    parser.add_argument("--nr", default=121, type=int, required=False)
+    parser.add_argument("--nt", default=200, type=int, required=False)
+    FLAGS = parser.parse_args()
+
+    table = SmoothingIntegralTable(fname=FLAGS.fname, gamma_range=(FLAGS.gamma_min, FLAGS.gamma_max), r_range=(FLAGS.r_min, FLAGS.r_max), t_min=FLAGS.t_min,
+                                   ngamma=FLAGS.ngamma, nr=FLAGS.nr, nt=FLAGS.nt, force_recompute=True, verbose=True)
+    print('Table saved in %s' %table.path)
+    print('Max error on log I: %s; over the full smoothing region: %s' %(table.max_abs_err, table.max_abs_err_norm))
@@ -6,6 +6,14 @@ Created on Thu Mar  4 11:54:06 2021
 @author: Michi
 """
 import numpy as np
+import os
+import sys
+
+PACKAGE_PARENT = '..'
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+from dataStructures.ABSdata import ConcatenatedData
 
 def logdiffexp(x, y):
     '''                                                                                                                                                                      
@@ -22,7 +30,7 @@ class HyperLikelihood(object):
     marginalised over the GW parameters
     
     '''
-    def __init__(self, population, data, params_inference, safety_factor=100, verbose=False):
+    def __init__(self, population, data, params_inference, safety_factor=100, verbose=False, concatenate_data=False):
         '''
         
 
@@ -31,6 +39,10 @@ class HyperLikelihood(object):
         population : TYPE object of type AllPopulations
 
         data : TYPE list of objects Data
+        
+        concatenate_data: if True, the samples of all datasets are joined (see ConcatenatedData) 
+                        and the population is evaluated only once for all the events. 
+                        The log likelihood is still returned separately for each dataset
 
         '''
         self.population=population
@@ -38,20 +50,70 @@ class HyperLikelihood(object):
         self.params_inference=params_inference
         self.safety_factor = safety_factor
         self.verbose=verbose
+        
+        for data_ in self.data:
+            assert (np.log(np.diff(data_.sample_offsets))==data_.logNsamples).all()
+        
+        self.concatenate_data=concatenate_data
+        if concatenate_data:
+            self._allData = ConcatenatedData(self.data)
+            print('Concatenated %s datasets, total %s events' %(len(self.data), self._allData.Nobs))
+        
+        # If no cosmological parameter is varied, source-frame quantities 
+        # and cosmological factors are computed once here
+        self.fixed_cosmo = not any(p in self.population.cosmo.params for p in self.params_inference)
+        if self.fixed_cosmo:
+            print('No cosmological parameter in the inference. Pre-computing source-frame masses and redshifts...')
+            self._fixed_cosmo_terms = {}
+            for data_ in self._get_datasets():
+                self._fixed_cosmo(data_)
+    
+    
+    def _get_datasets(self):
+        '''
+        Data objects on which the population is evaluated
+        '''
+        if self.concatenate_data:
+            return [self._allData]
+        return self.data
+    
+    
+    def _fixed_cosmo(self, data):
+        '''
+        Returns the output of _get_fixed_cosmo_terms for data. 
+        The result is kept in _fixed_cosmo_terms together with the values of the cosmological parameters, 
+        and is recomputed if the base values have changed (e.g. with AllPopulations.set_values)
+        '''
+        LambdaCosmo = tuple( self.population.cosmo.baseValues[p] for p in self.population.cosmo.params )
+        data_, LambdaCosmo_, terms = self._fixed_cosmo_terms.get(id(data), (None, None, None))
+        if data_ is not data or LambdaCosmo_!=LambdaCosmo:
+            terms = self._get_fixed_cosmo_terms(data, LambdaCosmo)
+            self._fixed_cosmo_terms[id(data)] = (data, LambdaCosmo, terms)
+        return terms
     
-    def _get_mass_redshift(self, Lambda, data):
+    
+    def _get_fixed_cosmo_terms(self, data, LambdaCosmo):
+        '''
+        Returns m1, m2, z, spins and cosmological factors, 
+        computed with the values LambdaCosmo of the cosmological parameters
+        '''
+        m1, m2, z = self._get_mass_redshift(LambdaCosmo, data)
+        log_cosmo = self.population.log_cosmo_terms(z, LambdaCosmo, dL=data.dL_flat)
+        return m1, m2, z, self._getSpins(data), log_cosmo
+    
+    def _get_mass_redshift(self, Lambda, data, samples=slice(None)):
         
         LambdaCosmo, LambdaAllPop = self.population._split_params(Lambda)
         H0, Om0, w0,  Xi0, n = self.population.cosmo._get_values(LambdaCosmo, ['H0', 'Om', 'w0','Xi0', 'n'])
         
-        z = self.population.cosmo.z_from_dLGW_fast(data.dL, H0, Om0, w0, Xi0, n)
-        m1 = data.m1z / (1 + z)    
-        m2 = data.m2z / (1 + z)
+        z = self.population.cosmo.z_from_dLGW_fast(data.dL_flat[samples], H0, Om0, w0, Xi0, n)
+        m1 = data.m1z_flat[samples] / (1 + z)    
+        m2 = data.m2z_flat[samples] / (1 + z)
         
         return m1, m2, z
     
     def _getSpins(self,data ):
-        return data.spins
+        return data.spins_flat
     
     def _getTobs(self, data):
         return data.Tobs
@@ -62,53 +124,145 @@ class HyperLikelihood(object):
         Returns log likelihood for each dataset
         """
         Lambda = self.population.get_Lambda(Lambda_test, self.params_inference )
-        m1, m2, z = self._get_mass_redshift(Lambda, data)
-        spins = self._getSpins(data)
         Tobs = self._getTobs(data)
         
-        # If different events have different number of samples, 
-        # This is taken into account by filling the likelihood with -infty
-        # where the array of samples has been filled with nan
-        logLik_=np.empty_like(m1)
-        where_compute=~np.isnan(m1)
-        logLik_[~where_compute]=np.NINF
+        # The samples of all events are stored in flat arrays (see Data._set_flat_samples), 
+        # so no padding is present if different events have different number of samples
+        if self.fixed_cosmo:
+            m1, m2, z, spins, log_cosmo = self._fixed_cosmo(data)
+            logLik_ = self.population._log_dN_dm1zdm2zddL(m1, m2, z, spins, Tobs, Lambda, log_cosmo=log_cosmo)
+        else:
+            m1, m2, z = self._get_mass_redshift(Lambda, data)
+            spins = self._getSpins(data)
+            logLik_ = self.population._log_dN_dm1zdm2zddL(m1, m2, z, spins, Tobs, Lambda, dL=data.dL_flat)
         
-        #logLik_ = np.where( ~np.isnan(m1), self.population.log_dN_dm1zdm2zddL(m1, m2, z, spins, Tobs, Lambda), np.NINF) #m1, m2, z, spins, Tobs, Lambda
-        spins=[s[where_compute] for s in spins]
-        logLik_[where_compute] = self.population.log_dN_dm1zdm2zddL(m1[where_compute], m2[where_compute], z[where_compute], spins, Tobs, Lambda, dL=data.dL[where_compute])
+        return self._sum_over_samples(logLik_, data, Lambda)
+    
+    
+    def _sum_over_samples(self, logLik_, data, Lambda):
+        '''
+        Marginalises over the GW parameters of each event and sums over the events.
+        If data is of type ConcatenatedData, the sum is done separately for each catalog, 
+        and the result has an additional last axis of length n_catalogs
+        '''
+        allLogLiks, Neff = self._marginalise_events(logLik_, data, Lambda)
         
-        # Remove original prior from posterior samples to get the likelihood        
-        logLik_ -= data.logOrMassPrior()
-        logLik_ -= data.logOrDistPrior()
+        # add log likelihoods for all observations
+        if isinstance(data, ConcatenatedData):
+            catalog_starts = data.catalog_offsets[:-1]
+            lowNeff = np.logical_or.reduceat(Neff<self.safety_factor, catalog_starts, axis=-1)
+            ll = np.add.reduceat(allLogLiks, catalog_starts, axis=-1)
+        else:
+            lowNeff = np.any(Neff<self.safety_factor, axis=-1)
+            ll = allLogLiks.sum(axis=-1)
+        if np.any(np.isnan(np.where(lowNeff, 0., ll))):
+            raise ValueError('NaN value for logLik. Values of Lambda: %s' %(str(Lambda) ) )
+        return np.where(lowNeff, np.NINF, ll)[()]
+    
+    
+    def _marginalise_events(self, logLik_, data, Lambda, events=slice(None)):
+        '''
+        Log likelihood and number of effective samples of each event. 
+        logLik_ contains the population evaluated on the samples of the events in the slice events
+        '''
+        offsets = data.sample_offsets[events.start:None if events.stop is None else events.stop+1]
+        samples = slice(offsets[0], offsets[-1])
+        logNsamples = data.logNsamples[events]
+        
+        # Remove original prior from posterior samples to get the likelihood 
+        # (computed once, see Data._set_flat_samples)
+        logLik_ = logLik_ - data.logOrPrior_flat[samples]
         
-        assert (np.log(where_compute.sum(axis=-1))==data.logNsamples).all()
         # mean over posterior samples ~ marginalise over GW parameters for every observation
-        allLogLiks = np.logaddexp.reduce(logLik_, axis=-1)-data.logNsamples 
+        # (sum over the samples of each event)
+        starts = offsets[:-1]-offsets[0]
+        allLogLiks = np.logaddexp.reduceat(logLik_, starts, axis=-1)-logNsamples 
         
         # Now allLogLiks has shape=n. of observations
         # Check number of effective samples
-        logs2 = ( np.logaddexp.reduce(2*logLik_, axis=-1) -2*data.logNsamples)
-        logSigmaSq = logdiffexp( logs2, 2.0*allLogLiks - data.logNsamples)
+        logs2 = ( np.logaddexp.reduceat(2*logLik_, starts, axis=-1) -2*logNsamples)
+        logSigmaSq = logdiffexp( logs2, 2.0*allLogLiks - logNsamples)
         Neff = np.exp( 2.0*allLogLiks - logSigmaSq)
-        if np.any(Neff<self.safety_factor):
-            if self.verbose:
-                print('Not enough samples to safely evaluate the likelihood. Neff: %s at position(s) %s for safety factor: %s. Rejecting sample. Values of Lambda: %s' %(str(Neff[Neff<self.safety_factor]), str(np.argwhere(Neff<self.safety_factor).T),self.safety_factor,str(Lambda)))
-            return np.NINF
-
-        else:
-            # add log likelihoods for all observations
-            ll = allLogLiks.sum()
-            if np.isnan(ll):
-                raise ValueError('NaN value for logLik. Values of Lambda: %s' %(str(Lambda) ) )
-            return ll
+        
+        if np.any(Neff<self.safety_factor) and self.verbose:
+            print('Not enough samples to safely evaluate the likelihood. Neff: %s at position(s) %s for safety factor: %s. Rejecting sample. Values of Lambda: %s' %(str(Neff[Neff<self.safety_factor]), str(np.argwhere(Neff<self.safety_factor).T),self.safety_factor,str(Lambda)))
+        
+        return allLogLiks, Neff
+    
+    
+    def _logLik_early(self, Lambda_test, data, chunk_size=None):
+        '''
+        Same as _logLik, but the events are evaluated in chunks of chunk_size events 
+        (all together if chunk_size is None), and None is returned as soon as 
+        an event has not enough effective samples
+        '''
+        Lambda = self.population.get_Lambda(Lambda_test, self.params_inference )
+        Tobs = self._getTobs(data)
+        nEvents = len(data.logNsamples)
+        if chunk_size is None:
+            chunk_size = nEvents
+        
+        allLogLiks = []
+        for start in range(0, nEvents, chunk_size):
+            events = slice(start, min(start+chunk_size, nEvents))
+            samples = slice(data.sample_offsets[events.start], data.sample_offsets[events.stop])
+            Tobs_ = Tobs[samples] if np.ndim(Tobs) else Tobs
+            
+            if self.fixed_cosmo:
+                m1, m2, z, spins, log_cosmo = self._fixed_cosmo(data)
+                m1, m2, z, log_cosmo = m1[samples], m2[samples], z[samples], log_cosmo[samples]
+                spins = [s[samples] for s in spins]
+                logLik_ = self.population._log_dN_dm1zdm2zddL(m1, m2, z, spins, Tobs_, Lambda, log_cosmo=log_cosmo)
+            else:
+                m1, m2, z = self._get_mass_redshift(Lambda, data, samples=samples)
+                spins = [s[samples] for s in self._getSpins(data)]
+                logLik_ = self.population._log_dN_dm1zdm2zddL(m1, m2, z, spins, Tobs_, Lambda, dL=data.dL_flat[samples])
+            
+            logLiks_, Neff = self._marginalise_events(logLik_, data, Lambda, events=events)
+            if np.any(Neff<self.safety_factor):
+                return None
+            allLogLiks.append(logLiks_)
+        
+        allLogLiks = np.concatenate(allLogLiks)
+        if np.any(np.isnan(allLogLiks)):
+            raise ValueError('NaN value for logLik. Values of Lambda: %s' %(str(Lambda) ) )
+        if isinstance(data, ConcatenatedData):
+            return list(np.add.reduceat(allLogLiks, data.catalog_offsets[:-1]))
+        return allLogLiks.sum()
+    
+    
+    def logLik_early(self, Lambda_test, chunk_size=None):
+        '''
+        Returns a list with the log likelihood of each dataset, or None as soon as 
+        an event with not enough effective samples is found (in which case the log likelihood 
+        would be -inf). The events of each dataset are evaluated in chunks of chunk_size events, 
+        so that the remaining events are skipped after a rejection.
+        '''
+        if self.concatenate_data:
+            return self._logLik_early(Lambda_test, self._allData, chunk_size=chunk_size)
+        
+        allL = []
+        for data_ in self.data:
+            ll = self._logLik_early(Lambda_test, data_, chunk_size=chunk_size)
+            if ll is None:
+                return None
+            allL.append(ll)
+        return allL
     
     
-    def logLik(self, Lambda_test, **kwargs):
+    def logLik(self, Lambda_test, executor=None, **kwargs):
+        '''
+        Returns a list with the log likelihood of each dataset. 
+        If executor (e.g. a concurrent.futures.ThreadPoolExecutor) is given, 
+        the datasets are evaluated concurrently
+        '''
+        if self.concatenate_data:
+            return list(self._logLik( Lambda_test, self._allData, **kwargs))
+        
+        if executor is not None:
+            return list(executor.map(lambda data_: self._logLik( Lambda_test, data_, **kwargs), self.data))
         
         allL = []
         for data_ in self.data:
             allL.append(self._logLik( Lambda_test, data_, **kwargs))
         return  allL  
-        
-            
-            
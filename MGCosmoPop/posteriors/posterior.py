@@ -6,6 +6,8 @@ Created on Thu Mar  4 13:18:13 2021
 @author: Michi
 """
 import numpy as np
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 
@@ -20,14 +22,101 @@ def logdiffexp(x, y):
 
 class Posterior(object):
     
-    def __init__(self, hyperLikelihood, prior, selectionBias, verbose=False, bias_safety_factor=10.):
-        
+    def __init__(self, hyperLikelihood, prior, selectionBias, verbose=False, bias_safety_factor=10., adapt_z_grid=False, z_grid_args={}, n_threads=None, event_chunk_size=None, early_rejection=False, pool_selection=False):
+        '''
+        If adapt_z_grid is True, the redshift grid used by the cosmology is restricted to the range 
+        of luminosity distances of the data and injections, for all values of the 
+        cosmological parameters allowed by the prior. z_grid_args are passed to Cosmo.set_z_grid
+        
+        If n_threads is not None, in logPosterior the likelihood and the selection effects are computed 
+        concurrently, and the datasets of each of them are distributed on a pool of n_threads threads. 
+        This is useful since numpy releases the GIL in the large array operations. 
+        When using multiprocessing on top of this (e.g. a Pool for emcee), 
+        the number of threads per process should be reduced accordingly.
+        
+        Otherwise, if early_rejection is True, in logPosterior the rejection criteria are evaluated 
+        from the cheapest one, and the computation stops as soon as the sample is rejected: 
+        first the prior, then the number of effective injections of the selection effects, 
+        then the number of effective samples of each event, which is checked every 
+        event_chunk_size events (or once per dataset if event_chunk_size is None). 
+        This is not used with return_all=True, since all the terms are needed.
+        
+        In all cases, the number of samples rejected by each criterion is stored in rejection_counts, 
+        and the number of samples that pass all of them in n_accepted.
+        They are updated under a lock, so that logPosterior can be called from different threads.
+        
+        If pool_selection is True, the selection effects of all the datasets are combined in a single 
+        selection function (see SelectionBiasInjections.Ndet_pooled): the expected numbers of detections 
+        and their MC variances are added, and the number of effective injections is compared with 
+        bias_safety_factor times the total number of observations. 
+        In this case, logPosterior with return_all=True returns lists with one element for mu and error.
+        '''
         self.hyperLikelihood = hyperLikelihood
         self.prior = prior
         self.selectionBias = selectionBias
         self.verbose=verbose
         self.bias_safety_factor=bias_safety_factor
         #self.params_inference = params_inference
+        self.n_threads=n_threads
+        self._executors=None
+        self.event_chunk_size=event_chunk_size
+        self.early_rejection=early_rejection
+        self.pool_selection=pool_selection
+        if pool_selection and self.selectionBias is None:
+            raise ValueError('pool_selection requires the selection effects')
+        self._lock = threading.Lock()
+        self.rejection_counts = {'prior':0, 'selection_Neff':0, 'event_Neff':0}
+        self.n_accepted=0
+        
+        if self.selectionBias is not None:
+            self.selectionBias.set_Neff_min([ self.bias_safety_factor*data_.Nobs for data_ in self.hyperLikelihood.data ])
+        
+        if adapt_z_grid:
+            self._adapt_z_grid(**z_grid_args)
+    
+    
+    def _adapt_z_grid(self, **kwargs):
+        allData = list(self.hyperLikelihood.data)
+        if self.selectionBias is not None:
+            allData += list(self.selectionBias.injData)
+        dL_max = max( np.nanmax(data_.dL) for data_ in allData )
+        dL_min = min( np.nanmin(data_.dL) for data_ in allData )
+        priorLimits = { p: self.prior.priorLimits[p] for p in self.prior.params_inference }
+        self.hyperLikelihood.population.cosmo.set_z_grid(dL_max, dL_min=dL_min, priorLimits=priorLimits, **kwargs)
+    
+    
+    def _get_executors(self):
+        '''
+        Returns a pool with one thread, where the likelihood is computed while the selection effects 
+        are computed in the calling thread, and the pool where the single datasets are evaluated. 
+        The pools are created at the first call, so that the object can be pickled before 
+        '''
+        if self._executors is None:
+            self._executors = ThreadPoolExecutor(max_workers=1), ThreadPoolExecutor(max_workers=self.n_threads)
+        return self._executors
+    
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executors'] = None
+        del state['_lock']
+        return state
+    
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+    
+    
+    def _count(self, reason=None):
+        '''
+        Adds the sample to rejection_counts[reason], or to n_accepted if reason is None
+        '''
+        with self._lock:
+            if reason is None:
+                self.n_accepted+=1
+            else:
+                self.rejection_counts[reason]+=1
 
         
     def logPosterior(self, Lambda_test, return_all=False,):
@@ -35,43 +124,63 @@ class Posterior(object):
         # Compute prior
         lp = self.prior.logPrior(Lambda_test)
         if not np.isfinite(lp):
+            self._count('prior')
             return -np.inf
         
+        if self.early_rejection and not return_all and self.n_threads is None and self.selectionBias is not None:
+            return self._logPosterior_early(Lambda_test, lp)
+        
         # Get all parameters in case we are fixing some of them
         # Lambda = self.hyperLikelihood.population.get_Lambda(Lambda_test, self.prior.params_inference )
         
-        # Compute likelihood
-        lls = self.hyperLikelihood.logLik(Lambda_test)
-        
-        #logll = np.log(ll)
-        
-
-        
-        # Compute selection bias
-        # Includes uncertainty on MC estimation of the selection effects if required. err is =zero if we required to ignore it.
-        if self.selectionBias is not None:
-            mus, errs, Neffs = self.selectionBias.Ndet(Lambda_test, )
+        if self.n_threads is not None and self.selectionBias is not None:
+            # Likelihood and selection bias computed concurrently
+            lls, mus, errs, Neffs = self._logLik_Ndet_threads(Lambda_test)
         else:
-            Lambda = self.hyperLikelihood.population.get_Lambda(Lambda_test, self.hyperLikelihood.params_inference )
-            mus = [ self.hyperLikelihood.population.Nperyear_expected(Lambda)*self.hyperLikelihood._getTobs(self.hyperLikelihood.data[i]) for i in range(len(lls))]
-            errs = [0 for _ in range(len(lls))]
+            # Compute likelihood
+            lls = self.hyperLikelihood.logLik(Lambda_test)
+            
+            #logll = np.log(ll)
+            
+            # Compute selection bias
+            # Includes uncertainty on MC estimation of the selection effects if required. err is =zero if we required to ignore it.
+            if self.selectionBias is not None:
+                mus, errs, Neffs = self._Ndet(Lambda_test, )
+            else:
+                Lambda = self.hyperLikelihood.population.get_Lambda(Lambda_test, self.hyperLikelihood.params_inference )
+                mus = [ self.hyperLikelihood.population.Nperyear_expected(Lambda)*self.hyperLikelihood._getTobs(self.hyperLikelihood.data[i]) for i in range(len(lls))]
+                errs = [0 for _ in range(len(lls))]
             
+        # log likelihood and number of observations corresponding to each term of the selection effects
+        lls_sel = [np.sum(lls)] if self.pool_selection else lls
+        Nobs = self._get_Nobs()
+        
         #logNdet = logdiffexp(logMu, logErr )
-        logPosts = np.zeros(len(lls))
-        for i in range(len(lls)):
-            if Neffs[i] < self.bias_safety_factor * self.hyperLikelihood.data[i].Nobs:
+        logPosts = np.zeros(len(lls_sel))
+        lowNeff = False
+        for i in range(len(lls_sel)):
+            if Neffs[i] < self.bias_safety_factor * Nobs[i]:
                 if self.verbose:
-                    print('NEED MORE SAMPLES FOR SELECTION EFFECTS! Nobs = %s, Neff = %s, Values of Lambda: %s' %(self.hyperLikelihood.data[i].Nobs, Neffs[i], str(Lambda_test)))
+                    print('NEED MORE SAMPLES FOR SELECTION EFFECTS! Nobs = %s, Neff = %s, Values of Lambda: %s' %(Nobs[i], Neffs[i], str(Lambda_test)))
                 # reject the sample
                 logPosts[i] = -np.inf
+                lowNeff = True
             else:
-                logPosts[i] = lls[i]-mus[i] #-np.exp(logNdet.astype('float128')) 
+                logPosts[i] = lls_sel[i]-mus[i] #-np.exp(logNdet.astype('float128')) 
                 # Add uncertainty on MC estimation of the selection effects. err is =zero if we required to ignore it.
                 logPosts[i] += errs[i]
         
         # sum log likelihood of different datasets
         logPost = logPosts.sum()
         
+        # the log likelihood is -inf only if an event has not enough effective samples
+        if lowNeff:
+            self._count('selection_Neff')
+        elif not np.all(np.isfinite(lls)):
+            self._count('event_Neff')
+        else:
+            self._count()
+        
         
         # Add prior
         logPost += lp
@@ -85,3 +194,58 @@ class Posterior(object):
         
         
         
+    
+    
+    def _logPosterior_early(self, Lambda_test, lp):
+        '''
+        Same as logPosterior, but the selection effects are computed before the likelihood, 
+        and -inf is returned as soon as a rejection criterion is met
+        '''
+        mus, errs, Neffs = self._Ndet(Lambda_test, )
+        Nobs = self._get_Nobs()
+        for i in range(len(Neffs)):
+            if Neffs[i] < self.bias_safety_factor * Nobs[i]:
+                if self.verbose:
+                    print('NEED MORE SAMPLES FOR SELECTION EFFECTS! Nobs = %s, Neff = %s, Values of Lambda: %s' %(Nobs[i], Neffs[i], str(Lambda_test)))
+                self._count('selection_Neff')
+                return -np.inf
+        
+        lls = self.hyperLikelihood.logLik_early(Lambda_test, chunk_size=self.event_chunk_size)
+        if lls is None:
+            self._count('event_Neff')
+            return -np.inf
+        
+        self._count()
+        logPost = sum(lls)-sum(mus)+sum(errs)
+        return logPost+lp
+    
+    
+    def _logLik_Ndet_threads(self, Lambda_test):
+        '''
+        Likelihood and selection effects computed concurrently (see n_threads)
+        '''
+        outer, inner = self._get_executors()
+        llFuture = outer.submit(self.hyperLikelihood.logLik, Lambda_test, executor=inner)
+        mus, errs, Neffs = self._Ndet(Lambda_test, executor=inner)
+        return llFuture.result(), mus, errs, Neffs
+    
+    
+    def _Ndet(self, Lambda_test, executor=None):
+        '''
+        Selection effects for each dataset, or for all the datasets together if pool_selection is True. 
+        Returns lists of mu, error and Neff
+        '''
+        if self.pool_selection:
+            mu, err, Neff = self.selectionBias.Ndet_pooled(Lambda_test, executor=executor)
+            return [mu], [err], [Neff]
+        return self.selectionBias.Ndet(Lambda_test, executor=executor)
+    
+    
+    def _get_Nobs(self):
+        '''
+        Number of observations corresponding to each term returned by _Ndet
+        '''
+        Nobs = [ data_.Nobs for data_ in self.hyperLikelihood.data ]
+        if self.pool_selection:
+            return [sum(Nobs)]
+        return Nobs
@@ -8,8 +8,20 @@ Created on Thu Mar  4 13:06:04 2021
  
 from abc import ABC, abstractmethod
 import numpy as np
+import copy
+import os
+import sys
+import threading
 #from .. import utils
-import scipy.stats as ss
+from scipy.special import ndtr
+
+PACKAGE_PARENT = '..'
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+import utils
+import specialFunctions as sf
+from dataStructures.ABSdata import MixtureInjectionsData
 
 
 
@@ -40,6 +52,15 @@ class SelectionBias(ABC):
         self.injData=injData
         self.population=population
         self.params_inference = params_inference 
+        self.Neff_min = None
+    
+    
+    def set_Neff_min(self, Neff_min):
+        '''
+        Minimum number of effective samples required for each dataset (see Posterior).
+        Can be used to adapt the precision of the computation
+        '''
+        self.Neff_min = Neff_min
 
 
     @abstractmethod
@@ -55,7 +76,7 @@ class SelectionBiasInjections(SelectionBias):
     Logic for computing the selection effects
     '''
     
-    def __init__(self, population, injData, params_inference, get_uncertainty=True ):
+    def __init__(self, population, injData, params_inference, get_uncertainty=True, concatenate_data=False ):
         ''' 
 
         Parameters
@@ -66,7 +87,11 @@ class SelectionBiasInjections(SelectionBias):
         injData: Data object . Contains the injections data. Shoulf have attributes:
                 log_weights_sel' : [array of log_p_draw]
                  'logN_gen': number of injections 
-                 'condition': if any, some condition to filter injections
+                 Only the detected injections should be present (see Data._apply_condition)
+        
+        concatenate_data: if True, the injections of all datasets are joined (see MixtureInjectionsData) 
+                        and the population is evaluated only once for all the runs. 
+                        mu, error and Neff are still returned separately for each dataset
            
 
         '''
@@ -74,6 +99,54 @@ class SelectionBiasInjections(SelectionBias):
         
         self.get_uncertainty=get_uncertainty
         SelectionBias.__init__(self, population, injData, params_inference)
+        
+        self.concatenate_data=concatenate_data
+        if concatenate_data:
+            self._allInjData = MixtureInjectionsData(self.injData)
+            print('Concatenated %s injection sets, total %s detected injections' %(len(self.injData), len(self._allInjData.m1z)))
+        
+        # If no cosmological parameter is varied, source-frame quantities 
+        # and cosmological factors are computed once here
+        self.fixed_cosmo = not any(p in self.population.cosmo.params for p in self.params_inference)
+        if self.fixed_cosmo:
+            print('No cosmological parameter in the inference. Pre-computing source-frame masses and redshifts of injections...')
+            self._fixed_cosmo_terms = {}
+            for injData_ in self._get_datasets():
+                self._fixed_cosmo(injData_)
+    
+    
+    def _get_datasets(self):
+        '''
+        Injection sets on which the population is evaluated
+        '''
+        if self.concatenate_data:
+            return [self._allInjData]
+        return self.injData
+    
+    
+    def _fixed_cosmo(self, injData):
+        '''
+        Returns the output of _get_fixed_cosmo_terms for injData. 
+        The result is kept in _fixed_cosmo_terms together with the values of the cosmological parameters, 
+        and is recomputed if the base values have changed (e.g. with AllPopulations.set_values)
+        '''
+        LambdaCosmo = tuple( self.population.cosmo.baseValues[p] for p in self.population.cosmo.params )
+        injData_, LambdaCosmo_, terms = self._fixed_cosmo_terms.get(id(injData), (None, None, None))
+        if injData_ is not injData or LambdaCosmo_!=LambdaCosmo:
+            terms = self._get_fixed_cosmo_terms(injData, LambdaCosmo)
+            self._fixed_cosmo_terms[id(injData)] = (injData, LambdaCosmo, terms)
+        return terms
+    
+    
+    def _get_fixed_cosmo_terms(self, injData, LambdaCosmo):
+        '''
+        Returns m1, m2, z, spins and cosmological factors for the injections, 
+        computed with the values LambdaCosmo of the cosmological parameters
+        '''
+        m1, m2, z = self._get_mass_redshift(LambdaCosmo, injData)
+        log_cosmo = self.population.log_cosmo_terms(z, LambdaCosmo, dL=injData.dL)
+        spins = self._getSpins(injData)
+        return m1, m2, z, spins, log_cosmo
     
     
     def _get_mass_redshift(self, Lambda, injData):
@@ -98,31 +171,37 @@ class SelectionBiasInjections(SelectionBias):
     def _Ndet(self, Lambda_test, injData, verbose=False, ):
         
         Lambda = self.population.get_Lambda(Lambda_test, self.params_inference )
-        
-        m1, m2, z = self._get_mass_redshift(Lambda, injData)
-        spins = self._getSpins(injData)
         Tobs = self._getTobs(injData)
         
-        #logdN=np.empty_like(m1)
-        #logdN[~injData.condition]=np.NINF
-    
-        m1, m2, z, spins = m1[injData.condition], m2[injData.condition], z[injData.condition], [s[injData.condition] for s in spins]
-        
-        
-        #logdN =  np.where( injData.condition, self.population.log_dN_dm1zdm2zddL(m1, m2, z, spins, Tobs, Lambda),  np.NINF) 
-        #logdN -= injData.log_weights_sel
-        logdN=np.squeeze(self.population.log_dN_dm1zdm2zddL(m1, m2, z, spins, Tobs, Lambda, dL=injData.dL[injData.condition])-injData.log_weights_sel[injData.condition])
-        
+        if self.fixed_cosmo:
+            m1, m2, z, spins, log_cosmo = self._fixed_cosmo(injData)
+            logdN=self.population._log_dN_dm1zdm2zddL(m1, m2, z, spins, Tobs, Lambda, log_cosmo=log_cosmo)-injData.log_weights_sel
+        else:
+            m1, m2, z = self._get_mass_redshift(Lambda, injData)
+            spins = self._getSpins(injData)
+            
+            # The injection data only contain detected injections, so no mask is needed
+            logdN=self.population._log_dN_dm1zdm2zddL(m1, m2, z, spins, Tobs, Lambda, dL=injData.dL)-injData.log_weights_sel
         
-        logMu = np.logaddexp.reduce(logdN) - injData.logN_gen
+        return self._Ndet_from_logdN(logdN, injData, Lambda)
+    
+    
+    def _Ndet_from_logdN(self, logdN, injData, Lambda):
+        '''
+        Monte Carlo estimate of the expected number of detections, 
+        given the log of the weights of the detected injections. 
+        If injData is of type MixtureInjectionsData, the sum is done separately for each run, 
+        and the results have an additional last axis of length n_runs
+        '''
+        logMu = self._sum_over_injections(logdN, injData) - injData.logN_gen
         
-        if np.isnan(logMu):
+        if np.any(np.isnan(logMu)):
             raise ValueError('NaN value for logMu. Values of Lambda: %s' %( str(Lambda) ) )
         
         mu = np.exp(logMu)#.astype('float128')
         
         
-        logs2 = ( np.logaddexp.reduce(2*logdN) -2*injData.logN_gen)#.astype('float128')
+        logs2 = ( self._sum_over_injections(2*logdN, injData) -2*injData.logN_gen)#.astype('float128')
         logSigmaSq = logdiffexp( logs2, 2.0*logMu - injData.logN_gen )
         
         
@@ -141,19 +220,44 @@ class SelectionBiasInjections(SelectionBias):
         ## Effects of uncertainty on selection effect and/or marginalisation over total rate
         ## Adapted from 1904.10879
         
-        muSq = np.exp(2*logMu)
         SigmaSq = np.exp(logSigmaSq)#.astype('float128')
-        Sigma = np.sqrt(SigmaSq)
         
-        num = ss.norm(loc=mu-SigmaSq, scale=Sigma).logsf(0)
-        den = ss.norm(loc=mu, scale=Sigma ).logsf(0)
-        error = SigmaSq/2-den+num
+        return mu, self._error_term(mu, SigmaSq), Neff
+    
+    
+    def _sum_over_injections(self, logdN, injData):
+        '''
+        log of the sum of exp(logdN) over the injections (separately for each run for MixtureInjectionsData)
+        '''
+        if isinstance(injData, MixtureInjectionsData):
+            return np.logaddexp.reduceat(logdN, injData.run_offsets[:-1], axis=-1)
+        return np.logaddexp.reduce(logdN, axis=-1)
+    
+    
+    def _error_term(self, mu, SigmaSq):
+        '''
+        Correction to the log likelihood due to the uncertainty SigmaSq on the MC estimate of mu
+        Adapted from 1904.10879
+        '''
+        Sigma = np.sqrt(SigmaSq)
         
-                
-        return mu, error, Neff
+        num = sf.norm_logsf(0, loc=mu-SigmaSq, scale=Sigma)
+        den = sf.norm_logsf(0, loc=mu, scale=Sigma )
+        return SigmaSq/2-den+num
     
     
-    def Ndet(self, Lambda_test, verbose=False, ):
+    def Ndet(self, Lambda_test, verbose=False, executor=None):
+        '''
+        If executor (e.g. a concurrent.futures.ThreadPoolExecutor) is given, 
+        the datasets are evaluated concurrently
+        '''
+        if self.concatenate_data:
+            mu_, err_, Neff_ = self._Ndet(Lambda_test, self._allInjData, verbose=verbose, )
+            return list(mu_), list(np.broadcast_to(err_, mu_.shape)), list(Neff_)
+        
+        if executor is not None:
+            res = list(executor.map(lambda injData_: self._Ndet(Lambda_test, injData_, verbose=verbose, ), self.injData))
+            return [r[0] for r in res], [r[1] for r in res], [r[2] for r in res]
         
         mus=[]
         errs=[]
@@ -167,7 +271,554 @@ class SelectionBiasInjections(SelectionBias):
             errs.append(err_)
             Neffs.append(Neff_)
         return mus, errs, Neffs
-            
+    
+    
+    def Ndet_pooled(self, Lambda_test, verbose=False, executor=None):
+        '''
+        Expected number of detections summed over all the datasets, 
+        for a selection function combining all runs (see Posterior, pool_selection). 
+        The MC variances of the datasets are added. 
+        If the variance is zero (e.g. for SelectionBiasGrid, which has no Monte Carlo uncertainty), 
+        Neff is infinite and the error term is zero.
+        '''
+        mus, errs, Neffs = self.Ndet(Lambda_test, verbose=verbose, executor=executor)
+        mu = np.sum(mus)
+        SigmaSq = np.sum( np.array(mus)**2/np.array(Neffs) )
+        if SigmaSq==0:
+            return mu, 0, np.inf
+        Neff = mu**2/SigmaSq
+        if not self.get_uncertainty:
+            return mu, 0, Neff
+        return mu, self._error_term(mu, SigmaSq), Neff
+
+
+
+
+class SelectionBiasEmulator(SelectionBiasInjections):
+    
+    '''
+    Selection effects computed with injections, as in SelectionBiasInjections, 
+    but emulated with a Gaussian process in the space of the parameters of the inference. 
+    
+    The emulator is trained on the exact Monte Carlo values of log(mu) and log(SigmaSq), 
+    where SigmaSq is the MC variance of mu; Neff and the uncertainty term are reconstructed from them. 
+    At each call, the prediction of the emulator is used only if the resulting uncertainty on the 
+    log posterior, -mu + error term, is below tol (in absolute units of log posterior). 
+    To first order, this is 
+        mu*std(log mu) + SigmaSq/2*std(log SigmaSq) ,
+    since the error term is ~SigmaSq/2 = mu^2/(2 Neff). 
+    Otherwise, the exact sum over the injections is computed and added to the training set, 
+    so that the emulator is refined where the sampler is exploring. 
+    
+    New training points are added to the Gaussian process incrementally, keeping its length scales fixed 
+    (see utils.GaussianProcess.add). The length scales are optimised again only when 
+    the training set has grown by a factor refit_factor since the last full fit.
+    
+    The counters n_exact, n_emulated and n_fits, the training sets and the Gaussian processes are 
+    updated under a lock, so that the datasets can be evaluated on different threads (see Posterior). 
+    The exact sums over the injections are computed outside the lock.
+    '''
+    
+    def __init__(self, population, injData, params_inference, get_uncertainty=True, 
+                 tol=0.05, min_train=20, max_train=1000, refit_factor=1.5, verbose=False ):
+        ''' 
+        min_train: minimum number of exact evaluations before the emulator is used
+        max_train: maximum size of the training set. When it is reached, the points where the 
+                    emulator is not accurate enough are still computed exactly, but are not added
+        '''
         
+        SelectionBiasInjections.__init__(self, population, injData, params_inference, get_uncertainty=get_uncertainty)
+        self.tol=tol
+        self.min_train=min_train
+        self.max_train=max_train
+        self.refit_factor=refit_factor
+        self.verbose=verbose
         
+        self._train_X = { id(injData_): [] for injData_ in self.injData }
+        self._train_Y = { id(injData_): [] for injData_ in self.injData }
+        self._gp = { id(injData_): None for injData_ in self.injData }
+        self._n_fitted = { id(injData_): 0 for injData_ in self.injData }
         
+        self._lock = threading.Lock()
+        self.n_exact=0
+        self.n_emulated=0
+        self.n_fits=0
+    
+    
+    def __getstate__(self):
+        # The lock can not be pickled, and the training sets are stored in the order of injData,
+        # since the ids of the injections change in the copy
+        state = self.__dict__.copy()
+        del state['_lock']
+        for key in ('_train_X', '_train_Y', '_gp', '_n_fitted'):
+            state[key] = [ state[key][id(injData_)] for injData_ in self.injData ]
+        return state
+    
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for key in ('_train_X', '_train_Y', '_gp', '_n_fitted'):
+            setattr(self, key, { id(injData_): value for injData_, value in zip(self.injData, state[key]) })
+        self._lock = threading.Lock()
+    
+    
+    def _emulate(self, Lambda_test, injData):
+        '''
+        Returns the prediction of the emulator for (mu, SigmaSq), or None if 
+        the emulator is not trained or not accurate enough at Lambda_test
+        '''
+        gp = self._gp[id(injData)]
+        if gp is None:
+            return None
+        mean, std = gp.predict(Lambda_test)
+        mu, SigmaSq = np.exp(mean[0])
+        sigma_logPost = mu*std[0, 0]
+        if self.get_uncertainty:
+            sigma_logPost += SigmaSq/2*std[0, 1]
+        if sigma_logPost>self.tol:
+            return None
+        return mu, SigmaSq
+    
+    
+    def _add_training_point(self, Lambda_test, injData, mu, SigmaSq):
+        X, Y = self._train_X[id(injData)], self._train_Y[id(injData)]
+        if len(X)>=self.max_train:
+            return
+        X.append(Lambda_test)
+        Y.append([np.log(mu), np.log(SigmaSq)])
+        if len(X)<self.min_train:
+            return
+        gp = self._gp[id(injData)]
+        if gp is not None and len(X)<self.refit_factor*self._n_fitted[id(injData)]:
+            try:
+                gp.add(X[-1], Y[-1])
+                return
+            except np.linalg.LinAlgError:
+                pass
+        if gp is None:
+            gp = self._gp[id(injData)] = utils.GaussianProcess()
+        gp.fit(np.array(X), np.array(Y))
+        self._n_fitted[id(injData)] = len(X)
+        self.n_fits+=1
+        if self.verbose:
+            print('Selection bias emulator trained on %s points' %len(X))
+    
+    
+    def _Ndet(self, Lambda_test, injData, verbose=False, ):
+        
+        Lambda_test = np.atleast_1d(Lambda_test).astype(float)
+        
+        with self._lock:
+            pred = self._emulate(Lambda_test, injData)
+            if pred is not None:
+                self.n_emulated+=1
+            else:
+                self.n_exact+=1
+        if pred is not None:
+            mu, SigmaSq = pred
+            if not self.get_uncertainty:
+                return mu, 0, mu**2/SigmaSq
+            return mu, self._error_term(mu, SigmaSq), mu**2/SigmaSq
+        
+        # Fall back to the exact sum over the injections
+        mu, error, Neff = SelectionBiasInjections._Ndet(self, Lambda_test, injData, verbose=verbose)
+        if mu>0 and 0<Neff<np.inf:
+            with self._lock:
+                self._add_training_point(Lambda_test, injData, mu, mu**2/Neff)
+        return mu, error, Neff
+
+
+
+
+class SelectionBiasSubsampled(SelectionBiasInjections):
+    
+    '''
+    Selection effects computed with injections, as in SelectionBiasInjections, 
+    but evaluated first on random subsets of the detected injections of increasing size.
+    
+    fractions is the list of the sizes of the subsets, as fractions of the detected injections. 
+    The subsets are nested (they are the first elements of the same random permutation), 
+    and the full set is always used as last level. 
+    On a subset of n_sub out of n_det detected injections, mu is estimated with 
+    N_gen*n_sub/n_det generated injections.
+    
+    The result of a level is accepted if 
+        Neff >= Neff_margin*Neff_min , 
+    where Neff_min is the minimum number of effective samples required 
+    by the posterior ( bias_safety_factor*Nobs, see Posterior ), and, if max_sigma is not None, if 
+        sqrt(SigmaSq*fraction) <= max_sigma .
+    Since the MC uncertainty scales as 1/sqrt(n_sub), sqrt(SigmaSq*fraction) is the absolute uncertainty 
+    on mu (and so on the log likelihood) that the full set is expected to have at the same point, 
+    so max_sigma is the precision required for the full set. 
+    Otherwise the next level is used. 
+    The last level used for each dataset is stored in last_levels, 
+    and the number of times each level has been used in level_counts. 
+    These are updated under a lock, since the datasets can be evaluated on different threads (see Posterior).
+    '''
+    
+    def __init__(self, population, injData, params_inference, get_uncertainty=True, 
+                 fractions=(0.1, ), Neff_margin=2., max_sigma=None, seed=None, verbose=False ):
+        
+        self.fractions = sorted(f for f in fractions if 0<f<1)+[1.]
+        self.Neff_margin=Neff_margin
+        self.max_sigma=max_sigma
+        self.verbose=verbose
+        
+        rng = np.random.default_rng(seed)
+        self._subsets = {}
+        for injData_ in injData:
+            perm = rng.permutation(len(injData_.m1z))
+            self._subsets[id(injData_)] = [ self._get_subset(injData_, perm[:max(int(f*len(perm)), 1)]) for f in self.fractions[:-1] ]+[injData_]
+        
+        # This also pre-computes the cosmological terms of the subsets if the cosmology is fixed
+        SelectionBiasInjections.__init__(self, population, injData, params_inference, get_uncertainty=get_uncertainty)
+        if self.fixed_cosmo:
+            for injData_ in self.injData:
+                for sub in self._subsets[id(injData_)][:-1]:
+                    self._fixed_cosmo(sub)
+        
+        self._lock = threading.Lock()
+        self.last_levels = [ None for _ in self.injData ]
+        self.level_counts = np.zeros(len(self.fractions), dtype=int)
+    
+    
+    def __getstate__(self):
+        # The lock can not be pickled, and the subsets are stored in the order of injData,
+        # since the ids of the injections change in the copy
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_subsets'] = [ self._subsets[id(injData_)] for injData_ in self.injData ]
+        return state
+    
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._subsets = { id(injData_): subsets for injData_, subsets in zip(self.injData, state['_subsets']) }
+        self._lock = threading.Lock()
+    
+    
+    def _get_subset(self, injData, idx):
+        '''
+        Copy of injData containing only the injections idx
+        '''
+        sub = copy.copy(injData)
+        sub.m1z = injData.m1z[idx]
+        sub.m2z = injData.m2z[idx]
+        sub.dL = injData.dL[idx]
+        sub.spins = [ s[idx] for s in injData.spins ]
+        sub.log_weights_sel = injData.log_weights_sel[idx]
+        sub.logN_gen = injData.logN_gen+np.log(len(idx)/len(injData.m1z))
+        return sub
+    
+    
+    def _accept(self, mu, Neff, Neff_min, fraction):
+        if Neff_min is not None and Neff < self.Neff_margin*Neff_min:
+            return False
+        if self.max_sigma is not None and mu*np.sqrt(fraction/Neff) > self.max_sigma:
+            return False
+        return True
+    
+    
+    def _Ndet_levels(self, Lambda_test, i, verbose=False):
+        '''
+        Selection effects for the i-th dataset, going through the subsets until the result is accepted
+        '''
+        injData_ = self.injData[i]
+        Neff_min = None if self.Neff_min is None else self.Neff_min[i]
+        for level, sub in enumerate(self._subsets[id(injData_)]):
+            mu_, err_, Neff_ = self._Ndet(Lambda_test, sub, verbose=verbose, )
+            if level==len(self.fractions)-1 or self._accept(mu_, Neff_, Neff_min, self.fractions[level]):
+                break
+        if self.verbose:
+            print('Selection bias for dataset %s computed with %s of the injections. Neff = %s' %(i, self.fractions[level], Neff_))
+        with self._lock:
+            self.last_levels[i] = level
+            self.level_counts[level] += 1
+        return mu_, err_, Neff_
+    
+    
+    def Ndet(self, Lambda_test, verbose=False, executor=None):
+        
+        if executor is not None:
+            res = list(executor.map(lambda i: self._Ndet_levels(Lambda_test, i, verbose=verbose), range(len(self.injData))))
+        else:
+            res = [ self._Ndet_levels(Lambda_test, i, verbose=verbose) for i in range(len(self.injData)) ]
+        return [r[0] for r in res], [r[1] for r in res], [r[2] for r in res]
+
+
+
+
+class DetectionGrid(object):
+    
+    '''
+    Detection probability tabulated on a grid in detector-frame masses and luminosity distance,
+    with the quadrature weights of the grid. 
+    Has the same attributes as a Data object containing injections (see SelectionBiasInjections), 
+    so that the integral of the population over the grid has the same form as the Monte Carlo sum:
+        
+        m1z, m2z, dL: grid points (only points with p_det>pdet_min are kept)
+        log_weights_sel: - log ( p_det * quadrature weight )
+        logN_gen = 0
+    
+    The detection model is the same used to generate mock data and injections 
+    with Observations (see mock/observePopulation.py): the observed SNR is the network SNR 
+    plus a gaussian noise of unit variance, conditioned to be positive, and an event 
+    is detected if it is above the threshold observations.rho_th. 
+    The average over sky position, inclination, time of arrival and duty cycle 
+    is done with n_angles Monte Carlo draws, summarised by n_quantiles quantiles 
+    of the distribution of the SNR at fixed masses.
+    
+    The integral is done with the midpoint rule in log(m1z), log(m2z/m1z) and dL, 
+    so the accuracy is controlled by the number of points of the grid (shape). 
+    m_range is the range of detector-frame masses; by default, the range 
+    of the SNR interpolation of the detectors. 
+    dL_max is the maximum luminosity distance, by default the one corresponding to observations.zmax. 
+    Distances are in units of the cosmology.
+    '''
+    
+    def __init__(self, observations, Tobs, m_range=None, dL_max=None, shape=(60, 60, 60), 
+                 n_angles=10000, n_quantiles=200, pdet_min=1e-08, seed=1312, chunk_size=500, verbose=True):
+        
+        self.Tobs=Tobs
+        self.rho_th = observations.rho_th
+        detectors = list(observations.detNet.get_detectors().values())
+        cosmo = observations.allPops.cosmo
+        
+        if m_range is None:
+            m_range = ( max(det.mmin for det in detectors), min(det.mmax for det in detectors) )
+        if dL_max is None:
+            dL_max = cosmo.dLGW(observations.zmax, observations.H0base, observations.Om0Base, observations.w0Base, observations.Xi0Base, observations.nBase)
+        # SNRs are computed with distances in Gpc
+        to_Gpc = 1e-03/cosmo.Mpc_to_dist_unit
+        
+        # Midpoint rule in log(m1z), log(q=m2z/m1z) and dL. 
+        # The density is discontinuous at m2z=m1z, so q=1 is taken as the boundary of the last cell
+        nm1, nq, ndL = shape
+        logm1, dlogm1 = self._midpoints(np.log(m_range[0]), np.log(m_range[1]), nm1)
+        logq, dlogq = self._midpoints(np.log(m_range[0])-logm1, 0., nq)
+        dLgrid, ddL = self._midpoints(0., dL_max, ndL)
+        
+        m1 = np.repeat(np.exp(logm1), nq)
+        m2 = np.exp(logm1[:, None]+logq).flatten()
+        logw = np.repeat(np.log(dlogm1*dlogq), nq)+np.log(m1)+np.log(m2)
+        
+        if verbose:
+            print('Computing detection probability on %s points in (m1z, m2z) and %s points in dL with %s detectors...' %(len(m1), ndL, len(detectors)))
+        Qsq = self._get_Qsq(detectors, n_angles, seed)
+        
+        logpdet = np.empty((len(m1), ndL))
+        qs = (np.arange(n_quantiles)+0.5)/n_quantiles
+        for i in range(0, len(m1), chunk_size):
+            sl = slice(i, i+chunk_size)
+            # optimal SNRs at 1 Gpc, shape (n_detectors, chunk_size)
+            A = np.array([ det.get_oSNR(m1[sl], m2[sl], np.ones(m1[sl].shape)) for det in detectors ])
+            SNR1Gpc = np.sqrt( np.einsum('dn,da->na', A**2, Qsq) )
+            SNR1Gpc = np.quantile(SNR1Gpc, qs, axis=1).T
+            SNR = SNR1Gpc[:, None, :]/(dLgrid[None, :, None]*to_Gpc)
+            logpdet[sl] = np.log( np.mean( ndtr(SNR-self.rho_th)/ndtr(SNR), axis=-1) )
+        
+        logw = logw[:, None]+np.log(ddL)
+        keep = logpdet>np.log(pdet_min)
+        self.m1z = np.broadcast_to(m1[:, None], logpdet.shape)[keep]
+        self.m2z = np.broadcast_to(m2[:, None], logpdet.shape)[keep]
+        self.dL = np.broadcast_to(dLgrid[None, :], logpdet.shape)[keep]
+        self.log_weights_sel = -(logpdet+logw)[keep]
+        self.logN_gen = 0.
+        self.spins = []
+        if verbose:
+            print('Kept %s grid points with p_det>%s' %(keep.sum(), pdet_min))
+    
+    
+    def _midpoints(self, a, b, n):
+        '''
+        Centers and width of n equal cells between a and b. 
+        a can be an array, in which case the cells are along a new last axis
+        '''
+        h = (b-a)/n
+        x = np.asarray(a)[..., None]+(np.arange(n)+0.5)*np.asarray(h)[..., None]
+        return x, h
+    
+    
+    def _get_Qsq(self, detectors, n_angles, seed):
+        '''
+        Projection factors of each detector for isotropic sky position and inclination,
+        uniform time of arrival, including the duty cycle. Shape (n_detectors, n_angles)
+        '''
+        rng = np.random.default_rng(seed)
+        costhetas = 1.-2.*rng.uniform(size=n_angles)
+        phis = 2.*np.pi*rng.uniform(size=n_angles)
+        cosiotas = 1.-2.*rng.uniform(size=n_angles)
+        ts_det = rng.uniform(size=n_angles)
+        
+        Qsq=[]
+        for det in detectors:
+            costhetaD, phiD = det._equat2detector(costhetas, phis, ts_det)
+            on = rng.uniform(size=n_angles)<det.duty_cycle
+            Qsq.append(det._Qsq(costhetaD, phiD, cosiotas)*on)
+        return np.array(Qsq)
+
+
+
+
+class SelectionBiasGrid(SelectionBiasInjections):
+    
+    '''
+    Selection effects computed by deterministic quadrature of the population 
+    over a grid of detection probabilities (see DetectionGrid), instead of Monte Carlo injections. 
+    There is no Monte Carlo uncertainty, so the error term is zero and Neff is infinite.
+    
+    Usage:
+        
+        sb = SelectionBiasGrid(population, [observations_O3a, ...], params_inference, Tobs=[Tobs_O3a, ...], grid_args={} )
+    
+    where observations are objects of type Observations (see mock/observePopulation.py) 
+    describing the detector network and threshold of each dataset, 
+    and grid_args are passed to DetectionGrid. 
+    
+    The spins are not included in the detection probability, 
+    so only populations with DummySpinDist are supported.
+    '''
+    
+    def __init__(self, population, observations, params_inference, Tobs, grid_args={} ):
+        
+        for pop in population._pops:
+            if pop.spinDist.__class__.__name__ !='DummySpinDist':
+                raise ValueError('SelectionBiasGrid only supports populations with DummySpinDist')
+        
+        grids = [ DetectionGrid(obs, Tobs_, **grid_args) for obs, Tobs_ in zip(observations, Tobs) ]
+        SelectionBiasInjections.__init__(self, population, grids, params_inference, get_uncertainty=False)
+    
+    
+    def _Ndet_from_logdN(self, logdN, injData, Lambda):
+        
+        mu = np.exp(np.logaddexp.reduce(logdN, axis=-1) - injData.logN_gen)
+        if np.any(np.isnan(mu)):
+            raise ValueError('NaN value for logMu. Values of Lambda: %s' %( str(Lambda) ) )
+        
+        return mu, 0, np.full(np.shape(mu), np.inf)[()]
+
+
+
+
+class SelectionBiasControlVariate(SelectionBiasInjections):
+    
+    '''
+    Selection effects computed with injections, with a control variate to reduce the variance 
+    of the Monte Carlo estimate of mu.
+    
+    The control variate is the weight of each generated injection for a fiducial population Lambda_fid, 
+    g_i = dN/dm1z dm2z ddL (Lambda_fid) / p_draw, irrespective of whether the injection is detected. 
+    Its expectation is known without Monte Carlo: since the mass and spin distributions are normalized, 
+    it is the number of events of the fiducial population in the redshift range of the draws, 
+    
+        mu_g = Tobs int_{z_range} R(z) dV/dz / (1+z) dz , 
+    
+    computed by quadrature. This requires the draws to cover the support of the mass distribution 
+    of the fiducial population. 
+    With f_i the weights for Lambda (zero for undetected injections), the estimate is
+    
+        mu = <f> - c ( <g> - mu_g ) ,   c = Cov(f, g) / Var(g) , 
+    
+    where averages are over the generated injections, with variance 
+    
+        SigmaSq = ( Var(f) - Cov(f, g)^2 / Var(g) ) / N_gen . 
+    
+    The variance is reduced by a factor 1-corr(f, g)^2 with respect to the usual estimate. 
+    The gain is largest for Lambda close to Lambda_fid and when most of the injections are detected: 
+    g does not know which injections are detected, so the scatter of f due to detection 
+    (of order Var(f) times the undetected fraction) is not removed. 
+    The error term and Neff = mu^2/SigmaSq are computed from this variance. 
+    
+    The sums of g over all generated injections are computed once here, 
+    so each evaluation only uses the detected injections, as SelectionBiasInjections. 
+    allInjData is a list with one object for each dataset, with the same attributes as injData 
+    but containing all the generated injections (e.g. a Data object before _apply_condition). 
+    z_range is the range of redshifts of the draws (for the base values of the cosmological parameters).
+    Lambda_fid is the list of values of all the parameters of the population (by default, the base values). 
+    '''
+    
+    def __init__(self, population, injData, params_inference, allInjData, z_range, Lambda_fid=None, get_uncertainty=True ):
+        
+        SelectionBiasInjections.__init__(self, population, injData, params_inference, get_uncertainty=get_uncertainty)
+        
+        if Lambda_fid is None:
+            Lambda_fid = self.population.get_base_values(self.population.params)
+        self.Lambda_fid = np.array(Lambda_fid)
+        self.z_range = z_range
+        
+        # For each dataset: log of the weights of the detected injections for the fiducial population, 
+        # and moments of the control variate over all the generated injections
+        self._log_g = {}
+        self._g_moments = {}
+        for injData_, allInjData_ in zip(self.injData, allInjData):
+            self._log_g[id(injData_)] = self._log_weights_fid(injData_)
+            log_g = self._log_weights_fid(allInjData_)
+            logg0 = np.max(log_g)
+            g = np.exp(log_g-logg0)
+            N = np.exp(injData_.logN_gen)
+            if len(g)!=int(round(N)):
+                raise ValueError('allInjData should contain all the %s generated injections. Got %s' %(int(round(N)), len(g)))
+            mean_g = g.sum()/N
+            var_g = (g**2).sum()/N-mean_g**2
+            mu_g = np.exp(self._log_mu_fid(self._getTobs(injData_))-logg0)
+            self._g_moments[id(injData_)] = (logg0, mean_g, var_g, mu_g)
+    
+    
+    def _log_weights_fid(self, injData):
+        m1, m2, z = self._get_mass_redshift(self.Lambda_fid, injData)
+        return self.population.log_dN_dm1zdm2zddL(m1, m2, z, self._getSpins(injData), self._getTobs(injData), self.Lambda_fid, dL=injData.dL)-injData.log_weights_sel
+    
+    
+    def _log_mu_fid(self, Tobs):
+        '''
+        log of the expected number of events of the fiducial population in z_range, 
+        summed over the populations
+        '''
+        LambdaCosmo, LambdaAllPop = self.population._split_params(self.Lambda_fid)
+        H0, Om0, w0 = self.population.cosmo._get_values(LambdaCosmo, ['H0', 'Om', 'w0'])
+        logN = []
+        prev=0
+        for i, pop in enumerate(self.population._pops):
+            lambdaBBHrate, _, _ = pop._split_lambdas(LambdaAllPop[prev:prev+self.population._allNParams[i]])
+            prev=self.population._allNParams[i]
+            logN.append( utils.log_quad(lambda z: self.population.logdN_dz(z, H0, Om0, w0, lambdaBBHrate, pop), *self.z_range, rtol=1e-10) )
+        return np.logaddexp.reduce(logN)+np.log(Tobs)
+    
+    
+    def _Ndet_from_logdN(self, logdN, injData, Lambda):
+        
+        N = np.exp(injData.logN_gen)
+        log_g = self._log_g[id(injData)]
+        logg0, mean_g, var_g, mu_g = self._g_moments[id(injData)]
+        
+        # Rescale the weights to avoid overflows
+        logf0 = np.max(logdN, axis=-1, keepdims=True)
+        f = np.exp(logdN-logf0)
+        g = np.exp(log_g-logg0)
+        
+        # f is zero for the undetected injections
+        mean_f = f.sum(axis=-1)/N
+        var_f = (f**2).sum(axis=-1)/N-mean_f**2
+        cov = (f*g).sum(axis=-1)/N-mean_f*mean_g
+        
+        c = cov/var_g
+        mu = mean_f - c*(mean_g - mu_g)
+        # residual variance, set to zero when it is at the level of the roundoff errors
+        SigmaSq = var_f-cov**2/var_g
+        SigmaSq = np.where(SigmaSq > 1e-12*var_f, SigmaSq, 0.)/N
+        
+        scale = np.exp(logf0[..., 0])
+        mu, SigmaSq = mu*scale, SigmaSq*scale**2
+        
+        if np.any(np.isnan(mu)):
+            raise ValueError('NaN value for mu. Values of Lambda: %s' %( str(Lambda) ) )
+        
+        # If f is a multiple of g the estimate is exact: SigmaSq=0, Neff is infinite and there is no error term
+        exact = SigmaSq==0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            Neff = np.where(exact, np.inf, mu**2/SigmaSq)[()]
+            if not self.get_uncertainty:
+                return mu, 0, Neff
+            error = np.where(exact, 0., self._error_term(mu, SigmaSq))[()]
+        
+        return mu, error, Neff
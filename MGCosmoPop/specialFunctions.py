@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+#    Copyright (c) 2021 Michele Mancarella <michele.mancarella@unige.ch>
+#
+#    All rights reserved. Use of this source code is governed by a modified BSD
+#    license that can be found in the LICENSE file.
+
+'''
+Log-space cdf and survival functions of the normal distribution, used in the likelihood, 
+and log integrals of power laws, used in the normalization of the mass functions.
+
+They act directly on numpy arrays, without creating scipy.stats distribution objects,
+and are based on scipy.special.log_ndtr, so they remain accurate in the tails,
+where log(cdf) or log(1-cdf) would give -inf or lose precision.
+
+Run this file to compare with the scipy.stats implementation.
+'''
+
+import numpy as np
+from scipy.special import log_ndtr
+
+
+def norm_logcdf(x, loc=0., scale=1.):
+    '''
+    log of the cdf of a normal distribution. Same as scipy.stats.norm(loc, scale).logcdf(x)
+    '''
+    return log_ndtr((x-loc)/scale)
+
+
+def norm_logsf(x, loc=0., scale=1.):
+    '''
+    log of the survival function (1-cdf) of a normal distribution. Same as scipy.stats.norm(loc, scale).logsf(x)
+    '''
+    return log_ndtr((loc-x)/scale)
+
+
+def log_diff_ndtr(a, b):
+    '''
+    log( Phi(b) - Phi(a) ) for b>a, with Phi the standard normal cdf.
+    For a>0 the difference of the survival functions is used, so that both tails are accurate
+    '''
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=float), np.asarray(b, dtype=float))
+    upper = a>0
+    # upper tail: Phi(b) - Phi(a) = Phi(-a) - Phi(-b)
+    hi = log_ndtr(np.where(upper, -a, b))
+    lo = log_ndtr(np.where(upper, -b, a))
+    return (hi + np.log1p(-np.exp(lo-hi)))[()]
+
+
+def trunc_norm_lognorm(mu, sigma, lower, upper):
+    '''
+    log of the probability of a normal distribution N(mu, sigma) in the interval (lower, upper),
+    i.e. the log normalization of the truncated normal
+    '''
+    return log_diff_ndtr((lower-mu)/sigma, (upper-mu)/sigma)
+
+
+def log_smooth_window(m, ml, sl, mh, sh):
+    '''
+    log of Phi( log(m/ml)/sl ) * ( 1 - Phi( log(m/mh)/sh ) ) ,
+    a window function with smooth lower and upper cutoffs at ml and mh
+    '''
+    logm = np.log(m)
+    return log_ndtr((logm-np.log(ml))/sl) + log_ndtr((np.log(mh)-logm)/sh)
+
+
+def log_powerlaw_integral(gamma, a, b):
+    '''
+    log of the integral of x**gamma between a and b, for 0<a<=b. 
+    Written in terms of expm1, so that it is accurate for gamma close to -1 and for b close to a
+    '''
+    logx = np.log(b/a)
+    if np.abs(gamma+1)>1e-10:
+        return (gamma+1)*np.log(a)+np.log(np.expm1((gamma+1)*logx)/(gamma+1))
+    return np.log(logx)
+
+
+
+if __name__=='__main__':
+
+    import time
+    import scipy.stats as ss
+    from scipy.special import erfc
+
+    def bench(f, n=10):
+        f()
+        t=time.time()
+        for _ in range(n):
+            res = f()
+        return res, (time.time()-t)/n
+
+    rng = np.random.default_rng(1312)
+    N = int(1e06)
+
+    print('Smooth window on %s points:' %N)
+    m = np.exp(rng.uniform(np.log(1.), np.log(200.), N))
+    old, t_old = bench(lambda: np.log(ss.norm().cdf((np.log(m)-np.log(5.))/0.1))+np.log((1-ss.norm().cdf((np.log(m)-np.log(45.))/0.1))) )
+    new, t_new = bench(lambda: log_smooth_window(m, 5., 0.1, 45., 0.1) )
+    fin = np.isfinite(old)
+    print('scipy.stats: %.2e s, specialFunctions: %.2e s. Max abs difference where finite: %s. Points that were -inf: %s, now finite: %s' %(t_old, t_new, np.max(np.abs(old-new)[fin]), (~fin).sum(), np.isfinite(new[~fin]).sum() ))
+
+    print('Error term of the selection effects on %s points:' %N)
+    mu = rng.uniform(1, 500, N)
+    SigmaSq = mu**2/rng.uniform(10, 1000, N)
+    Sigma = np.sqrt(SigmaSq)
+    old, t_old = bench(lambda: ss.norm(loc=mu-SigmaSq, scale=Sigma).logsf(0)-ss.norm(loc=mu, scale=Sigma ).logsf(0) )
+    new, t_new = bench(lambda: norm_logsf(0, loc=mu-SigmaSq, scale=Sigma)-norm_logsf(0, loc=mu, scale=Sigma) )
+    print('scipy.stats: %.2e s, specialFunctions: %.2e s. Max abs difference: %s' %(t_old, t_new, np.max(np.abs(old-new))))
+
+    print('Truncated gaussian normalization on %s points:' %N)
+    mu = rng.uniform(-1, 1, N)
+    sigma = rng.uniform(0.01, 1, N)
+    old, t_old = bench(lambda: np.log(0.5*erfc(-(1-mu)/(np.sqrt(2)*sigma))-0.5*erfc(-(-1-mu)/(np.sqrt(2)*sigma))) )
+    new, t_new = bench(lambda: trunc_norm_lognorm(mu, sigma, -1, 1) )
+    print('erfc: %.2e s, specialFunctions: %.2e s. Max abs difference: %s' %(t_old, t_new, np.max(np.abs(old-new))))
+
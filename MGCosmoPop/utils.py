@@ -4,8 +4,12 @@
 #    license that can be found in the LICENSE file.
 
 import sys
+import threading
 import requests
 import numpy as np
+from collections import OrderedDict
+from scipy.interpolate import BSpline, make_interp_spline
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
 
 
 def logdiffexp(x, y):
@@ -15,6 +19,417 @@ def logdiffexp(x, y):
     return x + np.log1p(-np.exp(y-x))
 
 
+
+######################
+# INTERPOLATION
+######################
+
+
+class TensorSpline(object):
+    '''
+    Tensor-product spline interpolant of a function tabulated on a regular 
+    (not necessarily uniform) grid.
+    The coefficients are computed once, by fitting an interpolating spline of order k
+    along each axis in turn. Evaluation at a point only involves the k+1 non-zero 
+    basis functions along each axis.
+    
+    Usage:
+        
+        spl = TensorSpline([x0, x1, x2], values) # values.shape = (len(x0), len(x1), len(x2))
+        
+        spl(a, b, x2new) 
+    
+    where a, b are scalars and x2new can be an array. 
+    Points outside the grid are returned as nan.
+    '''
+    
+    def __init__(self, axes, values, k=3):
+        
+        self.k=k
+        self.axes = [np.asarray(x) for x in axes]
+        self.knots = []
+        c = np.asarray(values)
+        for x in self.axes:
+            # fit along the first axis, then move it to the end.
+            # After looping over all axes, the original order is restored
+            spl = make_interp_spline(x, c, k=k, axis=0)
+            self.knots.append(spl.t)
+            c = np.moveaxis(spl.c, 0, -1)
+        self.coeffs = c
+    
+    
+    def __call__(self, *x):
+        '''
+        All arguments but the last should be scalars. The last can be an array.
+        '''
+        c = self.coeffs
+        for t, xi in zip(self.knots[:-1], x[:-1]):
+            c = self._eval_scalar(t, c, xi)
+        return BSpline(self.knots[-1], c, self.k, extrapolate=False)(x[-1])
+    
+    
+    def _eval_scalar(self, t, c, xi):
+        '''
+        Evaluates the spline with knots t and coefficients c along the first axis at the scalar xi, 
+        using only the k+1 coefficients that are non-zero there, 
+        so that the full array of coefficients is not copied
+        '''
+        k=self.k
+        if not (t[k] <= xi <= t[-k-1]):
+            return np.full(c.shape[1:], np.nan)
+        i = min(max(np.searchsorted(t, xi, side='right')-1, k), len(t)-k-2)
+        return BSpline(t[i-k:i+k+2], c[i-k:i+1], k, extrapolate=False, axis=0)(xi)
+    
+    
+    def bounds(self):
+        return [ (x[0], x[-1]) for x in self.axes]
+
+
+
+######################
+# QUADRATURE
+######################
+
+# Nodes and weights of the 15-point Kronrod rule on [-1, 1], and weights of the embedded 7-point Gauss rule
+_XGK15 = np.array([0.991455371120812639206854697526329, 0.949107912342758524526189684047851,
+                   0.864864423359769072789712788640926, 0.741531185599394439863864773280788,
+                   0.586087235467691130294144845693013, 0.405845151377397166906606412076961,
+                   0.207784955007898467600689403773245, 0.])
+_WGK15 = np.array([0.022935322010529224963732008058970, 0.063092092629978553290700663189204,
+                   0.104790010322250183839876322541518, 0.140653259715525918745189590510238,
+                   0.169004726639267902826583426598550, 0.190350578064785409913256402421014,
+                   0.204432940075298892414161999234649, 0.209482141084727828012999174891714])
+_WG7 = np.array([0., 0.129484966168869693270611432679082, 0., 0.279705391489276667901467771423780,
+                 0., 0.381830050505118944950369775488975, 0., 0.417959183673469387755102040816327])
+_XGK15 = np.concatenate([-_XGK15, _XGK15[-2::-1]])
+_WGK15 = np.concatenate([_WGK15, _WGK15[-2::-1]])
+_WG7 = np.concatenate([_WG7, _WG7[-2::-1]])
+
+
+def _log_gk15(logf, lo, hi):
+    '''
+    Gauss-Kronrod G7-K15 rule on each of the intervals (lo, hi), in a single call to logf. 
+    Returns the log of the integral and the log of the error estimate |K15-G7|.
+    '''
+    h = (hi-lo)/2
+    x = ((lo+hi)/2)[:, None]+h[:, None]*_XGK15[None, :]
+    logfx = logf(x)
+    mx = np.max(logfx, axis=1)
+    mx = np.where(np.isfinite(mx), mx, 0.)
+    fx = np.exp(logfx-mx[:, None])
+    with np.errstate(divide='ignore'):
+        logK = np.log( (fx*_WGK15).sum(axis=1)*h )+mx
+        logErr = np.log( np.abs(((_WGK15-_WG7)*fx).sum(axis=1))*h )+mx
+    return logK, logErr
+
+
+def log_quad(logf, a, b, breakpoints=(), rtol=1e-08, n_init=1, max_iter=50, verbose=False):
+    '''
+    log of the integrals of exp(logf(x)) between a and b, with adaptive Gauss-Kronrod (G7-K15) quadrature. 
+    Working with the log of the integrand avoids overflows and underflows.
+    
+    a, b can be arrays: all the integrals are computed at the same time, and logf is called 
+    once per iteration on the nodes of all the intervals that still need to be refined. 
+    logf should accept arrays of any shape.
+    
+    The range of each integral is first split at the breakpoints that fall inside it 
+    (points where the integrand is not smooth, e.g. the edges of its support), and each piece in n_init intervals. 
+    At each iteration, for the integrals where the estimated error is larger than rtol times the integral, 
+    the intervals with more than their share of the error are bisected, up to max_iter times.
+    
+    Returns an array with the shape of a and b broadcast together.
+    '''
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=float), np.asarray(b, dtype=float))
+    shape = a.shape
+    a, b = a.ravel(), b.ravel()
+    n = len(a)
+    
+    bps = np.sort(np.asarray(breakpoints, dtype=float).ravel())
+    edges = np.concatenate([a[:, None], np.clip(bps[None, :], a[:, None], b[:, None]), b[:, None]], axis=1)
+    frac = np.arange(n_init+1)/n_init
+    edges = (edges[:, :-1, None]+(edges[:, 1:]-edges[:, :-1])[:, :, None]*frac).reshape(n, -1)
+    lo, hi = edges[:, :-1].ravel(), edges[:, 1:].ravel()
+    owner = np.repeat(np.arange(n), edges.shape[1]-1)
+    keep = hi>lo
+    lo, hi, owner = lo[keep], hi[keep], owner[keep]
+    
+    logK, logErr = _log_gk15(logf, lo, hi)
+    logrtol = np.log(rtol)
+    for it in range(max_iter+1):
+        logI, logE = np.full(n, -np.inf), np.full(n, -np.inf)
+        np.logaddexp.at(logI, owner, logK)
+        np.logaddexp.at(logE, owner, logErr)
+        todo = logE > logI+logrtol
+        if not todo.any():
+            break
+        if it==max_iter:
+            print('log_quad: %s integrals did not reach rtol=%s after %s iterations. Max relative error: %s' %(todo.sum(), rtol, max_iter, np.exp(np.max(logE[todo]-logI[todo]))))
+            break
+        nInt = np.bincount(owner, minlength=n)
+        refine = todo[owner] & (logErr >= logI[owner]+logrtol-np.log(nInt[owner]))
+        mid = (lo[refine]+hi[refine])/2
+        newLo = np.concatenate([lo[refine], mid])
+        newHi = np.concatenate([mid, hi[refine]])
+        newLogK, newLogErr = _log_gk15(logf, newLo, newHi)
+        lo, hi = np.concatenate([lo[~refine], newLo]), np.concatenate([hi[~refine], newHi])
+        logK, logErr = np.concatenate([logK[~refine], newLogK]), np.concatenate([logErr[~refine], newLogErr])
+        owner = np.concatenate([owner[~refine], np.tile(owner[refine], 2)])
+    
+    if verbose:
+        print('log_quad: %s intervals after %s iterations' %(len(lo), it))
+    
+    return logI.reshape(shape)[()]
+
+
+
+######################
+# SAMPLING
+######################
+
+
+class InverseCDFSampler(object):
+    '''
+    Inverse-cdf sampler for a one-dimensional pdf, tabulated once on a uniform grid of res points 
+    between lower and upper. The cdf is the integral of the piecewise linear interpolant of the pdf. 
+    
+    A guide table gives, for each of guide_factor*res equal intervals in probability, 
+    the first grid interval that can contain the result. The inverse cdf is then found in 
+    O(1) operations per sample on average, instead of a binary search.
+    
+    Usage:
+        
+        sampler = InverseCDFSampler(pdf, lower, upper)
+        
+        x = sampler.sample(nSamples)
+        
+        y = sampler.sample_upper(x) # samples from the same pdf truncated at the values x
+    
+    The pdf does not need to be normalized.
+    '''
+    
+    def __init__(self, pdf, lower, upper, res=100000, guide_factor=4):
+        self.lower, self.upper, self.res = lower, upper, res
+        self.x = np.linspace(lower, upper, res)
+        self.dx = self.x[1]-self.x[0]
+        p = pdf(self.x)
+        cdf = np.concatenate([ [0.], np.cumsum((p[1:]+p[:-1])/2) ])
+        self.cdf = cdf/cdf[-1]
+        self.n_guide = guide_factor*res
+        self.guide = np.clip(np.searchsorted(self.cdf, np.arange(self.n_guide+1)/self.n_guide, side='right')-1, 0, res-2)
+    
+    
+    def cdf_at(self, x):
+        t = np.clip((x-self.lower)/self.dx, 0, self.res-1)
+        k = np.minimum(t.astype(int), self.res-2)
+        return self.cdf[k]+(t-k)*(self.cdf[k+1]-self.cdf[k])
+    
+    
+    def ppf(self, u, n_steps=3):
+        '''
+        Inverse of the cdf, for u in [0, 1). 
+        The grid interval is found starting from the guide table and moving forward at most n_steps times; 
+        binary search is used only for the values of u still not located after that.
+        '''
+        j = np.minimum((u*self.n_guide).astype(int), self.n_guide-1)
+        k, kmax = self.guide[j], self.guide[j+1]
+        for _ in range(n_steps):
+            k = k+( (k<kmax) & (self.cdf[k+1] <= u) )
+        left = (k<kmax) & (self.cdf[k+1] <= u)
+        if left.any():
+            k[left] = np.clip(np.searchsorted(self.cdf, u[left], side='right')-1, 0, self.res-2)
+        dc = self.cdf[k+1]-self.cdf[k]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(dc>0, (u-self.cdf[k])/dc, 0.)
+        return self.x[k]+frac*self.dx
+    
+    
+    def sample(self, nSamples):
+        return self.ppf(np.random.uniform(size=nSamples))
+    
+    
+    def sample_upper(self, upper):
+        '''
+        One sample for each value in upper, from the pdf truncated at that value
+        '''
+        return self.ppf(np.random.uniform(size=len(upper))*self.cdf_at(upper))
+
+
+
+######################
+# CACHING
+######################
+
+
+class LRUCache(object):
+    '''
+    Dictionary with bounded size. When full, the least recently used item is discarded.
+    Can be shared between threads.
+    
+    Usage:
+        
+        cache = LRUCache(maxsize=32)
+        
+        value = cache.get(key, compute) 
+        
+    returns the value stored for key, or calls compute() and stores the result if key is not present.
+    '''
+    
+    def __init__(self, maxsize=128):
+        self.maxsize=maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits=0
+        self.misses=0
+    
+    
+    def get(self, key, compute):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits+=1
+                return self._data[key]
+        
+        value = compute()
+        
+        with self._lock:
+            self.misses+=1
+            self._data[key] = value
+            while len(self._data)>self.maxsize:
+                self._data.popitem(last=False)
+        return value
+    
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    
+    def __len__(self):
+        return len(self._data)
+    
+    
+    def __contains__(self, key):
+        return key in self._data
+    
+    
+    def __getstate__(self):
+        # The lock can not be pickled (e.g. with multiprocessing). The cache is not copied
+        state = self.__dict__.copy()
+        state['_data'] = OrderedDict()
+        del state['_lock']
+        return state
+    
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+
+######################
+# REGRESSION
+######################
+
+
+class GaussianProcess(object):
+    '''
+    Gaussian-process regression with squared-exponential kernel and constant mean.
+    Several outputs sharing the same training inputs can be fitted at once.
+    
+    The length scale along each input dimension is chosen among length_factors times 
+    the standard deviation of the training inputs, by maximising the marginal likelihood.
+    The amplitude of the kernel is the variance of the training outputs.
+    
+    Usage:
+        
+        gp = GaussianProcess()
+        gp.fit(X, Y) # X.shape = (n_train, n_dim), Y.shape = (n_train, n_out)
+        
+        mean, std = gp.predict(x) # x.shape = (n_points, n_dim), mean.shape=std.shape=(n_points, n_out)
+    
+    New training points can be added with gp.add(x, y) without re-optimising the length scales. 
+    '''
+    
+    def __init__(self, length_factors=(0.25, 0.5, 1., 2.), nugget=1e-08):
+        self.length_factors=length_factors
+        self.nugget=nugget
+    
+    
+    def _kernel(self, X1, X2):
+        d = (X1[:, None, :]-X2[None, :, :])/self.length_scales
+        return np.exp(-0.5*np.sum(d**2, axis=-1))
+    
+    
+    def _solve(self, X, Y):
+        K = self._kernel(X, X)+self.nugget*np.eye(len(X))
+        L = cho_factor(K, lower=True)
+        alpha = cho_solve(L, Y)
+        # marginal likelihood up to a constant, summed over the outputs
+        logL = -0.5*np.sum(Y*alpha/self.amplitude**2)-Y.shape[1]*np.sum(np.log(np.diag(L[0])))
+        return L, alpha, logL
+    
+    
+    def fit(self, X, Y):
+        X = np.atleast_2d(X)
+        Y = np.asarray(Y).reshape(len(X), -1)
+        self.X=X
+        self.mean = Y.mean(axis=0)
+        Y = Y-self.mean
+        self.amplitude = np.where(Y.std(axis=0)>0, Y.std(axis=0), 1.)
+        
+        scale = X.std(axis=0)
+        scale = np.where(scale>0, scale, 1.)
+        best = np.NINF
+        for f in self.length_factors:
+            self.length_scales = f*scale
+            try:
+                L, alpha, logL = self._solve(X, Y)
+            except np.linalg.LinAlgError:
+                continue
+            if logL>best:
+                best, best_f, self._L, self._alpha = logL, f, L, alpha
+        if not np.isfinite(best):
+            raise np.linalg.LinAlgError('Kernel matrix is not positive definite for any of the length scales')
+        self.length_scales = best_f*scale
+        self._Y = Y
+    
+    
+    def add(self, x, y):
+        '''
+        Adds the training points x, y keeping the mean, amplitude and length scales of the last fit. 
+        The Cholesky factor of the kernel matrix is extended by one row for each point, 
+        so the cost is O(n_train^2) instead of the O(n_train^3) of a new fit
+        '''
+        x = np.atleast_2d(x)
+        y = np.asarray(y).reshape(len(x), -1)-self.mean
+        for x_ in x:
+            n = len(self.X)
+            k = self._kernel(x_[None, :], self.X)[0]
+            l = solve_triangular(self._L[0], k, lower=True)
+            d2 = 1.+self.nugget-l@l
+            if d2<=0:
+                raise np.linalg.LinAlgError('Kernel matrix is not positive definite after adding the point %s' %str(x_))
+            L = np.zeros((n+1, n+1))
+            L[:n, :n] = np.tril(self._L[0])
+            L[n, :n] = l
+            L[n, n] = np.sqrt(d2)
+            self._L = (L, True)
+            self.X = np.vstack([self.X, x_])
+        self._Y = np.concatenate([self._Y, y])
+        self._alpha = cho_solve(self._L, self._Y)
+    
+    
+    def predict(self, x):
+        x = np.atleast_2d(x)
+        k = self._kernel(x, self.X)
+        mean = self.mean+k@self._alpha
+        v = solve_triangular(self._L[0], k.T, lower=True)
+        var = np.clip(1.-np.sum(v**2, axis=0), 0., None)
+        std = np.sqrt(var)[:, None]*self.amplitude
+        return mean, std
+
+
+
 ######################
 # OTHER
 ######################
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+'''
+Fixtures shared by the tests: a small mock catalog and injection set, 
+and a function building the posterior used in the inference
+'''
+import os
+import sys
+
+import numpy as np
+import h5py
+import pytest
+import astropy.units as u
+from astropy.cosmology import Planck15
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'MGCosmoPop'))
+
+from population.astro.astroMassDistribution import BrokenPowerLawMass
+from population.astro.astroSpinDistribution import DummySpinDist
+from population.astro.rateEvolution import PowerLawRateEvolution
+from population.astro.astroPopulation import AstroPopulation
+from cosmology.cosmo import Cosmo
+from population.allPopulations import AllPopulations
+from dataStructures.mockData import GWMockData, GWMockInjectionsData
+from posteriors.prior import Prior
+from posteriors.likelihood import HyperLikelihood
+from posteriors.posterior import Posterior
+from posteriors.selectionBias import SelectionBiasInjections
+
+
+PARAMS_INFERENCE = ['H0', 'Om', 'R0', 'lambdaRedshift', 'alpha1', 'mh']
+
+PRIOR_LIMITS = {'H0':(20, 140), 'Om':(0.05, 1), 'R0':(1e-1, 1e3), 'lambdaRedshift':(-10, 10), 
+                'alpha1':(-4, 12), 'mh':(30, 100), 'w0':(-2, -0.5), 'Xi0':(0.1, 10)}
+
+TEST_POINTS = np.array([ [67.7, 0.31, 20, 1.8, 1.6, 87], 
+                         [70, 0.25, 30, 2.5, 2.0, 80], 
+                         [60, 0.4, 10, 0., 1.2, 60], 
+                         [75, 0.3, 25, 3., 1.6, 95] ])
+
+
+
+def write_mock_observations(fname, Nobs=10, Nsamples=2000, seed=1):
+    '''
+    Gaussian posterior samples around random values of the source masses and redshift
+    '''
+    rng = np.random.default_rng(seed)
+    zt = rng.uniform(0.1, 0.8, Nobs)
+    m1t = rng.uniform(15, 45, Nobs)
+    m2t = m1t*rng.uniform(0.5, 0.95, Nobs)
+    dLt = Planck15.luminosity_distance(zt).to(u.Gpc).value
+    m1 = (m1t*(1+zt))[:, None]*np.exp(0.05*rng.standard_normal((Nobs, Nsamples)))
+    m2 = np.minimum((m2t*(1+zt))[:, None]*np.exp(0.05*rng.standard_normal((Nobs, Nsamples))), m1*0.999)
+    dL = dLt[:, None]*np.exp(0.2*rng.standard_normal((Nobs, Nsamples)))
+    with h5py.File(fname, 'w') as out:
+        g = out.create_group('posteriors')
+        g['m1det'] = m1
+        g['m2det'] = m2
+        g['dl'] = dL
+
+
+def write_mock_injections(fname, N_gen=100000, seed=2):
+    '''
+    Injections uniform in source masses and redshift, detected with a probability 
+    decreasing with the distance
+    '''
+    rng = np.random.default_rng(seed)
+    z = rng.uniform(0.01, 1.5, N_gen)
+    m1 = rng.uniform(5, 90, N_gen)
+    m2 = m1*rng.uniform(0.1, 1, N_gen)
+    keep = m2>4.5
+    z, m1, m2 = z[keep], m1[keep], m2[keep]
+    dL = Planck15.luminosity_distance(z).to(u.Gpc).value
+    det = rng.uniform(size=z.size) < np.exp(-dL/1.5)*np.minimum(1, m1/30)
+    # log of the probability density of the injections in detector-frame masses and luminosity distance
+    ddL_dz = (Planck15.luminosity_distance(z+1e-04).to(u.Gpc).value-dL)/1e-04
+    logw = -np.log(1.49)-np.log(85)-np.log(m1*0.9)-2*np.log1p(z)-np.log(ddL_dz)
+    with h5py.File(fname, 'w') as out:
+        out['m1det'] = (m1*(1+z))[det]
+        out['m2det'] = (m2*(1+z))[det]
+        out['dl'] = dL[det]
+        out['logwt'] = logw[det]
+        out['snr'] = np.full(det.sum(), 10.)
+        out.attrs['N_gen'] = N_gen
+        out.attrs['snr_th'] = 8.
+
+
+
+@pytest.fixture(scope='session')
+def mock_files(tmp_path_factory):
+    path = tmp_path_factory.mktemp('mock')
+    obs, inj = str(path/'observations.h5'), str(path/'injections.h5')
+    write_mock_observations(obs)
+    write_mock_injections(inj)
+    return obs, inj
+
+
+
+@pytest.fixture(scope='session')
+def build_posterior(mock_files):
+    '''
+    Returns a function building a Posterior on the mock data. 
+    The keyword arguments are passed to the single components
+    '''
+    obs, inj = mock_files
+    
+    def build(params_inference=PARAMS_INFERENCE, n_datasets=1, cosmo_kw={}, lik_kw={}, sb_kw={}, post_kw={}, sb_cls=SelectionBiasInjections):
+        cosmo = Cosmo(dist_unit=u.Gpc, **cosmo_kw)
+        pop = AstroPopulation(PowerLawRateEvolution(), BrokenPowerLawMass(), DummySpinDist())
+        allPops = AllPopulations(cosmo)
+        allPops.add_pop(pop)
+        data = [ GWMockData(obs, Tobs=1.) for _ in range(n_datasets) ]
+        injData = [ GWMockInjectionsData(inj, Tobs=1.) for _ in range(n_datasets) ]
+        params_inference = list(params_inference)
+        prior = Prior(PRIOR_LIMITS, params_inference, {p:'flat' for p in PRIOR_LIMITS}, None)
+        lik = HyperLikelihood(allPops, data, params_inference, **{'safety_factor':5, **lik_kw})
+        sb = None if sb_cls is None else sb_cls(allPops, injData, params_inference, **sb_kw)
+        return Posterior(lik, prior, sb, **{'bias_safety_factor':1., **post_kw})
+    
+    return build
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+import os
+import itertools
+import numpy as np
+import pytest
+import astropy.units as u
+from scipy.integrate import quad
+from astropy.cosmology import FlatwCDM, FlatLambdaCDM
+
+from cosmology.cosmo import Cosmo, uu_flat_LCDM
+from cosmology.emulator import ComovingDistanceEmulator
+
+
+CLIGHT = 2.99792458e05
+
+EMULATOR_ARGS = dict(Om_range=(0.05, 1.), w0_range=(-2., -0.5), zmax=20., nOm=30, nw0=40, nz=200)
+
+
+
+def astropy_uu(z, Om, w0):
+    return FlatwCDM(H0=100, Om0=Om, w0=w0).comoving_distance(z).to(u.Mpc).value*100/CLIGHT
+
+
+@pytest.fixture(scope='module')
+def emulator_file(tmp_path_factory):
+    fname = str(tmp_path_factory.mktemp('emulator')/'uu_emulator.h5')
+    ComovingDistanceEmulator(fname=fname, **EMULATOR_ARGS)
+    return fname
+
+
+
+def test_emulator(emulator_file):
+    emu = ComovingDistanceEmulator(fname=emulator_file, **EMULATOR_ARGS)
+    assert emu.max_rel_err < 1e-04
+    rng = np.random.default_rng(1)
+    z = np.geomspace(1e-05, 20., 200)
+    for Om, w0 in zip(rng.uniform(0.05, 1., 10), rng.uniform(-2., -0.5, 10)):
+        assert emu.covers(Om, w0)
+        assert np.allclose(emu.uu(z, Om, w0), astropy_uu(z, Om, w0), rtol=emu.max_rel_err*1.5, atol=0)
+    assert not emu.covers(0.3, -2.5)
+    assert np.all(np.isnan(emu.uu(z, 0.3, -2.5)))
+
+
+def test_emulator_in_memory(emulator_file, tmp_path, monkeypatch, capsys):
+    # by default nothing is written to disk or printed
+    monkeypatch.chdir(tmp_path)
+    emu = ComovingDistanceEmulator(**EMULATOR_ARGS)
+    assert emu.path is None
+    assert os.listdir(tmp_path)==[]
+    assert capsys.readouterr().out==''
+    ref = ComovingDistanceEmulator(fname=emulator_file, **EMULATOR_ARGS)
+    z = np.geomspace(1e-05, 20., 50)
+    assert np.all(emu.uu(z, 0.3, -1.2)==ref.uu(z, 0.3, -1.2))
+
+
+def test_cosmo_with_emulator(emulator_file):
+    cosmo = Cosmo(dist_unit=u.Gpc, use_emulator=True, emulator_args=dict(fname=emulator_file, **EMULATOR_ARGS))
+    ref = Cosmo(dist_unit=u.Gpc, analytic_LCDM=False)
+    z = np.geomspace(1e-03, 10., 100)
+    for H0, Om, w0, Xi0, n in [ (67., 0.3, -1., 1., 1.91), (72., 0.25, -0.8, 1.5, 2.), (60., 0.5, -1.3, 0.8, 1.) ]:
+        dL = ref.dLGW(z, H0, Om, w0, Xi0, n)
+        assert np.allclose(cosmo.dLGW(z, H0, Om, w0, Xi0, n), dL, rtol=1e-04, atol=0)
+        assert np.allclose(cosmo.z_from_dLGW_fast(dL, H0, Om, w0, Xi0, n), z, rtol=1e-04, atol=0)
+        assert np.allclose(cosmo.log_dV_dz(z, H0, Om, w0), ref.log_dV_dz(z, H0, Om, w0), rtol=0, atol=1e-04)
+    # outside the table, astropy is used
+    assert cosmo.dLGW(1., 67., 0.3, -2.5, 1., 0.)==ref.dLGW(1., 67., 0.3, -2.5, 1., 0.)
+
+
+@pytest.mark.parametrize('Om', [0., 0.05, 0.3, 0.7, 1.])
+def test_uu_flat_LCDM(Om):
+    z = np.concatenate([ np.geomspace(1e-08, 1e-03, 50), [1e-03*(1-1e-12), 1e-03], np.geomspace(1e-03, 1e05, 200) ])
+    ref = [ quad(lambda x: 1/np.sqrt(Om*(1+x)**3+1-Om), 0, z_, epsabs=0, epsrel=1e-13, limit=200)[0] for z_ in z ]
+    assert np.allclose(uu_flat_LCDM(z, Om), ref, rtol=1e-11, atol=0)
+    # astropy integrates numerically, so agreement is limited by its tolerance
+    ref = FlatLambdaCDM(H0=100, Om0=Om).comoving_distance(z[z>1e-03]).to(u.Mpc).value*100/CLIGHT
+    assert np.allclose(uu_flat_LCDM(z[z>1e-03], Om), ref, rtol=1e-08, atol=0)
+    assert uu_flat_LCDM(0., Om)==0
+    assert uu_flat_LCDM(z.reshape(2, -1), Om).shape==(2, len(z)//2)
+
+
+def test_cosmo_analytic_LCDM():
+    cosmo = Cosmo(dist_unit=u.Gpc)
+    ref = Cosmo(dist_unit=u.Gpc, analytic_LCDM=False)
+    z = np.geomspace(1e-04, 20., 100)
+    for H0, Om, Xi0, n in [ (67., 0.3, 1., 1.91), (72., 0.25, 1.5, 2.), (60., 1., 0.8, 1.) ]:
+        assert np.allclose(cosmo.uu(z, Om, -1), ref.uu(z, Om, -1), rtol=1e-08, atol=0)
+        assert np.allclose(cosmo.E(z, Om, -1), ref.E(z, Om, -1), rtol=1e-10, atol=0)
+        dL = ref.dLGW(z, H0, Om, -1, Xi0, n)
+        assert np.allclose(cosmo.dLGW(z, H0, Om, -1, Xi0, n), dL, rtol=1e-08, atol=0)
+        assert np.allclose(cosmo.z_from_dLGW_fast(dL, H0, Om, -1, Xi0, n), z, rtol=1e-06, atol=0)
+        assert np.allclose(cosmo.log_dV_dz(z, H0, Om, -1), ref.log_dV_dz(z, H0, Om, -1), rtol=0, atol=1e-08)
+
+
+def test_set_z_grid(capsys):
+    cosmo = Cosmo(dist_unit=u.Gpc, kernels='numpy')
+    ref = Cosmo(dist_unit=u.Gpc, kernels='numpy')
+    priorLimits = {'H0': (20., 140.), 'Om': (0.05, 1.), 'w0': (-2., -0.5), 'Xi0': (0.3, 5.), 'n': (0.5, 3.)}
+    dL = np.geomspace(1e-02, 20., 200)
+    cosmo.set_z_grid(dL.max(), dL_min=dL.min(), priorLimits=priorLimits)
+    assert capsys.readouterr().out==''
+    assert len(cosmo.zGridGlobals) < len(ref.zGridGlobals)
+    # the grid covers the range in dL for all the values of the parameters in the prior
+    for H0, Om, w0, Xi0, n in itertools.product(*priorLimits.values()):
+        z = cosmo.z_from_dLGW_fast(dL, H0, Om, w0, Xi0, n)
+        assert np.allclose(z, ref.z_from_dLGW_fast(dL, H0, Om, w0, Xi0, n), rtol=1e-05, atol=0)
+        assert np.allclose(cosmo.log_jacobians(z, H0, Om, w0, Xi0, n), ref.log_jacobians(z, H0, Om, w0, Xi0, n), rtol=0, atol=1e-05)
+    # above the grid the result is nan
+    zmax = cosmo.zGridGlobals[-1]
+    assert np.isnan(cosmo.z_from_dLGW_fast(1e03, 67.7, 0.31, -1., 1., 0.))
+    assert np.all(np.isnan(cosmo.log_jacobians(2*zmax, 67.7, 0.31, -1.2, 1., 0.)))
+
+
+@pytest.mark.parametrize('kernels', ['astropy', 'numpy'])
+def test_cosmo_batch(kernels):
+    cosmo = Cosmo(dist_unit=u.Gpc, kernels=kernels)
+    ref = Cosmo(dist_unit=u.Gpc, kernels=kernels)
+    # repeated values of (Om, w0, Xi0, n) with different H0
+    H0 = np.array([60., 67.7, 75., 60., 80., 67.7])
+    Om = np.array([0.31, 0.31, 0.31, 0.25, 0.25, 0.31])
+    w0 = np.array([-1., -1., -1., -1.2, -1.2, -1.])
+    Xi0 = np.array([1., 1., 1., 1.5, 1.5, 0.8])
+    n = np.array([0., 0., 0., 2., 2., 1.])
+    dL = np.geomspace(1e-02, 20., 100)
+    
+    z = cosmo.z_from_dLGW_fast(dL, H0, Om, w0, Xi0, n)
+    assert z.shape==(len(H0), len(dL))
+    # one interpolator for each value of (Om, w0, Xi0, n)
+    assert len(cosmo._z_from_dL_cache)==3
+    logdV = cosmo.log_dV_dz(z, H0, Om, w0)
+    logddL = cosmo.log_ddL_dz(z, H0, Om, w0, Xi0, n)
+    logddL_dL = cosmo.log_ddL_dz(z, H0, Om, w0, Xi0, n, dL=dL)
+    dLGW = cosmo.dLGW(z, H0, Om, w0, Xi0, n)
+    for i, p in enumerate(zip(H0, Om, w0, Xi0, n)):
+        z_ = ref.z_from_dLGW_fast(dL, *p)
+        assert np.allclose(z[i], z_, rtol=1e-12, atol=0)
+        assert np.allclose(logdV[i], ref.log_dV_dz(z_, *p[:3]), rtol=1e-12, atol=0)
+        assert np.allclose(logddL[i], ref.log_ddL_dz(z_, *p), rtol=1e-12, atol=0)
+        assert np.allclose(logddL_dL[i], ref.log_ddL_dz(z_, *p, dL=dL), rtol=1e-12, atol=0)
+        assert np.allclose(dLGW[i], ref.dLGW(z_, *p), rtol=1e-12, atol=0)
+        # inverse of dLGW
+        assert np.allclose(dLGW[i], dL, rtol=1e-06, atol=0)
+    assert np.isclose(z[1, 50], ref.z_from_dLGW(dL[50], H0[1], Om[1], w0[1], Xi0[1], n[1]), rtol=1e-06, atol=0)
+
+
+@pytest.mark.parametrize('use_emulator', [False, True])
+def test_numpy_kernels(emulator_file, use_emulator):
+    emulator_args = dict(fname=emulator_file, **EMULATOR_ARGS)
+    cosmo = Cosmo(dist_unit=u.Gpc, kernels='numpy', use_emulator=use_emulator, emulator_args=emulator_args)
+    ref = Cosmo(dist_unit=u.Gpc, kernels='astropy', analytic_LCDM=False)
+    z = np.geomspace(1e-04, 15., 300)
+    for H0, Om, w0, Xi0, n in [ (67.7, 0.31, -1., 1., 0.), (72., 0.25, -0.8, 1.5, 2.), (60., 0.5, -1.3, 0.8, 1.), (67.7, 0.31, -1., 1.2, 0.) ]:
+        dL = ref.dLGW(z, H0, Om, w0, Xi0, n)
+        logdV, logddL = cosmo.log_jacobians(z, H0, Om, w0, Xi0, n)
+        assert np.allclose(logdV, ref.log_dV_dz(z, H0, Om, w0), rtol=0, atol=1e-06)
+        assert np.allclose(logddL, ref.log_ddL_dz(z, H0, Om, w0, Xi0, n), rtol=0, atol=1e-06)
+        _, logddL = cosmo.log_jacobians(z, H0, Om, w0, Xi0, n, dL=dL)
+        assert np.allclose(logddL, ref.log_ddL_dz(z, H0, Om, w0, Xi0, n, dL=dL), rtol=0, atol=1e-06)
+        # the single-pass result is the same as the separate functions
+        assert np.all(cosmo.log_jacobians(z, H0, Om, w0, Xi0, n)[0]==cosmo.log_dV_dz(z, H0, Om, w0))
+        assert np.all(cosmo.log_jacobians(z, H0, Om, w0, Xi0, n, dL=dL)[1]==cosmo.log_ddL_dz(z, H0, Om, w0, Xi0, n, dL=dL))
+
+
+def test_batch_numpy_kernels():
+    # batched evaluation with the numpy kernels, against astropy point by point
+    cosmo = Cosmo(dist_unit=u.Gpc, kernels='numpy')
+    ref = Cosmo(dist_unit=u.Gpc, kernels='astropy', analytic_LCDM=False)
+    H0, Om, w0, Xi0, n = np.array([ [60., 0.31, -1., 1., 0.], [72., 0.25, -0.8, 1.5, 2.], [80., 0.31, -1., 1., 0.] ]).T
+    z = np.geomspace(1e-03, 10., 200)
+    logdV, logddL = cosmo.log_jacobians(z, H0, Om, w0, Xi0, n)
+    assert logdV.shape==logddL.shape==(3, len(z))
+    for i, p in enumerate(zip(H0, Om, w0, Xi0, n)):
+        assert np.allclose(logdV[i], ref.log_dV_dz(z, *p[:3]), rtol=0, atol=1e-06)
+        assert np.allclose(logddL[i], ref.log_ddL_dz(z, *p), rtol=0, atol=1e-06)
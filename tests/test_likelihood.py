@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+import numpy as np
+import pytest
+
+from conftest import write_mock_observations, TEST_POINTS, PARAMS_INFERENCE
+from dataStructures.mockData import GWMockData
+from dataStructures.ABSdata import ConcatenatedData
+from posteriors.likelihood import HyperLikelihood
+
+
+
+def ragged_data(fname, Tobs, seed):
+    '''
+    Mock catalog where each event has a different number of samples, 
+    with nan padding as in LVCData
+    '''
+    data = GWMockData(fname, Tobs=Tobs)
+    rng = np.random.default_rng(seed)
+    nKeep = rng.integers(500, data.m1z.shape[1], data.m1z.shape[0])
+    pad = np.arange(data.m1z.shape[1])[None, :]>=nKeep[:, None]
+    data.m1z[pad], data.m2z[pad], data.dL[pad] = np.nan, np.nan, np.nan
+    data.Nsamples, data.logNsamples = nKeep, np.log(nKeep)
+    data._set_flat_samples()
+    return data
+
+
+@pytest.fixture(scope='module')
+def catalogs(tmp_path_factory):
+    path = tmp_path_factory.mktemp('catalogs')
+    allData = []
+    for i, (Nobs, Tobs) in enumerate([ (10, 1.), (6, 0.5), (8, 2.) ]):
+        fname = str(path/('observations_%s.h5' %i))
+        write_mock_observations(fname, Nobs=Nobs, seed=10+i)
+        allData.append(ragged_data(fname, Tobs, seed=i))
+    return allData
+
+
+def loglik_per_event(allPops, data, Lambda):
+    '''
+    Log likelihood of a catalog, looping over the events on the padded arrays
+    '''
+    LambdaCosmo, _ = allPops._split_params(Lambda)
+    res = 0.
+    for i in range(data.m1z.shape[0]):
+        keep = ~np.isnan(data.m1z[i])
+        m1z, m2z, dL = data.m1z[i][keep], data.m2z[i][keep], data.dL[i][keep]
+        z = allPops.cosmo.z_from_dLGW_fast(dL, *LambdaCosmo)
+        logdN = allPops.log_dN_dm1zdm2zddL(m1z/(1+z), m2z/(1+z), z, [], data.Tobs, Lambda, dL=dL)
+        logdN -= data.logOrMassPrior()[i][keep]+data.logOrDistPrior()[i][keep]
+        res += np.logaddexp.reduce(logdN)-np.log(keep.sum())
+    return res
+
+
+
+def test_concatenated_data(catalogs):
+    cat = ConcatenatedData(catalogs)
+    for name in ('m1z', 'm2z', 'dL'):
+        expected = np.concatenate([ getattr(data, name)[~np.isnan(data.m1z)] for data in catalogs ])
+        assert np.all(getattr(cat, name+'_flat')==expected)
+    nSamples = np.concatenate([ data.Nsamples for data in catalogs ])
+    assert np.all(np.diff(cat.sample_offsets)==nSamples)
+    assert np.all(cat.logNsamples==np.log(nSamples))
+    assert np.all(np.diff(cat.catalog_offsets)==[ len(data.Nsamples) for data in catalogs ])
+    assert np.all(cat.Tobs==np.repeat([ data.Tobs for data in catalogs ], [ data.Nsamples.sum() for data in catalogs ]))
+    assert np.all(cat.logOrPrior_flat==np.concatenate([ data.logOrMassPrior(flat=True)+data.logOrDistPrior(flat=True) for data in catalogs ]))
+
+
+@pytest.mark.parametrize('concatenate_data', [False, True])
+def test_loglik_sums(build_posterior, catalogs, concatenate_data):
+    allPops = build_posterior(sb_cls=None).hyperLikelihood.population
+    lik = HyperLikelihood(allPops, catalogs, PARAMS_INFERENCE, safety_factor=0., concatenate_data=concatenate_data)
+    for Lambda_test in TEST_POINTS:
+        Lambda = allPops.get_Lambda(Lambda_test, PARAMS_INFERENCE)
+        expected = [ loglik_per_event(allPops, data, Lambda) for data in catalogs ]
+        assert np.allclose(lik.logLik(Lambda_test), expected, rtol=1e-12, atol=0)
+        assert np.allclose(lik.logLik_early(Lambda_test, chunk_size=3), expected, rtol=1e-12, atol=0)
+
+
+def test_concatenated_single_evaluation(build_posterior, catalogs):
+    allPops = build_posterior(sb_cls=None).hyperLikelihood.population
+    cache = allPops._pops[0].massDist.norm_cache
+    res, lookups = {}, {}
+    for concatenate_data in (False, True):
+        lik = HyperLikelihood(allPops, catalogs, PARAMS_INFERENCE, safety_factor=0., concatenate_data=concatenate_data)
+        lik.logLik(TEST_POINTS[0])
+        n = cache.hits+cache.misses
+        res[concatenate_data] = lik.logLik(TEST_POINTS[0])
+        lookups[concatenate_data] = cache.hits+cache.misses-n
+    # the population is evaluated once for all catalogs, and the result is split back per catalog
+    assert lookups[False]==len(catalogs)*lookups[True]
+    assert np.allclose(res[True], res[False], rtol=1e-12, atol=0)
+
+
+def test_flat_samples_no_padding(build_posterior, catalogs, monkeypatch):
+    for data in catalogs:
+        assert data.m1z_flat.size==data.Nsamples.sum()<data.m1z.size
+        for i in range(len(data.Nsamples)):
+            event = slice(data.sample_offsets[i], data.sample_offsets[i+1])
+            assert np.all(data.dL_flat[event]==data.dL[i][~np.isnan(data.dL[i])])
+    
+    # the population is only evaluated on the flat samples, without padding
+    allPops = build_posterior(sb_cls=None).hyperLikelihood.population
+    lik = HyperLikelihood(allPops, catalogs, PARAMS_INFERENCE, safety_factor=0.)
+    sizes = []
+    log_dN = allPops._log_dN_dm1zdm2zddL
+    def checked_log_dN(m1, m2, z, *args, **kwargs):
+        assert not np.any(np.isnan(m1)) and not np.any(np.isnan(m2)) and not np.any(np.isnan(z))
+        sizes.append(len(m1))
+        return log_dN(m1, m2, z, *args, **kwargs)
+    monkeypatch.setattr(allPops, '_log_dN_dm1zdm2zddL', checked_log_dN)
+    
+    lik.logLik(TEST_POINTS[0])
+    assert sizes==[ data.Nsamples.sum() for data in catalogs ]
+    sizes.clear()
+    lik.logLik_early(TEST_POINTS[0], chunk_size=3)
+    assert sum(sizes)==sum( data.Nsamples.sum() for data in catalogs )
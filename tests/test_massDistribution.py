@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+from scipy.integrate import quad
+
+from population.astro.astroMassDistribution import BrokenPowerLawMass, AstroSmoothPowerLawMass
+from population.astro.smoothingTable import SmoothingIntegralTable
+from conftest import TEST_POINTS
+
+
+# alpha1, alpha2, beta, deltam, ml, mh, b
+PARAMS = [ (1.6, 5.6, 1.4, 4.8, 4., 87., 0.43), 
+           (-0.5, 3., -2.5, 8., 6., 60., 0.2), 
+           (3., 1., 4., 0.5, 2., 100., 0.01), 
+           (2.5, 7., 0., 20., 5., 40., 0.3) ]
+
+
+
+def _logS(m, deltam, ml):
+    if m<=ml:
+        return -np.inf
+    if m>=ml+deltam:
+        return 0.
+    return -np.logaddexp(0, deltam/(m-ml)+deltam/(m-ml-deltam))
+
+
+def quad_log(logf, a, b, points=None, n_scan=1000):
+    '''
+    log of the integral of exp(logf) between a and b with scipy, rescaling the integrand by its max 
+    on a grid, so that also integrals ~exp(-1000) can be computed
+    '''
+    logf0 = max( logf(x) for x in np.linspace(a, b, n_scan+1)[1:] )
+    return np.log(quad(lambda x: np.exp(logf(x)-logf0), a, b, points=points, epsabs=0, epsrel=1e-12, limit=500)[0])+logf0
+
+
+def quad_logC(m, beta, deltam, ml):
+    pts = [ml+deltam] if m>ml+deltam else None
+    return -quad_log(lambda x: beta*np.log(x)+_logS(x, deltam, ml), ml, m, points=pts)
+
+
+
+@pytest.fixture(scope='module')
+def massDist():
+    return BrokenPowerLawMass()
+
+
+@pytest.mark.parametrize('params', PARAMS)
+def test_logC(massDist, params):
+    alpha1, alpha2, beta, deltam, ml, mh, b = params
+    # inside the smoothing region (including the points integrated exactly close to ml) and above
+    m = np.concatenate([ ml+deltam*np.array([0.01, 0.1, 0.5, 0.9, 0.999]), ml+deltam+np.array([1e-03, 1., 10.]), [mh] ])
+    expected = np.array([ quad_logC(m_, beta, deltam, ml) for m_ in m ])
+    assert np.allclose(massDist._logC(m, beta, deltam, ml), expected, rtol=0, atol=1e-06)
+    assert np.allclose(massDist._logC(m, beta, deltam, ml, rtol=1e-09), expected, rtol=0, atol=1e-08)
+    assert np.allclose(massDist._logCexact(m, beta, deltam, ml), expected, rtol=0, atol=1e-08)
+    
+    # Very close to ml, where p(m) ~ exp(-deltam/(m-ml)), the Gauss-Legendre rule is less accurate
+    m = ml+deltam*np.array([1e-03])
+    assert np.allclose(massDist._logC(m, beta, deltam, ml), quad_logC(m[0], beta, deltam, ml), rtol=1e-05, atol=0)
+
+
+def quad_logNorm(alpha1, alpha2, deltam, ml, mh, b):
+    mbr = ml+b*(mh-ml)
+    def logp(m):
+        gamma, norm = (-alpha1, 0.) if m<mbr else (-alpha2, (alpha2-alpha1)*np.log(mbr))
+        return gamma*np.log(m)+norm+_logS(m, deltam, ml)
+    return quad_log(logp, ml, mh, points=[ml+deltam, mbr])
+
+
+@pytest.mark.parametrize('params', PARAMS)
+def test_logNorm(massDist, params):
+    alpha1, alpha2, beta, deltam, ml, mh, b = params
+    expected = quad_logNorm(alpha1, alpha2, deltam, ml, mh, b)
+    assert np.isclose(massDist._logNorm(alpha1, alpha2, deltam, ml, mh, b), expected, rtol=0, atol=1e-08)
+
+
+def test_smooth_power_law_normalization():
+    massDist = AstroSmoothPowerLawMass()
+    for lambdaBBHmass in [ (0.75, 0.0, 5.0, 0.1, 45.0, 0.1), (2.3, 1.5, 3., 0.3, 80., 0.05), (-1., -1.5, 8., 0.02, 30., 0.2) ]:
+        alpha, beta, ml, sl, mh, sh = lambdaBBHmass
+        mMin, mMax = ml*np.exp(-8*sl), mh*np.exp(8*sh)
+        logp1 = lambda m: massDist._logpdfm1only(np.array([m]), alpha, ml, sl, mh, sh)[0]
+        logp2 = lambda m: massDist._logpdfm2(np.array([m]), beta, ml, sl, mh, sh)[0]
+        # nested integral over m2<m1
+        logF2 = lambda m1: quad_log(logp2, mMin, m1, points=[ml] if m1>ml else None, n_scan=20)
+        expected = quad_log(lambda m1: logp1(m1)+logF2(m1), mMin, mMax, points=[ml, mh])
+        assert np.isclose(massDist._get_log_normalization(lambdaBBHmass), expected, rtol=0, atol=1e-07)
+
+
+# Small table covering the parameters in PARAMS
+TABLE_ARGS = dict(gamma_range=(-8., 8.), r_range=(0.1, 5.), ngamma=65, nr=61, nt=200)
+
+
+@pytest.fixture(scope='module')
+def table_file(tmp_path_factory):
+    fname = str(tmp_path_factory.mktemp('table')/'smoothing_integral_table.h5')
+    SmoothingIntegralTable(fname=fname, **TABLE_ARGS)
+    return fname
+
+
+def test_smoothing_table_in_memory(table_file, tmp_path, monkeypatch, capsys):
+    # by default nothing is written to disk or printed
+    monkeypatch.chdir(tmp_path)
+    table = SmoothingIntegralTable(**TABLE_ARGS)
+    assert table.path is None
+    assert os.listdir(tmp_path)==[]
+    assert capsys.readouterr().out==''
+    ref = SmoothingIntegralTable(fname=table_file, **TABLE_ARGS)
+    t = np.linspace(0.05, 1., 20)
+    assert np.all(table.logJ(1.5, 0.8, t)==ref.logJ(1.5, 0.8, t))
+
+
+def test_smoothing_table(table_file):
+    table = SmoothingIntegralTable(fname=table_file, **TABLE_ARGS)
+    assert table.max_abs_err < 1e-05
+    for alpha1, alpha2, beta, deltam, ml, mh, b in PARAMS:
+        for gamma in (-alpha1, -alpha2, beta):
+            assert table.covers(gamma, deltam, ml)
+            x = ml+deltam*np.array([0.05, 0.3, 0.7, 1.])
+            expected = [ quad_log(lambda m: gamma*np.log(m)+_logS(m, deltam, ml), ml, x_) for x_ in x ]
+            assert np.allclose(table.logI(x, gamma, deltam, ml), expected, rtol=0, atol=2*table.max_abs_err)
+            assert np.isclose(table.logI_norm(gamma, deltam, ml), expected[-1], rtol=0, atol=2*table.max_abs_err_norm)
+    assert not table.covers(9., 1., 5.)
+    assert np.all(np.isnan(table.logI(np.array([5.5]), 9., 1., 5.)))
+
+
+@pytest.mark.parametrize('params', PARAMS)
+def test_table_normalizations(table_file, params):
+    alpha1, alpha2, beta, deltam, ml, mh, b = params
+    massDist = BrokenPowerLawMass(use_table=True, table_args=dict(fname=table_file, **TABLE_ARGS))
+    assert massDist._use_table(-alpha1, deltam, ml) and massDist._use_table(beta, deltam, ml)
+    assert np.isclose(massDist._logNorm(alpha1, alpha2, deltam, ml, mh, b), quad_logNorm(alpha1, alpha2, deltam, ml, mh, b), rtol=0, atol=1e-07)
+    # below t_min, the points are integrated exactly
+    m = np.concatenate([ ml+deltam*np.array([0.01, 0.1, 0.5, 0.9, 0.999]), ml+deltam+np.array([1e-03, 1., 10.]), [mh] ])
+    expected = np.array([ quad_logC(m_, beta, deltam, ml) for m_ in m ])
+    assert np.allclose(massDist._logC(m, beta, deltam, ml), expected, rtol=0, atol=1e-07)
+
+
+def test_norm_cache(build_posterior):
+    post = build_posterior(n_datasets=2)
+    massDist = post.hyperLikelihood.population._pops[0].massDist
+    cache = massDist.norm_cache
+    massDist.clear_norm_cache()
+    
+    Lambda = TEST_POINTS[0].copy()
+    ref = post.logPosterior(Lambda)
+    misses, hits = cache.misses, cache.hits
+    # the normalizations are shared by the two datasets and the injections
+    assert misses>0 and hits>0
+    assert post.logPosterior(Lambda)==ref
+    assert cache.misses==misses
+    
+    # only the parameters of the mass function enter the key
+    Lambda[0] = 70.
+    post.logPosterior(Lambda)
+    assert cache.misses==misses
+    
+    # a different value of the parameters is a new entry, computed as without the cache
+    for i, value in [ (4, 2.), (5, 80.) ]:
+        Lambda[i] = value
+        res = post.logPosterior(Lambda)
+        assert cache.misses>misses
+        massDist.clear_norm_cache()
+        assert len(cache)==0
+        assert post.logPosterior(Lambda)==res
+        misses = cache.misses
+
+
+def test_norm_cache_threads(build_posterior):
+    # concurrent evaluations sharing the cache give the same results as serial ones
+    post = build_posterior(n_datasets=2)
+    serial = [ post.logPosterior(Lambda) for Lambda in TEST_POINTS ]
+    post.hyperLikelihood.population._pops[0].massDist.clear_norm_cache()
+    points = np.concatenate([TEST_POINTS]*8)
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        res = list(ex.map(post.logPosterior, points))
+    assert res==serial*8
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+
+from conftest import PARAMS_INFERENCE, TEST_POINTS
+
+
+# Accepted, rejected by the prior, by the selection effects, by the number of effective samples of the events, accepted
+POINTS = np.array([ [67.7, 0.31, 2, 1.8, 1.6, 87], 
+                    [500, 0.31, 2, 1.8, 1.6, 87], 
+                    [67.7, 0.31, 2, 1.8, 1.6, 35], 
+                    [67.7, 0.31, 2, 1.8, 1.6, 45], 
+                    [67.7, 0.31, 2, 1.8, -3, 87] ])
+
+COUNTS = ({'prior':1, 'selection_Neff':1, 'event_Neff':1}, 2)
+
+KWARGS = dict(lik_kw=dict(safety_factor=5000), post_kw=dict(bias_safety_factor=20.))
+
+
+
+@pytest.fixture(scope='module')
+def reference(build_posterior):
+    post = build_posterior(**KWARGS)
+    return np.array([ post.logPosterior(Lambda) for Lambda in POINTS ]), (post.rejection_counts, post.n_accepted)
+
+
+@pytest.mark.parametrize('post_kw', [ dict(), dict(early_rejection=True), dict(early_rejection=True, event_chunk_size=3), dict(n_threads=2) ])
+def test_paths_match(build_posterior, reference, post_kw):
+    post = build_posterior(lik_kw=KWARGS['lik_kw'], post_kw={**KWARGS['post_kw'], **post_kw})
+    logPost = np.array([ post.logPosterior(Lambda) for Lambda in POINTS ])
+    assert np.array_equal(np.isfinite(logPost), np.isfinite(reference[0]))
+    assert np.allclose(logPost[np.isfinite(logPost)], reference[0][np.isfinite(logPost)], rtol=1e-12)
+    assert (post.rejection_counts, post.n_accepted)==COUNTS
+    assert reference[1]==COUNTS
+
+
+def test_early_rejection_is_opt_in(build_posterior, reference):
+    post = build_posterior(**KWARGS)
+    assert not post.early_rejection
+    
+    # return_all never uses the early path, and counts as the other paths
+    post = build_posterior(lik_kw=KWARGS['lik_kw'], post_kw={**KWARGS['post_kw'], 'early_rejection':True})
+    res = [ post.logPosterior(Lambda, return_all=True) for Lambda in POINTS ]
+    assert np.allclose([ r if np.isscalar(r) else r[0] for r in res ], reference[0], rtol=1e-12)
+    assert (post.rejection_counts, post.n_accepted)==COUNTS
+
+
+@pytest.mark.parametrize('post_kw', [ dict(), dict(early_rejection=True), dict(n_threads=2) ])
+def test_pooled_selection(build_posterior, post_kw):
+    post = build_posterior(n_datasets=2, post_kw=dict(pool_selection=True, **post_kw))
+    ref = build_posterior(n_datasets=2)
+    sb = ref.selectionBias
+    for Lambda in POINTS[[0, 4]]:
+        mus, errs, Neffs = sb.Ndet(Lambda)
+        mu = np.sum(mus)
+        SigmaSq = np.sum(np.array(mus)**2/np.array(Neffs))
+        lls = ref.hyperLikelihood.logLik(Lambda)
+        expected = np.sum(lls)-mu+sb._error_term(mu, SigmaSq)+ref.prior.logPrior(Lambda)
+        assert np.isclose(post.logPosterior(Lambda), expected, rtol=1e-12)
+    
+    # Two copies of the same dataset: the pooled selection function has twice the effective injections
+    mus, errs, Neffs = sb.Ndet(POINTS[0])
+    mu, err, Neff = post.selectionBias.Ndet_pooled(POINTS[0])
+    assert np.isclose(mu, 2*mus[0], rtol=1e-12)
+    assert np.isclose(Neff, 2*Neffs[0], rtol=1e-12)
+    assert post._get_Nobs()==[ 2*post.hyperLikelihood.data[0].Nobs ]
+
+
+def test_pickle_threaded(build_posterior, reference):
+    # e.g. to send the posterior to the processes of a multiprocessing Pool
+    post = build_posterior(lik_kw=KWARGS['lik_kw'], post_kw={**KWARGS['post_kw'], 'n_threads':2})
+    logPost = [ post.logPosterior(Lambda) for Lambda in POINTS ]
+    assert post._executors is not None
+    copy = pickle.loads(pickle.dumps(post))
+    assert copy._executors is None
+    assert np.array_equal([ copy.logPosterior(Lambda) for Lambda in POINTS ], logPost)
+    assert copy._executors is not None
+    assert np.allclose(logPost, reference[0], rtol=1e-12)
+
+
+@pytest.mark.parametrize('post_kw', [ dict(), dict(early_rejection=True), dict(n_threads=2) ])
+def test_counts_threads(build_posterior, reference, post_kw):
+    # e.g. a sampler evaluating the walkers on a pool of threads
+    post = build_posterior(lik_kw=KWARGS['lik_kw'], post_kw={**KWARGS['post_kw'], **post_kw})
+    n_repeat = 10
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        logPost = list(executor.map(post.logPosterior, np.tile(POINTS, (n_repeat, 1))))
+    assert np.allclose(logPost, np.tile(reference[0], n_repeat), rtol=1e-12)
+    assert post.rejection_counts=={ k: n_repeat*v for k, v in COUNTS[0].items() }
+    assert post.n_accepted==n_repeat*COUNTS[1]
+
+
+@pytest.mark.parametrize('concatenate_data', [False, True])
+def test_fixed_cosmo(build_posterior, concatenate_data):
+    kw = dict(n_datasets=2, lik_kw=dict(concatenate_data=concatenate_data), sb_kw=dict(concatenate_data=concatenate_data))
+    fixed = build_posterior(params_inference=PARAMS_INFERENCE[2:], **kw)
+    free = build_posterior(**kw)
+    assert fixed.hyperLikelihood.fixed_cosmo and fixed.selectionBias.fixed_cosmo
+    assert not free.hyperLikelihood.fixed_cosmo and not free.selectionBias.fixed_cosmo
+    allPops = fixed.hyperLikelihood.population
+    H0, Om = allPops.cosmo.baseValues['H0'], allPops.cosmo.baseValues['Om']
+    # the pre-computed terms follow the base values of the cosmological parameters
+    for H0, Om in [ (H0, Om), (72., 0.25), (H0, Om) ]:
+        allPops.set_values({'H0':H0, 'Om':Om})
+        for Lambda in TEST_POINTS[:, 2:]:
+            expected = free.logPosterior(np.concatenate([[H0, Om], Lambda]))
+            assert np.isfinite(expected)
+            assert np.isclose(fixed.logPosterior(Lambda), expected, rtol=1e-12)
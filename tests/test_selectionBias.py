@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+from types import SimpleNamespace
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import h5py
+import pytest
+
+from conftest import TEST_POINTS
+from posteriors.selectionBias import SelectionBiasInjections, SelectionBiasSubsampled, SelectionBiasEmulator, SelectionBiasControlVariate, SelectionBiasGrid
+
+
+
+@pytest.fixture(scope='module')
+def exact(build_posterior):
+    return build_posterior()
+
+
+
+def test_subsampled_accepts_subsets(build_posterior, exact):
+    post = build_posterior(sb_cls=SelectionBiasSubsampled, sb_kw=dict(fractions=(0.1, 0.3), seed=1))
+    sb = post.selectionBias
+    for Lambda in TEST_POINTS:
+        mu, _, Neff = sb.Ndet(Lambda)
+        mu_ex, _, Neff_ex = exact.selectionBias.Ndet(Lambda)
+        assert Neff[0] >= sb.Neff_margin*sb.Neff_min[0]
+        # Compatible with the full set within the MC uncertainty of the subset
+        assert abs(mu[0]-mu_ex[0]) < 4*mu[0]/np.sqrt(Neff[0])
+    assert sb.level_counts[0]>0
+    assert sb.level_counts.sum()==len(TEST_POINTS)
+
+
+def test_subsampled_max_sigma(build_posterior, exact):
+    # Low rate, so that the MC uncertainty on mu is O(1)
+    Lambda = np.array([67.7, 0.31, 1., 1.8, 1.6, 87])
+    mu_ex, err_ex, Neff_ex = exact.selectionBias.Ndet(Lambda)
+    sigma_full = mu_ex[0]/np.sqrt(Neff_ex[0])
+    
+    post = build_posterior(sb_cls=SelectionBiasSubsampled, sb_kw=dict(fractions=(0.1, ), seed=1, max_sigma=2*sigma_full))
+    post.selectionBias.Ndet(Lambda)
+    assert post.selectionBias.last_levels==[0]
+    
+    # Only the full set is precise enough, and the result is the exact one
+    post = build_posterior(sb_cls=SelectionBiasSubsampled, sb_kw=dict(fractions=(0.1, ), seed=1, max_sigma=sigma_full/2))
+    mu, err, Neff = post.selectionBias.Ndet(Lambda)
+    assert post.selectionBias.last_levels==[1]
+    assert np.allclose([mu[0], err[0], Neff[0]], [mu_ex[0], err_ex[0], Neff_ex[0]], rtol=1e-12)
+
+
+def test_subsampled_threads(build_posterior):
+    post = build_posterior(n_datasets=3, sb_cls=SelectionBiasSubsampled, sb_kw=dict(fractions=(0.1, 0.3), seed=1))
+    sb = post.selectionBias
+    Lambdas = np.tile(TEST_POINTS, (5, 1))
+    with ThreadPoolExecutor(max_workers=4) as outer, ThreadPoolExecutor(max_workers=4) as inner:
+        res = list(outer.map(lambda Lambda: sb.Ndet(Lambda, executor=inner), Lambdas))
+    assert sb.level_counts.sum()==3*len(Lambdas)
+
+    # the copy uses the same subsets
+    copy = pickle.loads(pickle.dumps(sb))
+    assert np.array_equal(copy.level_counts, sb.level_counts)
+    for Lambda, r in zip(Lambdas, res):
+        assert np.array_equal(copy.Ndet(Lambda), r)
+
+
+def test_emulator_matches_exact(build_posterior, exact):
+    tol = 0.1
+    post = build_posterior(sb_cls=SelectionBiasEmulator, sb_kw=dict(tol=tol))
+    sb = post.selectionBias
+    rng = np.random.default_rng(1)
+    center = np.array([67.7, 0.31, 2., 1.8, 1.6, 87])
+    scale = np.array([1., 0.01, 0.1, 0.1, 0.05, 1.])
+    Lambdas = center+scale*rng.standard_normal((200, len(center)))
+    for Lambda in Lambdas:
+        n_emulated = sb.n_emulated
+        mu, err, Neff = sb.Ndet(Lambda)
+        mu_ex, err_ex, Neff_ex = exact.selectionBias.Ndet(Lambda)
+        if sb.n_emulated==n_emulated:
+            # exact evaluation
+            assert np.allclose([mu[0], err[0], Neff[0]], [mu_ex[0], err_ex[0], Neff_ex[0]], rtol=1e-12)
+        else:
+            assert abs( (-mu[0]+err[0])-(-mu_ex[0]+err_ex[0]) ) < 3*tol
+            assert abs(Neff[0]/Neff_ex[0]-1) < 0.1
+    assert sb.n_emulated>0
+    # the length scales are not optimised at every new training point
+    assert sb.n_fits < sb.n_exact-sb.min_train
+
+
+def test_emulator_threads(build_posterior):
+    post = build_posterior(n_datasets=2, sb_cls=SelectionBiasEmulator, sb_kw=dict(min_train=5))
+    sb = post.selectionBias
+    rng = np.random.default_rng(2)
+    Lambdas = np.array([67.7, 0.31, 2., 1.8, 1.6, 87])*(1+0.002*rng.standard_normal((40, 6)))
+    # concurrent calls, each distributing the datasets on a pool as in Posterior
+    with ThreadPoolExecutor(max_workers=4) as outer, ThreadPoolExecutor(max_workers=4) as inner:
+        list(outer.map(lambda Lambda: sb.Ndet(Lambda, executor=inner), Lambdas[:20]))
+    assert sb.n_exact+sb.n_emulated==2*20
+    assert all( len(sb._train_X[id(injData_)])==len(sb._train_Y[id(injData_)]) for injData_ in sb.injData )
+
+    # the copy keeps the training sets of each dataset (e.g. to send it to a multiprocessing Pool)
+    copy = pickle.loads(pickle.dumps(sb))
+    assert (copy.n_exact, copy.n_emulated)==(sb.n_exact, sb.n_emulated)
+    for Lambda in Lambdas[20:]:
+        assert np.array_equal(copy.Ndet(Lambda), sb.Ndet(Lambda))
+    assert (copy.n_exact, copy.n_emulated)==(sb.n_exact, sb.n_emulated)
+
+
+def mock_all_injections(cosmo, N_gen, seed, z_range=(0., 1.5)):
+    '''
+    Injections uniform in z, m1 and m2<m1 in the source frame, detected with a probability 
+    decreasing with the distance. Returns the detected injections and all the generated ones
+    '''
+    rng = np.random.default_rng(seed)
+    H0, Om, w0, Xi0, n = [ cosmo.baseValues[p] for p in cosmo.params ]
+    z = rng.uniform(*z_range, N_gen)
+    m1 = rng.uniform(3, 100, N_gen)
+    m2 = rng.uniform(3, m1)
+    dL = cosmo.dLGW(z, H0, Om, w0, Xi0, n)
+    log_p_draw = -np.log(z_range[1]-z_range[0])-np.log(97)-np.log(m1-3)-2*np.log1p(z)-cosmo.log_ddL_dz(z, H0, Om, w0, Xi0, n)
+    det = rng.uniform(size=N_gen) < np.exp(-dL/1.5)*np.minimum(1, m1/30)
+    inj = lambda keep: SimpleNamespace(m1z=(m1*(1+z))[keep], m2z=(m2*(1+z))[keep], dL=dL[keep], log_weights_sel=log_p_draw[keep], 
+                                       logN_gen=np.log(N_gen), spins=[], Tobs=1.)
+    return inj(det), inj(np.full(N_gen, True))
+
+
+def test_control_variate(exact):
+    pop = exact.hyperLikelihood.population
+    params_inference = exact.selectionBias.params_inference
+    Lambda_fid = np.array([ pop.baseValues[p] for p in params_inference ])
+    
+    injData, allInjData = mock_all_injections(pop.cosmo, 100000, seed=4)
+    cv = SelectionBiasControlVariate(pop, [injData], params_inference, [allInjData], z_range=(0., 1.5))
+    plain = SelectionBiasInjections(pop, [injData], params_inference)
+    # independent injections, 40 times more
+    ref = SelectionBiasInjections(pop, [mock_all_injections(pop.cosmo, 4000000, seed=5)[0]], params_inference)
+    
+    # the mean of the control variate over the draws is compatible with its known expectation
+    logg0, mean_g, var_g, mu_g = cv._g_moments[id(injData)]
+    assert abs(mean_g-mu_g) < 4*np.sqrt(var_g/1e05)
+    
+    for Lambda in Lambda_fid*np.array([ [1., 1., 1., 1., 1., 1.], [1.01, 1., 1., 1., 1., 1.], [1., 1., 1., 1.1, 1.05, 0.98], [1., 1.1, 1.5, 0.8, 0.9, 1.] ]):
+        mu, err, Neff = cv.Ndet(Lambda)
+        mu_plain, err_plain, Neff_plain = plain.Ndet(Lambda)
+        mu_ref, err_ref, Neff_ref = ref.Ndet(Lambda)
+        assert Neff[0]>Neff_plain[0]
+        assert abs(mu[0]-mu_ref[0]) < 4*np.sqrt(mu[0]**2/Neff[0]+mu_ref[0]**2/Neff_ref[0])
+    
+    with pytest.raises(ValueError):
+        SelectionBiasControlVariate(pop, [injData], params_inference, [injData], z_range=(0., 1.5))
+
+
+
+class FakeDetector(object):
+    '''
+    L-shaped detector with a toy optimal SNR, 
+    and the same interface as mock.SNRtools.Detector used by DetectionGrid
+    '''
+    mmin, mmax = 2., 500.
+    duty_cycle = 0.8
+    
+    def get_oSNR(self, m1det, m2det, dL):
+        Mc = (m1det*m2det)**(3/5)/(m1det+m2det)**(1/5)
+        return 20*(Mc/20)**(5/6)/dL
+    
+    def _equat2detector(self, costheta, phi, t):
+        return costheta, phi
+    
+    def _Qsq(self, costh, phi, cosiota):
+        Fp = 0.5*(1.+costh**2)*np.cos(2*phi)
+        Fc = costh*np.sin(2*phi)
+        return (Fp*0.5*(1.+cosiota**2))**2 + (Fc*cosiota)**2
+
+
+
+class FakeObservations(object):
+    '''
+    Attributes of mock.observePopulation.Observations used by DetectionGrid
+    '''
+    def __init__(self, allPops, zmax=3., rho_th=8.):
+        self.allPops = allPops
+        self.zmax = zmax
+        self.rho_th = rho_th
+        self.detNet = type('FakeNetwork', (object,), {'get_detectors': lambda self: {'D1':FakeDetector(), 'D2':FakeDetector()}})()
+        self.H0base, self.Om0Base, self.w0Base, self.Xi0Base, self.nBase = [ allPops.cosmo.baseValues[p] for p in allPops.cosmo.params ]
+
+
+def mock_grid_injections(obs, m_range, dL_max, N_gen=400000, seed=3):
+    '''
+    Injections detected with the same model as DetectionGrid, drawn log-uniform in m1z and m2z<m1z 
+    and uniform in dL
+    '''
+    rng = np.random.default_rng(seed)
+    lo, hi = np.log(m_range[0]), np.log(m_range[1])
+    logm1 = rng.uniform(lo, hi, N_gen)
+    logm2 = rng.uniform(lo, logm1)
+    dL = rng.uniform(0, dL_max, N_gen)
+    costh, phi, cosiota = rng.uniform(-1, 1, N_gen), rng.uniform(0, 2*np.pi, N_gen), rng.uniform(-1, 1, N_gen)
+    # SNRs are computed with distances in Gpc
+    to_Gpc = 1e-03/obs.allPops.cosmo.Mpc_to_dist_unit
+    SNRsq = 0.
+    for det in obs.detNet.get_detectors().values():
+        on = rng.uniform(size=N_gen)<det.duty_cycle
+        SNRsq = SNRsq + det.get_oSNR(np.exp(logm1), np.exp(logm2), dL*to_Gpc)**2*det._Qsq(costh, phi, cosiota)*on
+    SNR = np.sqrt(SNRsq)
+    # observed SNR: gaussian noise conditioned to be positive
+    rho = SNR+rng.standard_normal(N_gen)
+    while np.any(rho<0):
+        neg = rho<0
+        rho[neg] = SNR[neg]+rng.standard_normal(neg.sum())
+    det = rho>obs.rho_th
+    log_p_draw = -logm1-logm2-np.log(hi-lo)-np.log(logm1-lo)-np.log(dL_max)
+    return SimpleNamespace(m1z=np.exp(logm1[det]), m2z=np.exp(logm2[det]), dL=dL[det], log_weights_sel=log_p_draw[det], 
+                           logN_gen=np.log(N_gen), spins=[], Tobs=1.)
+
+
+def test_detection_grid(exact):
+    allPops = exact.hyperLikelihood.population
+    obs = FakeObservations(allPops)
+    m_range = (3., 400.)
+    grid_args = dict(m_range=m_range, shape=(40, 40, 40), n_angles=20000, verbose=False)
+    sb = SelectionBiasGrid(allPops, [obs], exact.selectionBias.params_inference, Tobs=[1.], grid_args=grid_args)
+    grid = sb.injData[0]
+    dL_max = allPops.cosmo.dLGW(obs.zmax, obs.H0base, obs.Om0Base, obs.w0Base, obs.Xi0Base, obs.nBase)
+    assert np.isclose(grid.dL.max(), dL_max*(1-1/80))
+    
+    inj = mock_grid_injections(obs, m_range, dL_max)
+    mc = SelectionBiasInjections(allPops, [inj], exact.selectionBias.params_inference, get_uncertainty=False)
+    for Lambda in TEST_POINTS:
+        mu, err, Neff = sb.Ndet(Lambda)
+        assert err==[0] and Neff==[np.inf]
+        mu_mc, _, Neff_mc = mc.Ndet(Lambda)
+        # the error of the quadrature is much smaller than the MC uncertainty
+        assert abs(mu[0]-mu_mc[0]) < 4*mu_mc[0]/np.sqrt(Neff_mc[0])
+
+
+
+def write_snr_table(fname, mmin=2., mmax=500., n=120):
+    '''
+    Optimal SNR table at 1 Gpc in the format read by mock.SNRtools.oSNR.make_interpolator, 
+    with a toy scaling with the chirp mass
+    '''
+    ms = np.geomspace(mmin, mmax, n)
+    m1, m2 = np.meshgrid(ms, ms, indexing='ij')
+    Mc = (m1*m2)**(3/5)/(m1+m2)**(1/5)
+    with h5py.File(fname, 'w') as out:
+        out['ms'] = ms
+        out['SNR'] = 20*(Mc/20)**(5/6)
+        out.attrs['dL'] = 1.
+        out.attrs['flow'] = 10.
+        out.attrs['mmin'] = mmin
+        out.attrs['mmax'] = mmax
+
+
+def test_detection_grid_real_detectors(exact, tmp_path):
+    # mock.SNRtools imports pycbc, which is only used to tabulate the optimal SNRs
+    pytest.importorskip('pycbc')
+    from mock.SNRtools import Detector, NetworkSNR
+    from mock.observePopulation import Observations
+    from dataStructures.mockData import GWMockInjectionsData
+    
+    write_snr_table(str(tmp_path/'toy_optimal_snr_IMRPhenomXAS.h5'))
+    detNet = NetworkSNR()
+    for name, (lat, long, xax) in {'H1': (46.455, -119.408, 126.), 'L1': (30.563, -90.774, 198.)}.items():
+        detNet.add_det(name, Detector(lat=lat, long=long, xax=xax, duty_cycle=0.8, 
+                                      detector_args=dict(psd_name='toy', psd_base_path=str(tmp_path))))
+    allPops = exact.hyperLikelihood.population
+    obs = Observations(allPops, detNet, zmax=1.5, out_dir=str(tmp_path), rho_th=8.)
+    params_inference = exact.selectionBias.params_inference
+    
+    grid_args = dict(shape=(40, 40, 40), n_angles=20000, verbose=False)
+    sb = SelectionBiasGrid(allPops, [obs], params_inference, Tobs=[1.], grid_args=grid_args)
+    
+    # injections drawn from the fiducial population and detected with the real SNR and noise code
+    np.random.seed(7)
+    obs.generate_injections(1, chunk_size=300000)
+    inj = GWMockInjectionsData(str(tmp_path/'selected.h5'), Tobs=1.)
+    mc = SelectionBiasInjections(allPops, [inj], params_inference, get_uncertainty=False)
+    for Lambda in TEST_POINTS:
+        mu, _, _ = sb.Ndet(Lambda)
+        mu_mc, _, Neff_mc = mc.Ndet(Lambda)
+        assert abs(mu[0]-mu_mc[0]) < 4*mu_mc[0]/np.sqrt(Neff_mc[0])
+
+
+
+def write_O3_injections(fname, N=20000, N_gen=50000, seed=8):
+    '''
+    Injections in the format of the O3 sensitivity estimates read by O3InjectionsData
+    '''
+    rng = np.random.default_rng(seed)
+    z = rng.uniform(0.01, 1.2, N)
+    m1 = rng.uniform(5, 80, N)
+    m2 = m1*rng.uniform(0.2, 0.99, N)
+    with h5py.File(fname, 'w') as out:
+        out.attrs['analysis_time_s'] = 0.5*365.25*24*3600
+        out.attrs['total_generated'] = N_gen
+        g = out.create_group('injections')
+        g['mass1_source'], g['mass2_source'], g['redshift'] = m1, m2, z
+        g['sampling_pdf'] = 1/(1.19*75*m1*0.79)*np.full(N, 0.25)
+        # detection statistics decreasing with the distance
+        for pipeline in ('gstlal', 'pycbc_full', 'pycbc_bbh'):
+            g['ifar_'+pipeline] = rng.exponential(1., N)*(0.3/z)**2
+
+
+def test_injections_condition_at_load(exact, tmp_path):
+    from dataStructures.O3adata import O3InjectionsData
+    fname = str(tmp_path/'injections.h5')
+    write_O3_injections(fname)
+    inj = O3InjectionsData(fname, ifar_th=1.)
+    with h5py.File(fname, 'r') as f:
+        N = len(f['injections/redshift'])
+        detected = np.any([ np.array(f['injections/ifar_'+p])>1. for p in ('gstlal', 'pycbc_full', 'pycbc_bbh') ], axis=0)
+    assert 0<detected.sum()<N
+    # only the detected injections are kept, in contiguous arrays; the number of generated injections is unchanged
+    assert inj.N_gen==50000 and inj.logN_gen==np.log(50000)
+    for name in ('m1z', 'm2z', 'dL', 'log_weights_sel'):
+        assert len(getattr(inj, name))==detected.sum()
+        assert getattr(inj, name).flags['C_CONTIGUOUS']
+    
+    # same as masking all the injections at each evaluation
+    allPops, params_inference = exact.hyperLikelihood.population, exact.selectionBias.params_inference
+    full = O3InjectionsData(fname, ifar_th=-1.)
+    assert len(full.m1z)==N
+    sb = SelectionBiasInjections(allPops, [inj], params_inference)
+    for Lambda_test in TEST_POINTS:
+        Lambda = allPops.get_Lambda(Lambda_test, params_inference)
+        LambdaCosmo, _ = allPops._split_params(Lambda)
+        z = allPops.cosmo.z_from_dLGW_fast(full.dL, *LambdaCosmo)
+        logdN = allPops.log_dN_dm1zdm2zddL(full.m1z/(1+z), full.m2z/(1+z), z, [], full.Tobs, Lambda, dL=full.dL)-full.log_weights_sel
+        expected = np.exp(np.logaddexp.reduce(np.where(detected, logdN, np.NINF)))/full.N_gen
+        mu, _, _ = sb.Ndet(Lambda_test)
+        assert np.isclose(mu[0], expected, rtol=1e-12)
+
+
+def test_injections_threads(build_posterior):
+    # datasets evaluated concurrently give the same results as serial ones
+    sb = build_posterior(n_datasets=3).selectionBias
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        for Lambda in TEST_POINTS:
+            assert sb.Ndet(Lambda, executor=ex)==sb.Ndet(Lambda)
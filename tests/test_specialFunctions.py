@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+import numpy as np
+import pytest
+import scipy.stats as ss
+from scipy.integrate import quad
+
+from specialFunctions import norm_logcdf, norm_logsf, log_diff_ndtr, trunc_norm_lognorm, log_smooth_window, log_powerlaw_integral
+
+
+
+def log_diff_ndtr_quad(a, b):
+    '''
+    log( Phi(b) - Phi(a) ) by quadrature of the density, written as
+    phi(c) int exp(-+c t - t^2/2) dt with c the endpoint closest to zero, so that it is accurate in the tails
+    '''
+    if a<0<b:
+        return np.log(quad(lambda x: np.exp(-x**2/2)/np.sqrt(2*np.pi), a, b, points=[0.], epsabs=0, epsrel=1e-13)[0])
+    c, sign = (a, 1) if a>=0 else (b, -1)
+    res = quad(lambda t: np.exp(-sign*c*t-t**2/2), 0, b-a, epsabs=0, epsrel=1e-13)[0]
+    return -c**2/2-np.log(np.sqrt(2*np.pi))+np.log(res)
+
+
+def test_norm_logcdf_logsf():
+    x = np.linspace(-8, 8, 101)
+    loc, scale = 0.3, 1.7
+    assert np.allclose(norm_logcdf(x, loc, scale), ss.norm(loc, scale).logcdf(x), rtol=1e-12, atol=0)
+    assert np.allclose(norm_logsf(x, loc, scale), ss.norm(loc, scale).logsf(x), rtol=1e-12, atol=0)
+    # far tails are finite
+    assert np.all(np.isfinite(norm_logsf(np.array([40., 100.]))))
+
+
+@pytest.mark.parametrize('a, b', [ (-1., 2.), (0.5, 0.6), (-3., -2.9), (8., 9.), (30., 30.5), (-40., -39.), (-50., 50.), (0., 1e-06) ])
+def test_log_diff_ndtr(a, b):
+    assert np.isclose(log_diff_ndtr(a, b), log_diff_ndtr_quad(a, b), rtol=1e-10, atol=1e-12)
+    # broadcasting
+    res = log_diff_ndtr(np.full(3, a), b)
+    assert res.shape==(3,) and np.all(res==log_diff_ndtr(a, b))
+
+
+def test_trunc_norm_lognorm():
+    mu, sigma = np.array([-0.5, 0., 0.9, 0.2]), np.array([0.3, 1., 0.05, 0.01])
+    expected = np.log( ss.norm(mu, sigma).cdf(1)-ss.norm(mu, sigma).cdf(-1) )
+    assert np.allclose(trunc_norm_lognorm(mu, sigma, -1, 1), expected, rtol=1e-12, atol=1e-14)
+
+
+def test_log_smooth_window():
+    m = np.geomspace(1., 200., 300)
+    ml, sl, mh, sh = 5., 0.1, 45., 0.1
+    expected = ss.norm().logcdf(np.log(m/ml)/sl)+ss.norm().logsf(np.log(m/mh)/sh)
+    assert np.allclose(log_smooth_window(m, ml, sl, mh, sh), expected, rtol=1e-12, atol=0)
+    # log(1-cdf) computed directly gives -inf above mh
+    with np.errstate(divide='ignore'):
+        naive = np.log(1-ss.norm().cdf(np.log(m/mh)/sh))
+    assert np.any(np.isinf(naive)) and np.all(np.isfinite(log_smooth_window(m, ml, sl, mh, sh)))
+
+
+@pytest.mark.parametrize('gamma', [-3.5, -1., -1+1e-12, -1+1e-07, 0., 2.3])
+def test_log_powerlaw_integral(gamma):
+    for a, b in [ (1., 10.), (3., 3.+1e-06), (0.5, 80.) ]:
+        expected = np.log(quad(lambda x: x**gamma, a, b, epsabs=0, epsrel=1e-13)[0])
+        assert np.isclose(log_powerlaw_integral(gamma, a, b), expected, rtol=0, atol=1e-09)
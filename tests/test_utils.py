@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import scipy.stats as ss
+
+import utils
+
+
+
+def test_gaussian_process_add():
+    rng = np.random.default_rng(1)
+    X = rng.uniform(size=(60, 3))
+    Y = np.stack([np.sin(X.sum(axis=1)), np.cos(X[:, 0])], axis=1)
+    x = rng.uniform(size=(10, 3))
+    
+    gp = utils.GaussianProcess()
+    gp.fit(X[:40], Y[:40])
+    gp.add(X[40:], Y[40:])
+    
+    # Same hyperparameters, kernel matrix factorised from scratch
+    ref = utils.GaussianProcess()
+    ref.fit(X[:40], Y[:40])
+    ref.X = X
+    ref._L, ref._alpha, _ = ref._solve(X, Y-ref.mean)
+    
+    mean, std = gp.predict(x)
+    mean_ref, std_ref = ref.predict(x)
+    assert np.allclose(mean, mean_ref, rtol=1e-08, atol=1e-10)
+    assert np.allclose(std, std_ref, rtol=1e-06, atol=1e-10)
+    assert np.allclose(gp.predict(X[50])[0], Y[50], atol=1e-05)
+
+
+def test_log_quad():
+    from scipy.integrate import quad
+    
+    # smooth, with a kink, and with very small values
+    logf = lambda x: -0.5*x**2
+    a, b = np.array([-1., 0., 2., -5.]), np.array([1., 3., 7., 5.])
+    res = utils.log_quad(logf, a, b)
+    assert res.shape==a.shape
+    expected = [ np.log(quad(lambda x: np.exp(logf(x)), a_, b_, epsabs=0, epsrel=1e-13)[0]) for a_, b_ in zip(a, b) ]
+    assert np.allclose(res, expected, rtol=0, atol=1e-08)
+    
+    logf = lambda x: np.where(x<1., 2*np.log(np.abs(x)+1e-300), -3*np.log(x))-1000.
+    res = utils.log_quad(logf, 0.1, [0.5, 2., 10.], breakpoints=(1., ))
+    expected = [ np.log(quad(lambda x: np.exp(logf(x)+1000.), 0.1, b_, points=[1.] if b_>1 else None, epsabs=0, epsrel=1e-13)[0])-1000. for b_ in (0.5, 2., 10.) ]
+    assert np.allclose(res, expected, rtol=0, atol=1e-08)
+    
+    # scalar limits give a scalar, empty ranges give -inf
+    assert np.isscalar(utils.log_quad(logf, 0.1, 2.))
+    assert utils.log_quad(logf, 2., 2.)==-np.inf
+
+
+def test_tensor_spline():
+    # cubic splines reproduce polynomials of degree 3 along each axis
+    f = lambda x0, x1, x2: x0**3-2*x0*x1**2+x2**3*x1+x0*x1*x2-1
+    axes = [ np.linspace(0, 1, 8), np.geomspace(0.1, 3, 11), np.linspace(-2, 2, 15) ]
+    spl = utils.TensorSpline(axes, f(*np.meshgrid(*axes, indexing='ij')), k=3)
+    rng = np.random.default_rng(1)
+    x2 = rng.uniform(-2, 2, 50)
+    for x0, x1 in zip(rng.uniform(0, 1, 20), rng.uniform(0.1, 3, 20)):
+        assert np.allclose(spl(x0, x1, x2), f(x0, x1, x2), rtol=0, atol=1e-10)
+    assert np.allclose(spl(0., 3., 2.), f(0., 3., 2.), rtol=0, atol=1e-10)
+    
+    # outside the grid
+    assert np.all(np.isnan(spl(1.1, 1., x2)))
+    assert np.isnan(spl(0.5, 1., 2.5))
+    assert spl.bounds()==[ (0., 1.), (0.1, 3.), (-2., 2.) ]
+
+
+def test_lru_cache():
+    cache = utils.LRUCache(maxsize=3)
+    for i in range(5):
+        assert cache.get(i, lambda: i**2)==i**2
+    assert [ i in cache for i in range(5) ]==[False, False, True, True, True]
+    assert cache.get(2, lambda: None)==4
+    cache.get(5, lambda: 25)
+    assert 2 in cache and 3 not in cache
+    assert (cache.hits, cache.misses)==(1, 6)
+    
+    # The content is not pickled, and the copy can be used from several threads
+    copy = pickle.loads(pickle.dumps(cache))
+    assert len(copy)==0 and copy.maxsize==3
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        res = list(ex.map(lambda i: copy.get(i%3, lambda: i%3+10), range(100)))
+    assert res==[ i%3+10 for i in range(100) ]
+    assert len(copy)==3
+    assert copy.hits+copy.misses==107
+
+
+def test_inverse_cdf_sampler():
+    # power law with an analytic inverse cdf, and a pdf vanishing in part of the range
+    a, lo, hi = -2.3, 5., 100.
+    icdf = lambda u: (lo**(a+1)+u*(hi**(a+1)-lo**(a+1)))**(1/(a+1))
+    sampler = utils.InverseCDFSampler(lambda x: x**a, lo, hi)
+    sampler_zero = utils.InverseCDFSampler(lambda x: np.where((x>1) & (x<2), 0., 1.), 0., 3., res=1000)
+    
+    rng = np.random.default_rng(1)
+    u = np.concatenate([ [0., 1e-12, 0.5, 1-1e-12], rng.uniform(size=10000) ])
+    for s in (sampler, sampler_zero):
+        # same as a binary search on the tabulated cdf
+        x = s.ppf(u)
+        assert np.allclose(x, np.interp(u, s.cdf, s.x), rtol=0, atol=1e-10*(s.upper-s.lower))
+        assert np.allclose(s.cdf_at(x), u, rtol=0, atol=1e-12)
+    assert np.allclose(sampler.ppf(u), icdf(u), rtol=1e-07, atol=0)
+    # no samples where the interpolated pdf is zero
+    x0, x1 = sampler_zero.x[(sampler_zero.x>1) & (sampler_zero.x<2)][[0, -1]]
+    x = sampler_zero.ppf(u)
+    assert not np.any( (x>x0) & (x<x1) )
+    
+    np.random.seed(1)
+    assert ss.kstest(sampler.sample(20000), icdf(np.linspace(0, 1, 100001))).pvalue>1e-03
+    upper = np.full(20000, 20.)
+    x = sampler.sample_upper(upper)
+    assert np.all((x>=lo) & (x<=upper))
+    assert ss.kstest(x, icdf(np.linspace(0, 1, 100001)*sampler.cdf_at(20.))).pvalue>1e-03
+    upper = rng.uniform(lo, hi, 20000)
+    x = sampler.sample_upper(upper)
+    assert np.all((x>=lo) & (x<=upper))